@@ -1,9 +1,14 @@
 from test import support
 from unittest.mock import patch
 import datetime
+import gc
 import io
+import math
+import ntpath
 import os
+import random
 import sys
+import threading
 import time
 import tracemalloc
 import tracemalloctext
@@ -85,6 +90,31 @@ class TestTracemallocEnabled(unittest.TestCase):
         tracemalloc.disable()
         tracemalloc.clear_filters()
 
+    def test_metrics_registry_schedule(self):
+        registry = tracemalloctext.MetricsRegistry()
+        registry.history = tracemalloctext.MetricsHistory()
+        registry.register('app', lambda: {'value': (5, 'int')},
+                          interval=0.05)
+
+        def get_count():
+            if 'app.value' not in registry.history.get_names():
+                return 0
+            return len(registry.history.get_values('app.value'))
+
+        # metrics are sampled without taking snapshots
+        with patch.object(tracemalloc.Snapshot, 'create') as create:
+            task = registry.schedule(min_delay=0.01)
+            self.assertTrue(task.is_scheduled())
+            self.assertIs(registry.schedule(min_delay=0.01), task)
+            deadline = time.monotonic() + 10.0
+            while get_count() < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            task.cancel()
+        self.assertGreaterEqual(get_count(), 3)
+        self.assertFalse(create.called)
+
+        self.assertRaises(ValueError, registry.schedule, 0.0)
+
     def test_task_is_scheduled(self):
         task = tracemalloctext.Task(noop)
         task.set_delay(60)
@@ -135,6 +165,29 @@ class TestTracemallocEnabled(unittest.TestCase):
         scheduled = tracemalloctext.get_tasks()
         self.assertEqual(len(scheduled), 1)
 
+    def test_single_thread(self):
+        tasks = []
+        for delay in (60, 30, 90):
+            task = tracemalloctext.Task(noop)
+            task.set_delay(delay)
+            task.schedule()
+            tasks.append(task)
+        task = tracemalloctext.Task(noop)
+        task.set_memory_threshold(1024 * 1024)
+        task.schedule()
+        tasks.append(task)
+
+        # all tasks are driven by a single thread
+        threads = [thread for thread in threading.enumerate()
+                   if thread.name == 'tracemalloctext']
+        self.assertEqual(len(threads), 1)
+        self.assertEqual(len(tracemalloctext.get_tasks()), 4)
+
+        # the thread exits when the last task is cancelled
+        tracemalloctext.cancel_tasks()
+        threads[0].join(1.0)
+        self.assertFalse(threads[0].is_alive())
+
     def test_task_delay(self):
         calls = []
         def log_func(*args, **kw):
@@ -178,6 +231,92 @@ class TestTracemallocEnabled(unittest.TestCase):
         self.assertIsNotNone(diff)
         self.assertLessEqual(diff, threshold)
 
+    def test_task_memory_poll_adaptive(self):
+        threshold = 100 * 1024 * 1024
+        task = tracemalloctext.Task(noop)
+        task.set_memory_threshold(threshold)
+        task.set_memory_poll_delay(0.01, 0.5)
+        task.schedule()
+        entry = task._entry
+        traced = entry.min_memory + threshold
+
+        # memory is not moving: sleep the maximum delay
+        self.assertEqual(entry.memory_delay(traced, 0.0), 0.5)
+
+        # memory is growing fast: poll more often
+        delay = entry.memory_delay(traced, 1024 * 1024 * 1024)
+        self.assertLess(delay, 0.5)
+        self.assertGreaterEqual(delay, 0.01)
+
+        # the delay is bounded by the minimum delay
+        self.assertEqual(entry.memory_delay(traced, 1024 ** 4), 0.01)
+
+    def test_task_growth_rate_threshold(self):
+        calls = []
+        def log_func():
+            calls.append(log_func)
+
+        task = tracemalloctext.Task(log_func)
+        task.set_growth_rate_threshold(1024 * 1024, 0.3)
+        task.schedule()
+
+        # a short spike does not trigger the task
+        obj = allocate_bytes(10 * 1024 * 1024)
+        time.sleep(0.1)
+        obj = None
+        time.sleep(0.4)
+        self.assertEqual(calls, [])
+
+        # a sustained growth of 5 MB/sec triggers the task
+        objs = []
+        deadline = time.monotonic() + 1.0
+        while time.monotonic() < deadline and not calls:
+            objs.append(allocate_bytes(100 * 1024))
+            time.sleep(0.02)
+        self.assertEqual(len(calls), 1)
+
+    def test_task_peak_threshold(self):
+        calls = []
+        def log_func():
+            calls.append(log_func)
+
+        task = tracemalloctext.Task(log_func)
+        task.set_peak_threshold(1024 * 1024)
+        task.set_memory_poll_delay(0.01, 0.05)
+        task.schedule()
+
+        # new high-water mark
+        obj = allocate_bytes(2 * 1024 * 1024)
+        time.sleep(MEMORY_CHECK_DELAY)
+        self.assertEqual(len(calls), 1)
+
+        # the previous peak is not a new high-water mark
+        obj = None
+        obj = allocate_bytes(2 * 1024 * 1024)
+        time.sleep(MEMORY_CHECK_DELAY)
+        self.assertEqual(len(calls), 1)
+
+        obj2 = allocate_bytes(2 * 1024 * 1024)
+        time.sleep(MEMORY_CHECK_DELAY)
+        self.assertEqual(len(calls), 2)
+
+    def test_task_peak_threshold_freed(self):
+        calls = []
+        def log_func():
+            calls.append(log_func)
+
+        task = tracemalloctext.Task(log_func)
+        task.set_peak_threshold(1024 * 1024)
+        task.set_memory_poll_delay(0.5, 1.0)
+        task.schedule()
+        time.sleep(0.1)
+
+        # the peak is freed before the next poll
+        obj = allocate_bytes(2 * 1024 * 1024)
+        obj = None
+        time.sleep(1.5)
+        self.assertEqual(len(calls), 1)
+
     def test_task_repeat(self):
         calls = []
         def log_func():
@@ -226,10 +365,302 @@ class TestTracemallocEnabled(unittest.TestCase):
             for index in range(1, 4):
                 snapshot, filename = task.take_snapshot()
                 self.assertEqual(snapshot.get_metric('callback'), 5)
+                self.assertEqual(snapshot.get_metric('process.pid'),
+                                 os.getpid())
                 self.assertEqual(filename,
                                  'tracemalloc-%04d.pickle' % index)
                 self.assertTrue(os.path.exists(filename))
 
+    def test_take_snapshot_delta(self):
+        with support.temp_cwd():
+            task = tracemalloctext.TakeSnapshotTask(traces=True,
+                                                    keyframe_interval=3)
+            snapshots = []
+            objs = []
+            for index in range(5):
+                objs.append(allocate_bytes(1024 * (index + 1)))
+                snapshots.append(task.take_snapshot())
+
+            for snapshot, filename in snapshots:
+                loaded = tracemalloctext.load_snapshot(filename)
+                self.assertEqual(loaded.traces, snapshot.traces)
+                self.assertEqual(loaded.stats, snapshot.stats)
+
+            # keyframes are loadable by Snapshot.load()
+            for index in (0, 3):
+                filename = snapshots[index][1]
+                loaded = tracemalloc.Snapshot.load(filename)
+                self.assertEqual(loaded.traces, snapshots[index][0].traces)
+
+    def test_take_snapshot_policy(self):
+        policy = tracemalloctext.CapturePolicy(growth_threshold=100 * 1024)
+        with support.temp_cwd():
+            task = tracemalloctext.TakeSnapshotTask(
+                "tracemalloc-$tier-$counter.pickle", policy=policy)
+            snapshot, filename = task.take_snapshot()
+            self.assertIsNone(snapshot.traces)
+            self.assertEqual(snapshot.get_metric('capture.tier'), 0)
+            self.assertEqual(filename, 'tracemalloc-stats-0001.pickle')
+
+            obj = allocate_bytes(200 * 1024)
+            snapshot, filename = task.take_snapshot()
+            self.assertIsNotNone(snapshot.traces)
+            self.assertEqual(snapshot.get_metric('capture.tier'), 1)
+            self.assertEqual(filename, 'tracemalloc-traces-0002.pickle')
+            del obj
+
+    def test_take_snapshot_retention(self):
+        retention = tracemalloctext.RetentionPolicy(keep_last=2)
+        with support.temp_cwd():
+            task = tracemalloctext.TakeSnapshotTask(traces=True,
+                                                    keyframe_interval=3,
+                                                    retention=retention)
+            for index in range(5):
+                snapshot, filename = task.take_snapshot()
+            # tracemalloc-0004.pickle is the keyframe of the last snapshot
+            files = ['tracemalloc-0004.pickle', 'tracemalloc-0005.pickle']
+            self.assertEqual(retention.get_files(), files)
+            self.assertEqual(sorted(os.listdir(os.curdir)), files)
+            loaded = tracemalloctext.load_snapshot(filename)
+            self.assertEqual(loaded.traces, snapshot.traces)
+
+            writer = tracemalloctext.SnapshotWriter()
+            task.writer = writer
+            for index in range(3):
+                task.take_snapshot()
+                writer.flush()
+            writer.close()
+            # tracemalloc-0007.pickle is the keyframe
+            files = ['tracemalloc-0007.pickle', 'tracemalloc-0008.pickle']
+            self.assertEqual(retention.get_files(), files)
+
+    def test_take_snapshot_sample(self):
+        with support.temp_cwd():
+            task = tracemalloctext.TakeSnapshotTask(traces=True,
+                                                    sample_size=10)
+            objs = [allocate_bytes(64) for index in range(100)]
+            snapshot, filename = task.take_snapshot()
+            self.assertLessEqual(len(snapshot.traces), 10)
+            loaded = tracemalloctext.load_snapshot(filename)
+            self.assertIsNotNone(
+                loaded.get_metric('tracemalloc.sample.threshold'))
+            del objs
+
+        self.assertRaises(ValueError, tracemalloctext.TakeSnapshotTask,
+                          sample_size=0)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'need os.fork()')
+    def test_take_snapshot_fork(self):
+        with support.temp_cwd():
+            task = tracemalloctext.TakeSnapshotTask(fork=True, max_children=2)
+            filenames = []
+            for index in range(1, 4):
+                snapshot, filename = task.take_snapshot()
+                filenames.append(filename)
+                self.assertLessEqual(len(task.get_pending_files()), 2)
+
+            task.wait_children()
+            self.assertEqual(task.get_pending_files(), [])
+            for filename in filenames:
+                snapshot = tracemalloc.Snapshot.load(filename)
+                self.assertIsNotNone(snapshot.stats)
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'),
+                         'need os.register_at_fork()')
+    def test_task_fork(self):
+        def write(fd):
+            os.write(fd, b'x')
+
+        rfd, wfd = os.pipe()
+        try:
+            task = tracemalloctext.Task(write, wfd)
+            task.set_delay(0.1)
+            task.set_fork_jitter(0.1)
+            task.schedule()
+            task2 = tracemalloctext.Task(noop)
+            task2.set_delay(60)
+            task2.restart_after_fork = False
+            task2.schedule()
+            # don't call the task in the parent process
+            task.set_delay(60)
+
+            pid = os.fork()
+            if not pid:
+                # child process: the task is restarted
+                exitcode = 1
+                try:
+                    if task.is_scheduled() and not task2.is_scheduled():
+                        task.set_delay(0.1)
+                        time.sleep(1.0)
+                        exitcode = 0
+                finally:
+                    os._exit(exitcode)
+
+            pid, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+            os.set_blocking(rfd, False)
+            self.assertTrue(task.is_scheduled())
+            self.assertTrue(task2.is_scheduled())
+            self.assertEqual(os.read(rfd, 1), b'x')
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'),
+                         'need os.register_at_fork()')
+    def test_take_snapshot_task_fork(self):
+        # the filename template has no $pid: the task is not restarted
+        task = tracemalloctext.TakeSnapshotTask()
+        task.set_delay(60)
+        task.schedule()
+        task2 = tracemalloctext.TakeSnapshotTask(
+            "tracemalloc-$pid-$counter.pickle")
+        task2.set_delay(60)
+        task2.schedule()
+
+        pid = os.fork()
+        if not pid:
+            # child process
+            exitcode = 1
+            try:
+                if not task.is_scheduled() and task2.is_scheduled():
+                    exitcode = 0
+            finally:
+                os._exit(exitcode)
+        pid, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertTrue(task.is_scheduled())
+        self.assertTrue(task2.is_scheduled())
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'need os.fork()')
+    def test_take_snapshot_after_fork(self):
+        with support.temp_cwd():
+            task = tracemalloctext.TakeSnapshotTask(
+                "tracemalloc-$pid-$counter.pickle", traces=True,
+                keyframe_interval=3)
+            task.take_snapshot()
+            task._children[12345] = 'other.pickle'
+
+            pid = os.fork()
+            if not pid:
+                # child process: the first snapshot is a keyframe
+                exitcode = 1
+                try:
+                    snapshot, filename = task.take_snapshot()
+                    magic = tracemalloctext._read_magic(filename)
+                    if (not task._children
+                    and magic != tracemalloctext._DELTA_MAGIC):
+                        exitcode = 0
+                finally:
+                    os._exit(exitcode)
+            pid, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+            del task._children[12345]
+
+    def test_take_snapshot_peak_window(self):
+        with support.temp_cwd():
+            task = tracemalloctext.TakeSnapshotTask(peak_window=60)
+            obj = allocate_bytes(1024 * 1024)
+            snapshot, filename = task.take_snapshot()
+            self.assertEqual(filename, 'tracemalloc-0001.pickle')
+
+            # lower than the peak of the window: the snapshot is skipped
+            obj = None
+            snapshot, filename = task.take_snapshot()
+            self.assertIsNone(snapshot)
+            self.assertIsNone(filename)
+
+            # new peak in the same window: the file is replaced
+            obj = allocate_bytes(2 * 1024 * 1024)
+            snapshot, filename = task.take_snapshot()
+            self.assertIsNotNone(snapshot)
+            self.assertEqual(filename, 'tracemalloc-0001.pickle')
+            self.assertEqual(os.listdir(), ['tracemalloc-0001.pickle'])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'need os.fork()')
+    def test_take_snapshot_peak_window_fork(self):
+        dump_snapshot = tracemalloctext.dump_snapshot
+        def slow_dump(*args, **kw):
+            time.sleep(0.5)
+            dump_snapshot(*args, **kw)
+
+        with support.temp_cwd(), \
+             patch.object(tracemalloctext, 'dump_snapshot', slow_dump):
+            task = tracemalloctext.TakeSnapshotTask(peak_window=60,
+                                                    fork=True,
+                                                    max_children=2)
+            obj = allocate_bytes(1024 * 1024)
+            snapshot, filename = task.take_snapshot()
+            obj2 = allocate_bytes(2 * 1024 * 1024)
+            snapshot, filename2 = task.take_snapshot()
+            self.assertEqual(filename2, filename)
+            # the child writing the same file exited before the new fork
+            self.assertEqual(task.get_pending_files(), [filename])
+            task.wait_children()
+            loaded = tracemalloctext.load_snapshot(filename)
+            self.assertEqual(loaded.stats, snapshot.stats)
+            del obj, obj2
+
+    def test_writer_task_metrics(self):
+        writer = tracemalloctext.SnapshotWriter()
+        task = tracemalloctext.TakeSnapshotTask(writer=writer)
+        with support.temp_cwd():
+            task.take_snapshot()
+            writer.flush()
+            snapshot, filename = task.take_snapshot()
+            writer.close()
+        self.assertEqual(snapshot.get_metric('snapshot_writer.written'), 1)
+        self.assertIsNotNone(
+            snapshot.get_metric('snapshot_writer.average_latency'))
+
+    def test_writer_drop_delta(self):
+        event = threading.Event()
+        dump_snapshot = tracemalloctext.dump_snapshot
+        def slow_dump(*args):
+            event.wait()
+            dump_snapshot(*args)
+
+        writer = tracemalloctext.SnapshotWriter(maxsize=1, policy='drop')
+        task = tracemalloctext.TakeSnapshotTask(traces=True,
+                                                keyframe_interval=10,
+                                                writer=writer)
+        with support.temp_cwd(), \
+             patch.object(tracemalloctext, 'dump_snapshot', slow_dump):
+            snapshots = []
+            # the first snapshot is written, the second is queued, the
+            # third is dropped
+            snapshots.append(task.take_snapshot())
+            while writer.queue_size():
+                time.sleep(0.01)
+            snapshots.append(task.take_snapshot())
+            counter = task.counter
+            snapshot, filename = task.take_snapshot()
+            self.assertEqual(writer.dropped, 1)
+            # no file name is returned for a dropped snapshot
+            self.assertIsNone(filename)
+            self.assertEqual(task.counter, counter)
+            event.set()
+            writer.flush()
+            # the dropped snapshot is not used as a base
+            snapshots.append(task.take_snapshot())
+            writer.close()
+
+            for snapshot, filename in snapshots:
+                loaded = tracemalloctext.load_snapshot(filename)
+                self.assertEqual(loaded.traces, snapshot.traces)
+
+    def test_take_snapshot_table(self):
+        task = tracemalloctext.TakeSnapshotTask(traces=True)
+        with support.temp_cwd():
+            snapshot, filename = task.take_snapshot()
+            table = task.traceback_table
+            snapshot2, filename = task.take_snapshot()
+        # each snapshot gets a new table
+        self.assertIsNot(task.traceback_table, table)
+        self.assertEqual(len(task.traceback_table),
+                         len(set(trace[1]
+                                 for trace in snapshot2.traces.values())))
+
 
 class TestTop(unittest.TestCase):
     maxDiff = 2048
@@ -327,6 +758,254 @@ tracemalloc.size: 200 B (+100 B)
 Traced Python memory: 105 B
         '''.strip() + '\n\n')
 
+    def test_display_top_count(self):
+        snapshot, snapshot2 = create_snapshots()
+        top = tracemalloctext.DisplayTop()
+        top.metrics = False
+        top.display_snapshot(snapshot, file=io.StringIO())
+
+        # count=None displays all differences
+        output = io.StringIO()
+        top.compare_to_previous = False
+        top.display_snapshot(snapshot2, count=None, file=output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 8)
+        self.assertEqual(lines[0],
+                         '2013-09-12 15:16:50: Top 5 allocations per filename '
+                         'and line number (compared to 2013-09-12 15:16:17)')
+
+        # the partial selection gives the same order than the full sort
+        for count in range(1, 6):
+            output = io.StringIO()
+            top.display_snapshot(snapshot2, count=count, file=output)
+            text = output.getvalue().splitlines()
+            self.assertEqual(text[1:1 + count], lines[1:1 + count])
+            # Traced Python memory
+            self.assertEqual(text[-2], lines[-2])
+
+    @unittest.skipIf(tracemalloctext._import_numpy() is None, 'need numpy')
+    def test_top_by_numpy(self):
+        snapshot, snapshot2 = create_snapshots()
+        # stats of snapshot2 are not consistent with its traces
+        for snapshot, cumulative in ((snapshot, False), (snapshot, True),
+                                     (snapshot2, True)):
+            for group_by in ('line', 'filename'):
+                top_stats = tracemalloctext.top_by(snapshot, group_by,
+                                                   cumulative, 'numpy')
+                expected = snapshot.top_by(group_by, cumulative)
+                self.assertEqual(top_stats.stats, expected.stats)
+                self.assertEqual(top_stats.group_by, group_by)
+                self.assertEqual(top_stats.cumulative, cumulative)
+                self.assertEqual(top_stats.timestamp, snapshot.timestamp)
+
+    def test_top_by_engine(self):
+        snapshot, snapshot2 = create_snapshots()
+        expected = snapshot.top_by('line', True).stats
+
+        # fallback to the Python engine if numpy is missing
+        with patch.object(tracemalloctext, '_import_numpy', lambda: None):
+            top_stats = tracemalloctext.top_by(snapshot, 'line', True, 'numpy')
+        self.assertEqual(top_stats.stats, expected)
+
+        top_stats = tracemalloctext.top_by(snapshot, 'line', True, 'python')
+        self.assertEqual(top_stats.stats, expected)
+
+        self.assertRaises(ValueError,
+                          tracemalloctext.top_by, snapshot, 'line', True, 'c')
+
+    def test_trend(self):
+        timestamp = datetime.datetime(2013, 9, 12, 10, 0, 0)
+        trend = tracemalloctext.TrendAnalysis()
+        for index in range(5):
+            stats = {
+                # steady growth of 1 KiB per hour
+                ('leak.py', 1): (1024 * index + 10, 1 + index),
+                # one-off cache fill
+                ('cache.py', 2): (20480 if index >= 3 else 10, 1),
+            }
+            if index == 1:
+                stats[('once.py', 3)] = (100, 1)
+            top_stats = tracemalloc.GroupedStats(
+                timestamp + datetime.timedelta(hours=index),
+                stats, 'line', False, {})
+            trend.add(top_stats)
+        self.assertEqual(trend.nsnapshot, 5)
+
+        trends = trend.get_trends()
+        self.assertEqual([key_trend.key for key_trend in trends[:2]],
+                         [('leak.py', 1), ('cache.py', 2)])
+        leak = trends[0]
+        self.assertEqual((leak.size, leak.count), (4106, 5))
+        self.assertAlmostEqual(leak.slope * 3600, 1024)
+        self.assertAlmostEqual(leak.r2, 1.0)
+        self.assertEqual(leak.monotonicity, 1.0)
+        self.assertEqual(trends[1].monotonicity, 0.25)
+
+        once = trend.get_trend(('once.py', 3))
+        self.assertEqual((once.size, once.count), (0, 0))
+        self.assertEqual(once.monotonicity, 0.0)
+        self.assertEqual(once.score, 0.0)
+
+        # top stats must be added in chronological order
+        top_stats.timestamp = timestamp
+        self.assertRaises(ValueError, trend.add, top_stats)
+
+        output = io.StringIO()
+        top = tracemalloctext.DisplayTop()
+        top.display_trend(trend, count=1, file=output)
+        self.assertEqual(output.getvalue(), '''
+2013-09-12 10:00:00 - 2013-09-12 14:00:00: Top 1 growing allocations per filename and line number (5 snapshots)
+#1: leak.py:1: size=4106 B, count=5, slope=+1024 B/hour, r2=1.00, monotonic=100%
+1 more growing
+
+'''.lstrip())
+
+    def test_matrix(self):
+        snapshot, snapshot2 = create_snapshots()
+        matrix = tracemalloctext.StatsMatrix(2)
+        matrix.add(snapshot.top_by('line'))
+        matrix.add(snapshot2.top_by('line'))
+        self.assertEqual(matrix.get_rows(), [
+            # candidate of the first column: not in its top 2
+            (('a.py', 5), [(2, 1), (5002, 2)]),
+            # not in the first column
+            (('c.py', 578), [None, (400, 1)]),
+            (('b.py', 1), [(66, 1), (0, 0)]),
+            (('a.py', 2), [(30, 3), (30, 3)]),
+        ])
+        self.assertRaises(ValueError, matrix.add, snapshot.top_by('line'))
+
+        output = io.StringIO()
+        top = tracemalloctext.DisplayTop()
+        top.display_matrix(matrix, file=output)
+        self.assertEqual(output.getvalue(), '''
+Top 4 allocations per filename and line number (2 snapshots)
+2013-09-12 15:16:17  2013-09-12 15:16:50
+            2 B (1)           5002 B (2)  a.py:5
+                  -            400 B (1)  c.py:578
+           66 B (1)              0 B (0)  b.py:1
+           30 B (3)             30 B (3)  a.py:2
+
+'''.lstrip())
+
+        output = io.StringIO()
+        matrix.write_csv(output)
+        self.assertEqual(output.getvalue().splitlines(), [
+            'key,2013-09-12 15:16:17 size,2013-09-12 15:16:17 count,'
+            '2013-09-12 15:16:50 size,2013-09-12 15:16:50 count',
+            'a.py:5,2,1,5002,2',
+            'c.py:578,,,400,1',
+            'b.py:1,66,1,0,0',
+            'a.py:2,30,3,30,3',
+        ])
+
+        # second pass: fill unknown cells
+        self.assertFalse(matrix.is_complete())
+        self.assertRaises(ValueError, matrix.fill, snapshot2.top_by('line'))
+        matrix.fill(snapshot.top_by('line'))
+        matrix.fill(snapshot2.top_by('line'))
+        self.assertTrue(matrix.is_complete())
+        self.assertEqual(matrix.get_rows(), [
+            (('a.py', 5), [(2, 1), (5002, 2)]),
+            (('c.py', 578), [(0, 0), (400, 1)]),
+            (('b.py', 1), [(66, 1), (0, 0)]),
+            (('a.py', 2), [(30, 3), (30, 3)]),
+        ])
+        self.assertRaises(ValueError, matrix.fill, snapshot2.top_by('line'))
+
+        # no candidate
+        matrix = tracemalloctext.StatsMatrix(2, candidates=0)
+        matrix.add(snapshot.top_by('line'))
+        matrix.add(snapshot2.top_by('line'))
+        self.assertEqual(matrix.get_rows()[0],
+                         (('a.py', 5), [None, (5002, 2)]))
+        self.assertRaises(ValueError, tracemalloctext.StatsMatrix, 2, -1)
+
+    def test_fleet(self):
+        timestamp = datetime.datetime(2013, 9, 12, 10, 0, 0)
+        fleet = tracemalloctext.FleetAggregation(60)
+        windows = []
+        for index in range(2):
+            for worker in range(10):
+                stats = {('app.py', 1): (1000, 10)}
+                if worker == 5:
+                    stats[('leak.py', 5)] = (50000, 2)
+                top_stats = tracemalloc.GroupedStats(
+                    timestamp + datetime.timedelta(seconds=300 * index
+                                                           + worker),
+                    stats, 'line', False, {})
+                window = fleet.add(top_stats, worker)
+                if window is not None:
+                    windows.append(window)
+        # the first window is closed by the first top stats of the second
+        self.assertEqual(len(windows), 1)
+        # same worker in the same window
+        self.assertIsNone(fleet.add(top_stats, 5))
+        self.assertEqual(fleet.ignored, 1)
+
+        windows.append(fleet.flush())
+        self.assertIsNone(fleet.flush())
+        self.assertEqual(fleet.nwindow, 2)
+        self.assertEqual(len(windows[1].workers), 10)
+        window = windows[0]
+        self.assertEqual(window.timestamp, timestamp)
+        self.assertEqual(len(window.workers), 10)
+        self.assertEqual(window.workers[5], (51000, 12))
+
+        top_stats = window.get_top_stats()
+        self.assertEqual(top_stats.stats,
+                         {('app.py', 1): (10000, 100),
+                          ('leak.py', 5): (50000, 2)})
+        self.assertEqual(top_stats.metrics['fleet.workers'].value, 10)
+
+        # only worker 5 allocated memory in leak.py
+        outliers = window.get_outliers(threshold=3.0)
+        self.assertEqual(outliers, [(('leak.py', 5), 5, 50000, 0,
+                                     float('inf'))])
+        outliers = window.get_worker_outliers(threshold=3.0)
+        self.assertEqual([outlier.worker for outlier in outliers], [5])
+
+        self.assertRaises(ValueError, fleet.add,
+                          tracemalloc.GroupedStats(timestamp, {}, 'filename',
+                                                   False, {}), 1)
+        # older top stats
+        self.assertRaises(ValueError, fleet.add,
+                          tracemalloc.GroupedStats(timestamp, {}, 'line',
+                                                   False, {}), 1)
+        self.assertRaises(ValueError, tracemalloctext.FleetAggregation, 0)
+
+    def test_fleet_window_start(self):
+        # snapshots taken at :58, :59, :61 and :62 are in the same window
+        timestamp = datetime.datetime(2013, 9, 12, 10, 0, 58)
+        fleet = tracemalloctext.FleetAggregation(60)
+        windows = []
+        for worker, delay in enumerate((0, 1, 3, 4, 60, 61)):
+            top_stats = tracemalloc.GroupedStats(
+                timestamp + datetime.timedelta(seconds=delay),
+                {('app.py', 1): (1000, 1)}, 'line', False, {})
+            window = fleet.add(top_stats, worker)
+            if window is not None:
+                windows.append(window)
+        windows.append(fleet.flush())
+        self.assertEqual([len(window.workers) for window in windows], [5, 1])
+        self.assertEqual(windows[1].timestamp,
+                         timestamp + datetime.timedelta(seconds=61))
+
+    def test_fleet_small(self):
+        # the z-score of an outlier is not bounded by the number of workers
+        timestamp = datetime.datetime(2013, 9, 12, 10, 0, 0)
+        window = tracemalloctext.FleetWindow(timestamp, 'line', False)
+        for worker, size in enumerate((1000, 1020, 980, 1010, 5000)):
+            top_stats = tracemalloc.GroupedStats(
+                timestamp, {('app.py', 1): (size, 1)}, 'line', False, {})
+            window.add(top_stats, worker)
+        outliers = window.get_outliers(threshold=3.0)
+        self.assertEqual(len(outliers), 1)
+        self.assertEqual(outliers[0][:4], (('app.py', 1), 4, 5000, 1002.5))
+        self.assertAlmostEqual(outliers[0].zscore, 3997.5 / 218.75 ** 0.5)
+        outliers = window.get_worker_outliers(threshold=3.0)
+        self.assertEqual([outlier.worker for outlier in outliers], [4])
+
     def test_display_top_task(self):
         def callback(snapshot):
             snapshot.add_metric('task', 700, 'size')
@@ -356,6 +1035,913 @@ tracemalloc.size: 100 B
         '''.strip() + '\n\n')
 
 
+class TestSnapshotFile(unittest.TestCase):
+    def check_snapshot(self, snapshot, snapshot2, traces=True):
+        self.assertEqual(snapshot2.timestamp, snapshot.timestamp)
+        self.assertEqual(snapshot2.traceback_limit, snapshot.traceback_limit)
+        self.assertEqual(snapshot2.stats, snapshot.stats)
+        if traces:
+            self.assertEqual(snapshot2.traces, snapshot.traces)
+        else:
+            self.assertIsNone(snapshot2.traces)
+        self.assertEqual(snapshot2.get_metric('my_data'), 8)
+
+    def test_compression(self):
+        snapshot, snapshot2 = create_snapshots()
+        for compression in ('zlib', 'lzma'):
+            with support.temp_cwd():
+                tracemalloctext.dump_snapshot(snapshot, 'snapshot',
+                                              compression)
+                loaded = tracemalloctext.load_snapshot('snapshot')
+                self.check_snapshot(snapshot, loaded)
+
+                loaded = tracemalloctext.load_snapshot('snapshot',
+                                                       traces=False)
+                self.check_snapshot(snapshot, loaded, traces=False)
+
+        self.assertRaises(ValueError,
+                          tracemalloctext.dump_snapshot, snapshot, 'x', 'rle')
+
+    def test_columnar(self):
+        snapshot, snapshot2 = create_snapshots()
+        with support.temp_cwd():
+            tracemalloctext.dump_snapshot(snapshot, 'snapshot',
+                                          format='columnar')
+            loaded = tracemalloctext.load_snapshot('snapshot')
+            self.assertIsInstance(loaded, tracemalloctext.ColumnarSnapshot)
+
+            # group by address without loading tracebacks
+            top_stats = loaded.top_by('address')
+            self.assertEqual(top_stats.stats,
+                             snapshot.top_by('address').stats)
+            self.assertIsNone(loaded.traces._tracebacks)
+
+            self.check_snapshot(snapshot, loaded)
+            self.assertEqual(len(loaded.traces), 6)
+            self.assertEqual(loaded.traces[0x20001],
+                             (2, (('a.py', 5), ('b.py', 4))))
+            self.assertIsNone(loaded.traces.get(0x20002))
+            self.assertNotIn(0x20002, loaded.traces)
+
+            top_stats = loaded.top_by('line', True)
+            self.assertEqual(top_stats.stats,
+                             snapshot.top_by('line', True).stats)
+
+            loaded = tracemalloctext.load_snapshot('snapshot', traces=False)
+            self.check_snapshot(snapshot, loaded, traces=False)
+
+            self.assertRaises(ValueError,
+                              tracemalloctext.dump_snapshot, snapshot, 'x',
+                              'zlib', 'columnar')
+
+    def test_columnar_no_traces(self):
+        snapshot, snapshot2 = create_snapshots()
+        snapshot.traces = None
+        with support.temp_cwd():
+            tracemalloctext.dump_snapshot(snapshot, 'snapshot',
+                                          format='columnar')
+            loaded = tracemalloctext.load_snapshot('snapshot')
+            self.check_snapshot(snapshot, loaded, traces=False)
+
+    def test_delta(self):
+        snapshot, snapshot2 = create_snapshots()
+        # resized block
+        snapshot2.traces[0x10001] = (20, snapshot2.traces[0x10001][1])
+        for compression in (None, 'zlib'):
+            with support.temp_cwd():
+                tracemalloctext.dump_snapshot(snapshot, 'snapshot1')
+                tracemalloctext.dump_snapshot(
+                    snapshot2, 'snapshot2', compression,
+                    base=('snapshot1', snapshot.traces))
+                tracemalloctext.dump_snapshot(
+                    snapshot, 'snapshot3', compression,
+                    base=('snapshot2', snapshot2.traces))
+
+                loaded = tracemalloctext.load_snapshot('snapshot2')
+                self.assertEqual(loaded.traces, snapshot2.traces)
+                self.assertEqual(loaded.stats, snapshot2.stats)
+                self.assertEqual(loaded.get_metric('my_data'), 10)
+
+                cache = {}
+                loaded = tracemalloctext.load_snapshot('snapshot3', True, cache)
+                self.check_snapshot(snapshot, loaded)
+                # the cache is not modified by the caller
+                loaded.traces.clear()
+                loaded = tracemalloctext.load_snapshot('snapshot3', True, cache)
+                self.check_snapshot(snapshot, loaded)
+
+                loaded = tracemalloctext.load_snapshot('snapshot3',
+                                                       traces=False)
+                self.check_snapshot(snapshot, loaded, traces=False)
+
+    def test_writer(self):
+        snapshot, snapshot2 = create_snapshots()
+        writer = tracemalloctext.SnapshotWriter(compression='zlib')
+        with support.temp_cwd():
+            for index in range(3):
+                self.assertTrue(writer.write(snapshot, 'snapshot%s' % index))
+            writer.close()
+            self.assertEqual(writer.written, 3)
+            self.assertEqual(writer.queue_size(), 0)
+            for index in range(3):
+                loaded = tracemalloctext.load_snapshot('snapshot%s' % index)
+                self.check_snapshot(snapshot, loaded)
+
+        writer.add_metrics(snapshot2)
+        self.assertEqual(snapshot2.get_metric('snapshot_writer.written'), 3)
+        self.assertEqual(snapshot2.get_metric('snapshot_writer.dropped'), 0)
+        self.assertGreaterEqual(
+            snapshot2.get_metric('snapshot_writer.latency'), 0.0)
+        self.assertAlmostEqual(
+            snapshot2.get_metric('snapshot_writer.average_latency'),
+            writer.total_latency / 3)
+
+    def test_writer_drop(self):
+        snapshot, snapshot2 = create_snapshots()
+        event = threading.Event()
+        def slow_dump(*args):
+            event.wait()
+
+        writer = tracemalloctext.SnapshotWriter(maxsize=1, policy='drop')
+        with patch.object(tracemalloctext, 'dump_snapshot', slow_dump):
+            # the first snapshot is written, the second is queued
+            self.assertTrue(writer.write(snapshot, 'snapshot1'))
+            while writer.queue_size():
+                time.sleep(0.01)
+            self.assertTrue(writer.write(snapshot, 'snapshot2'))
+            self.assertFalse(writer.write(snapshot, 'snapshot3'))
+            self.assertEqual(writer.dropped, 1)
+            event.set()
+            writer.close()
+        self.assertEqual(writer.written, 2)
+
+        self.assertRaises(ValueError,
+                          tracemalloctext.SnapshotWriter, policy='wait')
+
+    def run_main(self, *args):
+        stdout = io.StringIO()
+        with patch.object(sys, 'argv', ['tracemalloctext'] + list(args)), \
+             patch.object(sys, 'stdout', stdout), \
+             patch.object(sys, 'stderr', io.StringIO()):
+            tracemalloctext.main()
+        return stdout.getvalue()
+
+    def test_main_jobs(self):
+        snapshot, snapshot2 = create_snapshots()
+        with support.temp_cwd():
+            tracemalloctext.dump_snapshot(snapshot2, 'snapshot2',
+                                          format='columnar')
+            tracemalloctext.dump_snapshot(snapshot, 'snapshot1')
+            for args in ((), ('-c',), ('-x', 'b.py')):
+                args += ('snapshot2', 'snapshot1')
+                expected = self.run_main(*args)
+                self.assertIn('2 snapshots', expected)
+                self.assertEqual(self.run_main('--jobs=2', *args), expected)
+
+    def test_main_trend(self):
+        snapshot, snapshot2 = create_snapshots()
+        with support.temp_cwd():
+            tracemalloctext.dump_snapshot(snapshot, 'snapshot1')
+            tracemalloctext.dump_snapshot(snapshot2, 'snapshot2')
+            # files are sorted by timestamp
+            output = self.run_main('--trend', 'snapshot2', 'snapshot1')
+        self.assertIn('2013-09-12 15:16:17 - 2013-09-12 15:16:50', output)
+        self.assertIn('2 snapshots', output)
+
+    def test_main_matrix(self):
+        snapshot, snapshot2 = create_snapshots()
+        with support.temp_cwd():
+            tracemalloctext.dump_snapshot(snapshot, 'snapshot1')
+            tracemalloctext.dump_snapshot(snapshot2, 'snapshot2')
+            # files are sorted by timestamp
+            output = self.run_main('--matrix', '--csv', '-n', '2',
+                                   'snapshot2', 'snapshot1')
+        # snapshots are read once: only candidate keys have complete rows
+        self.assertIn('a.py:5,2,1,5002,2', output.splitlines())
+        self.assertIn('c.py:578,,,400,1', output.splitlines())
+
+    def test_main_fleet(self):
+        snapshot, snapshot2 = create_snapshots()
+        snapshot.add_metric('process.pid', 100, 'int')
+        snapshot2.add_metric('process.pid', 200, 'int')
+        with support.temp_cwd():
+            # the worker is identified by its PID, not by the filename
+            tracemalloctext.dump_snapshot(snapshot, 'snapshot-0001-100')
+            tracemalloctext.dump_snapshot(snapshot2, 'snapshot-0001-200')
+            output = self.run_main('--fleet', '60',
+                                   'snapshot-0001-100', 'snapshot-0001-200')
+        self.assertIn('2 snapshots, 1 windows', output)
+        self.assertIn('fleet.workers: 2', output)
+
+    def test_worker_name(self):
+        snapshot, snapshot2 = create_snapshots()
+        top_stats = snapshot.top_by('line')
+        self.assertEqual(
+            tracemalloctext._cli_worker_name(top_stats, 'dir/snap-1234-7'),
+            '1234')
+        snapshot.add_metric('process.pid', 42, 'int')
+        top_stats = snapshot.top_by('line')
+        self.assertEqual(
+            tracemalloctext._cli_worker_name(top_stats, 'dir/snap-1234-7'),
+            '42')
+
+
+class TestTracebackTable(unittest.TestCase):
+    def test_add(self):
+        table = tracemalloctext.TracebackTable()
+        traceback1 = (('a.py', 2), ('b.py', 4))
+        traceback2 = (('a.py', 5), ('b.py', 4))
+        self.assertEqual(table.add(traceback1), 0)
+        self.assertEqual(table.add(traceback2), 1)
+        self.assertEqual(table.add((('a.py', 2), ('b.py', 4))), 0)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.get(1), traceback2)
+        self.assertEqual(table.frames, [('a.py', 2), ('b.py', 4), ('a.py', 5)])
+        self.assertEqual(table.traceback_frames, [(0, 1), (2, 1)])
+        # frames are shared by tracebacks
+        self.assertIs(table.get(0)[1], table.get(1)[1])
+
+    def test_intern_tracebacks(self):
+        snapshot, snapshot2 = create_snapshots()
+        traces = dict(snapshot.traces)
+        table = tracemalloctext.intern_tracebacks(snapshot)
+        self.assertEqual(snapshot.traces, traces)
+        self.assertEqual(len(table), 4)
+        self.assertIs(snapshot.traces[0x10001][1],
+                      snapshot.traces[0x10003][1])
+
+        # the table can be shared by snapshots
+        tracemalloctext.intern_tracebacks(snapshot2, table)
+        self.assertEqual(len(table), 5)
+        self.assertIs(snapshot.traces[0x10001][1],
+                      snapshot2.traces[0x10001][1])
+
+        addresses, sizes, traceback_ids = table.get_trace_ids(snapshot.traces)
+        self.assertEqual(sorted(zip(addresses, sizes, traceback_ids)),
+                         [(0x10001, 10, 0), (0x10002, 10, 0),
+                          (0x10003, 10, 0), (0x20001, 2, 1),
+                          (0x30001, 66, 2), (0x40001, 7, 3)])
+
+
+    def test_previous(self):
+        table = tracemalloctext.TracebackTable()
+        old_traceback = (('a.py', 1),)
+        table.add(old_traceback)
+        traceback = (('a.py', 2), ('b.py', 4))
+        interned = table.intern(traceback)
+        # the interned traceback is the key, not the original traceback
+        self.assertEqual([id(key) for key in table._traceback_ids],
+                         [id(table.get(0)), id(interned)])
+
+        table2 = tracemalloctext.TracebackTable(table)
+        self.assertIs(table2.intern((('a.py', 2), ('b.py', 4))), interned)
+        self.assertIs(table2.frames[1], interned[1])
+        self.assertEqual(len(table2), 1)
+
+        # only the previous table is reused
+        table3 = tracemalloctext.TracebackTable(table2)
+        self.assertIsNot(table3.intern((('a.py', 1),)), table.get(0))
+
+
+class TestCallTree(unittest.TestCase):
+    def test_tree(self):
+        snapshot, snapshot2 = create_snapshots()
+        tree = tracemalloctext.CallTree(snapshot.traces)
+        self.assertEqual((tree.root.size, tree.root.count), (105, 6))
+        self.assertEqual(set(tree.root.children),
+                         {('b.py', 1), ('b.py', 4), (None, None)})
+
+        node = tree.root.children[('b.py', 4)]
+        self.assertEqual((node.size, node.count), (32, 4))
+        self.assertEqual(node.get_self_stats(), (0, 0))
+        child = node.children[('a.py', 2)]
+        self.assertEqual((child.size, child.count), (30, 3))
+        self.assertEqual(child.get_path(), (('a.py', 2), ('b.py', 4)))
+        self.assertEqual(tree.get_nodes(('a.py', 2)), [child])
+
+        self.assertEqual(tree.get_callees(('b.py', 4)),
+                         {('a.py', 2): (30, 3),
+                          ('a.py', 5): (2, 1),
+                          ('b.py', 4): (0, 0)})
+
+    def test_cumulative_stats(self):
+        snapshot, snapshot2 = create_snapshots()
+        for group_by in ('line', 'filename'):
+            expected = snapshot.top_by(group_by, True).stats
+            tree = tracemalloctext.CallTree(snapshot.traces)
+            self.assertEqual(tree.get_cumulative_stats(group_by), expected)
+
+            top_stats = tracemalloctext.top_by(snapshot, group_by, True,
+                                               'tree')
+            self.assertEqual(top_stats.stats, expected)
+
+        tree = tracemalloctext.CallTree(snapshot.traces)
+        self.assertRaises(ValueError, tree.get_cumulative_stats, 'address')
+
+    def test_recursion(self):
+        traces = {
+            1: (10, (('a.py', 1), ('a.py', 2), ('a.py', 1), ('b.py', 1))),
+            2: (5, (('a.py', 2), ('a.py', 1), ('b.py', 1))),
+        }
+        tree = tracemalloctext.CallTree(traces)
+        stats = tree.get_cumulative_stats('line')
+        # a memory block is only counted once per frame
+        self.assertEqual(stats, {('a.py', 1): (15, 2),
+                                 ('a.py', 2): (15, 2),
+                                 ('b.py', 1): (15, 2)})
+        self.assertEqual(tree.get_cumulative_stats('filename'),
+                         {'a.py': (15, 2), 'b.py': (15, 2)})
+        self.assertEqual(tree.get_callees(('a.py', 1)),
+                         {('a.py', 2): (15, 2), ('a.py', 1): (0, 0)})
+
+
+class TestSampleTraces(unittest.TestCase):
+    def create_snapshot(self):
+        timestamp = datetime.datetime(2013, 9, 12, 15, 16, 17)
+        traces = {}
+        for address in range(1000):
+            traces[address] = (10, (('a.py', 1), ('c.py', 1)))
+        for address in range(1000, 2000):
+            traces[address] = (30, (('b.py', 1), ('c.py', 1)))
+        traces[2000] = (100000, (('b.py', 2), ('c.py', 1)))
+        return tracemalloc.Snapshot(timestamp, 2, {}, traces)
+
+    def test_sample(self):
+        random.seed(1)
+        snapshot = self.create_snapshot()
+        tracemalloctext.sample_traces(snapshot, 100)
+        self.assertEqual(len(snapshot.traces), 100)
+        self.assertEqual(snapshot.get_metric('tracemalloc.sample.traces'),
+                         2001)
+        threshold = snapshot.get_metric('tracemalloc.sample.threshold')
+        self.assertGreater(threshold, 30)
+        # big memory blocks are always kept
+        self.assertIn(2000, snapshot.traces)
+
+        top_stats = tracemalloctext.top_by(snapshot, 'line', True)
+        self.assertIsNotNone(getattr(top_stats, 'errors', None))
+        self.assertEqual((top_stats.nsample, top_stats.ntrace), (100, 2001))
+        # the big memory block is exact
+        self.assertEqual(top_stats.stats[('b.py', 2)], (100000, 1))
+        self.assertEqual(top_stats.errors[('b.py', 2)], 0)
+        for key, size in ((('a.py', 1), 10000), (('b.py', 1), 30000),
+                          (('c.py', 1), 140000)):
+            error = top_stats.errors[key]
+            self.assertGreater(error, 0)
+            self.assertLessEqual(abs(top_stats.stats[key][0] - size),
+                                 4 * error)
+
+        # stats of lines are exact
+        top_stats = tracemalloctext.top_by(snapshot, 'line')
+        self.assertIsNone(getattr(top_stats, 'errors', None))
+
+        self.assertRaises(ValueError,
+                          tracemalloctext.sample_traces, snapshot, 0)
+
+    def test_traceback(self):
+        random.seed(1)
+        snapshot = self.create_snapshot()
+        tracemalloctext.sample_traces(snapshot, 100)
+        threshold = snapshot.get_metric('tracemalloc.sample.threshold')
+        for group_by in ('traceback', 'address'):
+            top_stats = tracemalloctext.top_by(snapshot, group_by)
+            self.assertEqual(len(top_stats.stats), 100)
+            self.assertEqual((top_stats.nsample, top_stats.ntrace),
+                             (100, 2001))
+            total = 0
+            for key, (size, count) in top_stats.stats.items():
+                if group_by == 'traceback':
+                    address = key[0]
+                else:
+                    address = key
+                trace_size = snapshot.traces[address][0]
+                if address == 2000:
+                    # the big memory block is exact
+                    self.assertEqual((size, count), (100000, 1))
+                    self.assertEqual(top_stats.errors[key], 0)
+                else:
+                    # small memory blocks stand for threshold bytes
+                    self.assertEqual(size, round(threshold))
+                    self.assertEqual(count, round(threshold / trace_size))
+                    self.assertGreater(top_stats.errors[key], 0)
+                total += size
+            self.assertLessEqual(abs(total - 140000),
+                                 4 * math.sqrt(sum(
+                                     error ** 2
+                                     for error in top_stats.errors.values())))
+
+        output = io.StringIO()
+        top = tracemalloctext.DisplayTop()
+        top.metrics = False
+        top.display_snapshot(snapshot, count=2, group_by='traceback',
+                             file=output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0],
+                         '2013-09-12 15:16:17: Top 2 allocations per '
+                         'traceback (estimated from 100 of 2001 traces)')
+        self.assertRegex(lines[1], r'^#1: memory block 0x7d0: size=97 KiB, '
+                                   r'count=1$')
+        self.assertRegex(lines[6], r'^#2: memory block .*: size=.*, '
+                                   r'count=.*, error=\+/-')
+
+    def test_sample_all(self):
+        snapshot = self.create_snapshot()
+        expected = snapshot.top_by('filename', True).stats
+        tracemalloctext.sample_traces(snapshot, 5000)
+        self.assertEqual(len(snapshot.traces), 2001)
+        top_stats = tracemalloctext.top_by(snapshot, 'filename', True)
+        self.assertEqual(top_stats.stats, expected)
+        self.assertEqual(set(top_stats.errors.values()), {0})
+
+    def test_display(self):
+        random.seed(1)
+        snapshot = self.create_snapshot()
+        tracemalloctext.sample_traces(snapshot, 100)
+        top_stats = tracemalloctext.top_by(snapshot, 'filename', True)
+        output = io.StringIO()
+        top = tracemalloctext.DisplayTop()
+        top.metrics = False
+        top.display_top_stats(top_stats, count=3, file=output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0],
+                         '2013-09-12 15:16:17: Cumulative top 3 allocations '
+                         'per filename (estimated from 100 of 2001 traces)')
+        self.assertRegex(lines[1], r'^#1: c.py: size=.*, error=\+/-')
+        self.assertRegex(lines[2], r'^#2: b.py: size=.*, error=\+/-')
+        self.assertRegex(lines[3], r'^#3: a.py: size=.*, error=\+/-')
+
+
+class TestFilterMatcher(unittest.TestCase):
+    def test_match(self):
+        Filter = tracemalloc.Filter
+        matcher = tracemalloctext.FilterMatcher([
+            Filter(True, 'a*.py'),
+            Filter(True, 'c.py', 5),
+            Filter(False, 'abc.py'),
+            Filter(False, 'x.py', 3, True),
+        ])
+        self.assertTrue(matcher.match_frame('a.py', 1))
+        self.assertTrue(matcher.match_frame('ab.py', 1))
+        self.assertFalse(matcher.match_frame('abc.py', 1))
+        self.assertFalse(matcher.match_frame('b.py', 1))
+        # .pyc is normalized to .py
+        self.assertTrue(matcher.match_frame('a.pyc', 1))
+        self.assertFalse(matcher.match_frame('a?py', 1))
+        self.assertTrue(matcher.match_frame('c.py', 5))
+        self.assertFalse(matcher.match_frame('c.py', 6))
+        self.assertFalse(matcher.match_frame(None, None))
+
+        # only the most recent frame is checked by include filters without
+        # traceback
+        self.assertTrue(matcher.match_traceback((('a.py', 1), ('b.py', 2))))
+        self.assertFalse(matcher.match_traceback((('b.py', 2), ('a.py', 1))))
+        # all frames are checked by traceback filters
+        traceback = (('a.py', 1), ('x.py', 3))
+        self.assertFalse(matcher.match_traceback(traceback))
+        self.assertFalse(matcher.match_traceback(traceback))
+        self.assertTrue(matcher.match_traceback((('a.py', 1), ('x.py', 4))))
+
+    def test_normalize(self):
+        # same decisions than Filter.match()
+        Filter = tracemalloc.Filter
+        frames = (('a.py', 1), ('a.pyc', 1), ('a.pyo', 1), ('A.py', 1),
+                  ('b.pyc', 2))
+        for pattern in ('a.py', 'a.pyc', 'a.pyo', '*.pyc', 'b*'):
+            for include in (True, False):
+                trace_filter = Filter(include, pattern)
+                matcher = tracemalloctext.FilterMatcher([trace_filter])
+                for filename, lineno in frames:
+                    self.assertEqual(matcher.match_frame(filename, lineno),
+                                     trace_filter.match(filename, lineno),
+                                     (include, pattern, filename))
+
+        # the case is ignored on Windows
+        with patch.object(os.path, 'normcase', ntpath.normcase):
+            matcher = tracemalloctext.FilterMatcher([
+                Filter(True, 'C:\\App\\*.py')])
+            self.assertTrue(matcher.match_frame('c:/app/x.PYC', 1))
+            self.assertFalse(matcher.match_frame('c:/lib/x.py', 1))
+
+        # empty traceback
+        matcher = tracemalloctext.FilterMatcher([Filter(True, 'a.py')])
+        self.assertFalse(matcher.match_traceback(()))
+        matcher = tracemalloctext.FilterMatcher([Filter(False, 'a.py')])
+        self.assertTrue(matcher.match_traceback(()))
+
+    def test_apply_filters(self):
+        snapshot, snapshot2 = create_snapshots()
+        filters = [tracemalloc.Filter(False, 'b.py', 4, True),
+                   tracemalloc.Filter(False, '')]
+        tracemalloctext.apply_filters(snapshot, filters)
+        self.assertEqual(snapshot.traces,
+                         {0x30001: (66, (('b.py', 1),))})
+        self.assertEqual(snapshot.stats,
+                         {'a.py': {2: (30, 3), 5: (2, 1)},
+                          'b.py': {1: (66, 1)}})
+
+        # same result than Snapshot.apply_filters()
+        matcher = tracemalloctext.FilterMatcher([
+            tracemalloc.Filter(True, 'a.py'),
+            tracemalloc.Filter(False, '*', 5)])
+        for snapshot, expected in zip(create_snapshots(), create_snapshots()):
+            expected.apply_filters(matcher.filters)
+            tracemalloctext.apply_filters(snapshot, matcher)
+            self.assertEqual(snapshot.traces, expected.traces)
+            self.assertEqual(snapshot.stats, expected.stats)
+
+
+@unittest.skipUnless(sys.platform == "linux", "need /proc/self")
+class TestProcessMemoryCollector(unittest.TestCase):
+    def test_collect(self):
+        collector = tracemalloctext.ProcessMemoryCollector('statm')
+        metrics = collector.collect()
+        self.assertEqual(set(metrics), {'Size', 'RSS', 'Shared', 'Text', 'Data'})
+        self.assertGreater(metrics['RSS'][0], 0)
+        # the file is kept open
+        fd = collector._fds['statm']
+        collector.collect()
+        self.assertEqual(collector._fds['statm'], fd)
+        collector.close()
+        self.assertEqual(collector._fds, {})
+
+        collector = tracemalloctext.ProcessMemoryCollector('smaps')
+        metrics = collector.collect()
+        self.assertIn('RSS', metrics)
+        self.assertIn('Peak', metrics)
+        if os.path.exists('/proc/self/smaps_rollup'):
+            self.assertIn('smaps.Pss', metrics)
+        collector.close()
+
+        self.assertRaises(ValueError,
+                          tracemalloctext.ProcessMemoryCollector, 'maps')
+
+    def test_add_metrics(self):
+        snapshot, snapshot2 = create_snapshots()
+        tracemalloctext.add_process_memory_metrics(snapshot)
+        self.assertGreater(snapshot.get_metric('process_memory.RSS'), 0)
+
+    def test_sample(self):
+        collector = tracemalloctext.ProcessMemoryCollector(ring_size=3)
+        for index in range(5):
+            self.assertTrue(collector.sample())
+        self.assertEqual(collector.nsample, 5)
+        samples = collector.get_samples()
+        self.assertEqual(len(samples), 3)
+        times = [sample[0] for sample in samples]
+        self.assertEqual(times, sorted(times))
+        for timestamp, rss, vms in samples:
+            self.assertGreater(rss, 0)
+            self.assertGreaterEqual(vms, rss)
+        collector.close()
+
+
+class TestGCCollector(unittest.TestCase):
+    def test_collect(self):
+        collector = tracemalloctext.GCCollector()
+        metrics = collector.collect()
+        self.assertEqual(metrics['gen0.count'], (gc.get_count()[0], 'int'))
+        self.assertEqual(metrics['collect_time'][1], 'seconds')
+        # objects are not counted by default
+        self.assertNotIn('objects', metrics)
+
+        snapshot, snapshot2 = create_snapshots()
+        tracemalloctext.add_gc_metrics(snapshot)
+        self.assertIsNotNone(snapshot.get_metric('gc.gen2.count'))
+
+    def test_count_objects(self):
+        collector = tracemalloctext.GCCollector(True, min_interval=10.0,
+                                                budget=0.1)
+        clock = [100.0]
+        def monotonic():
+            clock[0] += 1.0
+            return clock[0]
+
+        def slow_get_objects():
+            clock[0] += 2.0
+            return []
+
+        with patch.object(tracemalloctext, '_time_monotonic', monotonic):
+            metrics = collector.collect()
+            self.assertGreater(metrics['objects'][0], 0)
+            # counting objects took 1 second: wait at least 10 seconds
+            self.assertEqual(metrics['objects.time'], (1.0, 'seconds'))
+            self.assertNotIn('objects', collector.collect())
+            clock[0] += 5.0
+            self.assertNotIn('objects', collector.collect())
+            clock[0] += 5.0
+            self.assertIn('objects', collector.collect())
+
+            # the budget is 10%: counting objects took 3 seconds, wait at
+            # least 30 seconds
+            clock[0] += 30.0
+            collector._last_count = None
+            with patch.object(tracemalloctext.gc, 'get_objects',
+                              side_effect=slow_get_objects):
+                metrics = collector.collect()
+            self.assertEqual(metrics['objects.time'], (3.0, 'seconds'))
+            clock[0] += 20.0
+            self.assertNotIn('objects', collector.collect())
+            clock[0] += 10.0
+            self.assertIn('objects', collector.collect())
+
+        self.assertRaises(ValueError, tracemalloctext.GCCollector, budget=0)
+
+
+class TestMetricsHistory(unittest.TestCase):
+    def test_ring_buffer(self):
+        history = tracemalloctext.MetricsHistory(4)
+        for index in range(6):
+            history.add('rss', 1000 + index * 100, 'size', 10.0 * index)
+        history.add('objects', 5, 'int', 50.0)
+        self.assertEqual(history.get_names(), ['objects', 'rss'])
+        self.assertEqual(history.get_format('rss'), 'size')
+        # only the last 4 values are kept
+        self.assertEqual(history.get_values('rss'),
+                         [(20.0, 1200), (30.0, 1300),
+                          (40.0, 1400), (50.0, 1500)])
+        self.assertEqual(history.get_values('rss', window=10),
+                         [(40.0, 1400), (50.0, 1500)])
+        self.assertEqual(history.get_min('rss'), 1200)
+        self.assertEqual(history.get_max('rss', window=10), 1500)
+        self.assertEqual(history.get_rate('rss'), 10.0)
+        self.assertIsNone(history.get_rate('objects'))
+        self.assertEqual(history.format_sparkline('rss'), '▁▃▆█')
+        self.assertRaises(KeyError, history.get_values, 'vms')
+        self.assertRaises(ValueError, tracemalloctext.MetricsHistory, 1)
+
+    def test_display(self):
+        snapshot, snapshot2 = create_snapshots()
+        history = tracemalloctext.MetricsHistory()
+        history.add_snapshot(snapshot)
+        history.add_snapshot(snapshot2)
+        self.assertEqual(history.get_values('my_data'),
+                         [(snapshot.timestamp.timestamp(), 8),
+                          (snapshot2.timestamp.timestamp(), 10)])
+
+        output = io.StringIO()
+        top = tracemalloctext.DisplayTop()
+        top.history = history
+        top.display_snapshot(snapshot2, count=1, file=output)
+        self.assertEqual(output.getvalue().splitlines()[-4:-1], [
+            'my_data: 10 ▁█ min=8, max=10',
+            'process_memory.rss: 1500 B ▁█ min=1024 B, max=1500 B',
+            'tracemalloc.size: 200 B ▁█ min=100 B, max=200 B',
+        ])
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def test_intervals(self):
+        clock = [100.0]
+        calls = []
+        def cheap():
+            calls.append('cheap')
+            return {'value': (len(calls), 'int')}
+        def expensive():
+            calls.append('expensive')
+            clock[0] += 2.0
+            return {'size': (1024, 'size')}
+        def broken():
+            raise ValueError("broken collector")
+
+        registry = tracemalloctext.MetricsRegistry()
+        registry.register('app', cheap)
+        registry.register('heap', expensive, 'expensive')
+        self.assertEqual(registry.get_collectors(), ['app', 'heap'])
+
+        with patch.object(tracemalloctext, '_time_monotonic',
+                          lambda: clock[0]):
+            metrics = registry.collect()
+            self.assertEqual(calls, ['cheap', 'expensive'])
+            self.assertEqual(metrics['app.value'], (1, 'int'))
+            self.assertEqual(metrics['heap.size'], (1024, 'size'))
+            self.assertEqual(metrics['collector.heap.time'], (2.0, 'seconds'))
+            self.assertEqual(metrics['collector.app.time'], (0.0, 'seconds'))
+
+            # the expensive collector is not due: reuse its last metrics
+            clock[0] += 30.0
+            metrics = registry.collect()
+            self.assertEqual(calls, ['cheap', 'expensive', 'cheap'])
+            self.assertEqual(metrics['app.value'], (3, 'int'))
+            self.assertEqual(metrics['heap.size'], (1024, 'size'))
+
+            clock[0] += 30.0
+            registry.collect()
+            self.assertEqual(calls[-1], 'expensive')
+
+            # budget: don't spend more than 1% of the time in the collector
+            registry.register('heap', expensive, interval=0.0, budget=0.01)
+            registry.collect()
+            del calls[:]
+            clock[0] += 100.0
+            registry.collect()
+            self.assertEqual(calls, ['cheap'])
+            clock[0] += 100.0
+            registry.collect()
+            self.assertEqual(calls, ['cheap', 'cheap', 'expensive'])
+
+            # force
+            del calls[:]
+            registry.collect(force=True)
+            self.assertEqual(calls, ['cheap', 'expensive'])
+
+            registry.unregister('heap')
+            with patch.object(sys, 'stderr', io.StringIO()) as stderr:
+                registry.register('broken', broken)
+                metrics = registry.collect()
+            self.assertIn('broken collector', stderr.getvalue())
+            self.assertIn('collector.broken.time', metrics)
+
+        self.assertRaises(ValueError, registry.register, 'x', cheap, 'free')
+        self.assertRaises(KeyError, registry.unregister, 'heap')
+
+    def test_history(self):
+        registry = tracemalloctext.MetricsRegistry()
+        registry.history = tracemalloctext.MetricsHistory()
+        registry.register('app', lambda: {'value': (5, 'int')})
+        registry.collect()
+        self.assertEqual(registry.history.get_names(),
+                         ['app.value', 'collector.app.time'])
+
+        snapshot, snapshot2 = create_snapshots()
+        registry.add_metrics(snapshot)
+        self.assertEqual(snapshot.get_metric('app.value'), 5)
+
+    def test_next_delay(self):
+        clock = [100.0]
+        registry = tracemalloctext.MetricsRegistry()
+        self.assertEqual(registry.get_next_delay(), 1.0)
+        registry.register('app', lambda: {'value': (5, 'int')})
+        registry.register('heap', lambda: {'size': (1024, 'size')},
+                          'moderate')
+        with patch.object(tracemalloctext, '_time_monotonic',
+                          lambda: clock[0]):
+            # collectors are due
+            self.assertEqual(registry.get_next_delay(0.5), 0.5)
+            registry.collect()
+            # cheap collectors are run at each collect
+            self.assertEqual(registry.get_next_delay(0.5), 0.5)
+            registry.unregister('app')
+            clock[0] += 4.0
+            self.assertEqual(registry.get_next_delay(0.5), 6.0)
+
+    def test_default_registry(self):
+        registry = tracemalloctext.get_metrics_registry()
+        self.assertIs(tracemalloctext.get_metrics_registry(), registry)
+        self.assertEqual(registry.get_collectors(),
+                         ['process_memory', 'pymalloc', 'gc', 'tracemalloc'])
+
+
+class TestCapturePolicy(unittest.TestCase):
+    def create_snapshot(self, stats):
+        timestamp = datetime.datetime(2013, 9, 12, 15, 16, 17)
+        return tracemalloc.Snapshot(timestamp, 1, stats, None)
+
+    def test_growth(self):
+        policy = tracemalloctext.CapturePolicy(growth_threshold=100,
+                                               max_per_hour=2)
+        get_tier = policy.get_tier
+        self.assertEqual(get_tier(self.create_snapshot(
+            {'a.py': {1: (1000, 1)}}), now=0), 'stats')
+        self.assertEqual(get_tier(self.create_snapshot(
+            {'a.py': {1: (1050, 1)}}), now=1), 'stats')
+        self.assertEqual(get_tier(self.create_snapshot(
+            {'a.py': {1: (1100, 1)}}), now=2), 'traces')
+        self.assertEqual(policy.last_trigger, 'growth')
+        # the growth is computed from the last full capture
+        self.assertEqual(get_tier(self.create_snapshot(
+            {'a.py': {1: (1150, 1)}}), now=3), 'stats')
+        self.assertEqual(get_tier(self.create_snapshot(
+            {'a.py': {1: (1200, 1)}}), now=4), 'traces')
+
+        # at most 2 full captures per hour
+        self.assertEqual(get_tier(self.create_snapshot(
+            {'a.py': {1: (1300, 1)}}), now=5), 'stats')
+        self.assertEqual(policy.suppressed, 1)
+        self.assertEqual(get_tier(self.create_snapshot(
+            {'a.py': {1: (1300, 1)}}), now=3602), 'traces')
+
+    def test_new_key(self):
+        policy = tracemalloctext.CapturePolicy(top_count=2)
+        stats = {'a.py': {1: (1000, 1), 2: (500, 1), 3: (10, 1)}}
+        self.assertEqual(policy.get_tier(self.create_snapshot(stats), now=0),
+                         'stats')
+        stats = {'a.py': {1: (1000, 1), 2: (10, 1), 3: (500, 1)}}
+        self.assertEqual(policy.get_tier(self.create_snapshot(stats), now=1),
+                         'traces')
+        self.assertEqual(policy.last_trigger, 'new_key')
+        self.assertEqual(policy.get_tier(self.create_snapshot(stats), now=2),
+                         'stats')
+
+        self.assertRaises(ValueError, tracemalloctext.CapturePolicy,
+                          top_count=0)
+
+
+class TestRetentionPolicy(unittest.TestCase):
+    def write(self, retention, name, timestamp, size=10, base=None):
+        with open(name, "wb") as fp:
+            fp.write(b'x' * size)
+        retention.add(name, timestamp, base)
+        retention.set_written(name)
+
+    def test_keep_last(self):
+        retention = tracemalloctext.RetentionPolicy(keep_last=2)
+        with support.temp_cwd():
+            start = datetime.datetime(2013, 9, 12, 15, 0, 0)
+            for index in range(5):
+                timestamp = start + datetime.timedelta(minutes=index)
+                self.write(retention, 'snap%s' % index, timestamp)
+            self.assertEqual(retention.get_files(), ['snap3', 'snap4'])
+            self.assertEqual(sorted(os.listdir(os.curdir)),
+                             ['snap3', 'snap4'])
+            self.assertEqual(retention.total_size, 20)
+            self.assertEqual(retention.deleted, 3)
+
+    def test_thinning(self):
+        retention = tracemalloctext.RetentionPolicy(keep_last=1, hourly=2,
+                                                    daily=2)
+        with support.temp_cwd():
+            start = datetime.datetime(2013, 9, 12, 22, 0, 0)
+            # a snapshot every 30 minutes during 4 hours
+            for index in range(8):
+                timestamp = start + datetime.timedelta(minutes=30 * index)
+                self.write(retention, 'snap%s' % index, timestamp)
+            # snap0: first of 2013-09-12, snap4: first of 2013-09-13 and
+            # of 00h, snap6: first of 01h, snap7: last
+            self.assertEqual(retention.get_files(),
+                             ['snap0', 'snap4', 'snap6', 'snap7'])
+
+    def test_max_bytes(self):
+        retention = tracemalloctext.RetentionPolicy(max_bytes=35)
+        with support.temp_cwd():
+            start = datetime.datetime(2013, 9, 12, 15, 0, 0)
+            for index in range(5):
+                timestamp = start + datetime.timedelta(minutes=index)
+                self.write(retention, 'snap%s' % index, timestamp)
+            self.assertEqual(retention.get_files(),
+                             ['snap2', 'snap3', 'snap4'])
+            self.assertEqual(retention.total_size, 30)
+
+    def test_delta_chain(self):
+        retention = tracemalloctext.RetentionPolicy(keep_last=1)
+        with support.temp_cwd():
+            start = datetime.datetime(2013, 9, 12, 15, 0, 0)
+            base = None
+            for index in range(4):
+                timestamp = start + datetime.timedelta(minutes=index)
+                if index == 2:
+                    # keyframe
+                    base = None
+                self.write(retention, 'snap%s' % index, timestamp, base=base)
+                base = 'snap%s' % index
+            # snap3 is a delta of the keyframe snap2
+            self.assertEqual(retention.get_files(), ['snap2', 'snap3'])
+
+            # a file being written protects its base
+            retention.add('snap4', start + datetime.timedelta(minutes=4),
+                          'snap3')
+            self.write(retention, 'snap5',
+                       start + datetime.timedelta(minutes=5))
+            self.assertEqual(retention.get_files(),
+                             ['snap2', 'snap3', 'snap4', 'snap5'])
+            retention.set_written('snap4', False)
+            self.write(retention, 'snap6',
+                       start + datetime.timedelta(minutes=6))
+            self.assertEqual(retention.get_files(), ['snap6'])
+
+        self.assertRaises(ValueError, tracemalloctext.RetentionPolicy,
+                          keep_last=0)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'need os.fork()')
+    def test_fork(self):
+        retention = tracemalloctext.RetentionPolicy(keep_last=2)
+        with support.temp_cwd():
+            start = datetime.datetime(2013, 9, 12, 15, 0, 0)
+            self.write(retention, 'parent-1', start)
+            self.write(retention, 'parent-2',
+                       start + datetime.timedelta(minutes=1))
+            pid = os.fork()
+            if not pid:
+                # child process
+                exitcode = 1
+                try:
+                    if retention.get_files() == []:
+                        for index in range(1, 3):
+                            timestamp = (start
+                                         + datetime.timedelta(minutes=index + 1))
+                            self.write(retention, 'child-%s' % index,
+                                       timestamp)
+                        if retention.get_files() == ['child-1', 'child-2']:
+                            exitcode = 0
+                finally:
+                    os._exit(exitcode)
+            pid, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+            # the child didn't remove files of the parent
+            self.assertEqual(sorted(os.listdir(os.curdir)),
+                             ['child-1', 'child-2', 'parent-1', 'parent-2'])
+            self.assertEqual(retention.get_files(), ['parent-1', 'parent-2'])
+
+
 class TestTask(unittest.TestCase):
     def test_func_args(self):
         def func2(*args, **kw):
@@ -395,6 +1981,38 @@ class TestTask(unittest.TestCase):
         self.assertRaises(ValueError, task.set_memory_threshold, -1)
         self.assertRaises(TypeError, task.set_memory_threshold, "str")
 
+    def test_growth_rate_threshold(self):
+        task = tracemalloctext.Task(noop)
+        self.assertIsNone(task.get_growth_rate_threshold())
+
+        task.set_growth_rate_threshold(1024, 60)
+        self.assertEqual(task.get_growth_rate_threshold(), (1024, 60))
+
+        self.assertRaises(ValueError, task.set_growth_rate_threshold, 0, 60)
+        self.assertRaises(ValueError, task.set_growth_rate_threshold, 1024, 0)
+
+    def test_peak_threshold(self):
+        task = tracemalloctext.Task(noop)
+        self.assertIsNone(task.get_peak_threshold())
+
+        task.set_peak_threshold(1024 * 1024)
+        self.assertEqual(task.get_peak_threshold(), 1024 * 1024)
+
+        self.assertRaises(ValueError, task.set_peak_threshold, 0)
+
+    def test_memory_poll_delay(self):
+        task = tracemalloctext.Task(noop)
+        self.assertEqual(task.get_memory_poll_delay(), (0.01, 0.1))
+
+        task.set_memory_poll_delay(0.05, 5.0)
+        self.assertEqual(task.get_memory_poll_delay(), (0.05, 5.0))
+
+        task.set_memory_poll_delay(1.0, 1.0)
+        self.assertEqual(task.get_memory_poll_delay(), (1.0, 1.0))
+
+        self.assertRaises(ValueError, task.set_memory_poll_delay, 0, 1.0)
+        self.assertRaises(ValueError, task.set_memory_poll_delay, 2.0, 1.0)
+
     def test_delay(self):
         task = tracemalloctext.Task(noop)
         self.assertIsNone(task.get_delay())
@@ -426,6 +2044,17 @@ def test_main():
     support.run_unittest(
         TestTracemallocEnabled,
         TestTop,
+        TestSnapshotFile,
+        TestTracebackTable,
+        TestCallTree,
+        TestSampleTraces,
+        TestFilterMatcher,
+        TestProcessMemoryCollector,
+        TestGCCollector,
+        TestMetricsHistory,
+        TestMetricsRegistry,
+        TestCapturePolicy,
+        TestRetentionPolicy,
         TestTask,
     )
 
@@ -1,17 +1,32 @@
+import array
 import atexit
+import bisect
+import collections
+import collections.abc
+import datetime
 import gc
+import heapq
+import itertools
 import linecache
+import math
+import mmap
+import operator
 import os
+import pickle
+import queue
+import random
+import re
 import signal
+import struct
 import sys
 import threading
+import time
 import tracemalloc
 import weakref
 try:
     from time import monotonic as _time_monotonic
 except ImportError:
     from time import time as _time_monotonic
-
 __version__ = '0.92'
 
 def _format_timestamp(timestamp):
@@ -121,57 +136,1991 @@ def _format_traceback(traceback, filename_parts, color):
     return lines
 
 
-def add_process_memory_metrics(snapshot):
-    # FIXME: support more platforms
-    if sys.platform != "linux":
-        return
+_PROCESS_MEMORY_DETAILS = ('statm', 'status', 'smaps')
 
-    page_size = os.sysconf("SC_PAGE_SIZE")
-    metrics = {}
-    with open("/proc/self/status", "rb") as  fp:
-        for line in fp:
-            if not line.startswith(b"Vm"):
+def _parse_kb_lines(data, prefix=None):
+    # Parse "Key:   123 kB" lines, generate (key, size in bytes)
+    for line in data.splitlines():
+        key, sep, value = line.partition(b":")
+        if not sep:
+            continue
+        if prefix is not None:
+            if not key.startswith(prefix):
                 continue
-            key, value = line.split(b":")
-            key = key[2:].decode("ascii")
-            value = value.strip()
-            if not value.endswith(b" kB"):
+            key = key[len(prefix):]
+        value = value.strip()
+        if not value.endswith(b" kB"):
+            continue
+        yield key.decode("ascii"), int(value[:-3]) * 1024
+
+
+_SPARKLINE_CHARS = '▁▂▃▄▅▆▇█'
+
+def _format_sparkline(values):
+    low = min(values)
+    high = max(values)
+    scale = len(_SPARKLINE_CHARS) - 1
+    chars = []
+    for value in values:
+        if high > low:
+            index = int(round((value - low) * scale / (high - low)))
+        else:
+            index = 0
+        chars.append(_SPARKLINE_CHARS[index])
+    return ''.join(chars)
+
+
+class _MetricSeries:
+    __slots__ = ('format', 'nvalue', 'times', 'values')
+
+    def __init__(self, format, size):
+        self.format = format
+        # total number of added values
+        self.nvalue = 0
+        self.times = array.array('d', [0.0]) * size
+        self.values = array.array('d', [0.0]) * size
+
+    def add(self, timestamp, value):
+        index = self.nvalue % len(self.times)
+        self.times[index] = timestamp
+        self.values[index] = value
+        self.nvalue += 1
+
+    def get(self, since):
+        # Get the list of (timestamp, value) oldest first
+        size = len(self.times)
+        count = min(self.nvalue, size)
+        items = []
+        for index in range(self.nvalue - count, self.nvalue):
+            index %= size
+            timestamp = self.times[index]
+            if since is not None and timestamp < since:
                 continue
-            value = int(value[:-3]) * 1024
-            metrics[key] = (value, 'size')
+            items.append((timestamp, self.values[index]))
+        return items
 
-    for key, value_format in metrics.items():
-        value, format = value_format
-        snapshot.add_metric('process_memory.%s' % key, value, format)
 
-def add_pymalloc_metrics(snapshot):
+class MetricsHistory:
+    def __init__(self, size=256):
+        if size < 2:
+            raise ValueError("size must be greater than 1")
+        self.size = size
+        # name => _MetricSeries
+        self._series = {}
+
+    def add(self, name, value, format, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            series = self._series[name]
+        except KeyError:
+            series = self._series[name] = _MetricSeries(format, self.size)
+        series.add(timestamp, value)
+
+    def add_metrics(self, metrics, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        for metric in metrics.values():
+            self.add(metric.name, metric.value, metric.format, timestamp)
+
+    def add_snapshot(self, snapshot):
+        timestamp = snapshot.timestamp.timestamp()
+        self.add_metrics(snapshot.metrics, timestamp)
+
+    def get_names(self):
+        return sorted(self._series)
+
+    def get_format(self, name):
+        return self._series[name].format
+
+    def get_values(self, name, window=None):
+        series = self._series[name]
+        if window is not None:
+            # window relative to the most recent value
+            since = series.times[(series.nvalue - 1) % self.size] - window
+        else:
+            since = None
+        return series.get(since)
+
+    def get_min(self, name, window=None):
+        values = self.get_values(name, window)
+        if not values:
+            return None
+        return min(value for timestamp, value in values)
+
+    def get_max(self, name, window=None):
+        values = self.get_values(name, window)
+        if not values:
+            return None
+        return max(value for timestamp, value in values)
+
+    def get_rate(self, name, window=None):
+        # Get the rate of change per second between the oldest and the
+        # most recent value of the window
+        values = self.get_values(name, window)
+        if len(values) < 2:
+            return None
+        first_time, first_value = values[0]
+        last_time, last_value = values[-1]
+        if last_time <= first_time:
+            return None
+        return (last_value - first_value) / (last_time - first_time)
+
+    def format_sparkline(self, name, window=None, width=20):
+        values = self.get_values(name, window)[-width:]
+        if not values:
+            return ''
+        return _format_sparkline([value for timestamp, value in values])
+
+
+# ProcessMemoryCollector instances
+_process_memory_collectors = weakref.WeakSet()
+
+class ProcessMemoryCollector:
+    def __init__(self, detail='status', ring_size=0):
+        if detail not in _PROCESS_MEMORY_DETAILS:
+            raise ValueError("unknown detail: %r" % (detail,))
+        if ring_size < 0:
+            raise ValueError("ring size must be positive or zero")
+        self.detail = detail
+        if hasattr(os, 'sysconf'):
+            self._page_size = os.sysconf("SC_PAGE_SIZE")
+        else:
+            self._page_size = 4096
+        self._lock = threading.Lock()
+        _process_memory_collectors.add(self)
+        # the process identifier of opened files: /proc/self is resolved
+        # when the file is opened
+        self._pid = None
+        # name => file descriptor, or None if the file cannot be opened
+        self._fds = {}
+        self._buffer = bytearray(4096)
+
+        # ring buffer of samples: (time, rss, vms)
+        self.ring_size = ring_size
+        self.nsample = 0
+        self._ring_time = array.array('d', [0.0]) * ring_size
+        self._ring_rss = array.array('Q', [0]) * ring_size
+        self._ring_vms = array.array('Q', [0]) * ring_size
+
+    def after_fork(self):
+        # Called in the child process: the lock may have been held by
+        # another thread of the parent. Files are reopened by _read().
+        self._lock = threading.Lock()
+
+    def _close(self):
+        for fd in self._fds.values():
+            if fd is not None:
+                os.close(fd)
+        self._fds.clear()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _read(self, name):
+        if sys.platform != "linux":
+            return None
+        pid = os.getpid()
+        if pid != self._pid:
+            # files opened by the parent process
+            self._close()
+            self._pid = pid
+        try:
+            fd = self._fds[name]
+        except KeyError:
+            try:
+                fd = os.open("/proc/self/%s" % name, os.O_RDONLY)
+            except OSError:
+                fd = None
+            self._fds[name] = fd
+        if fd is None:
+            return None
+
+        # reuse the same buffer and the same file descriptor
+        buffer = self._buffer
+        while True:
+            if hasattr(os, 'preadv'):
+                size = os.preadv(fd, [buffer], 0)
+            else:
+                data = os.pread(fd, len(buffer), 0)
+                size = len(data)
+                buffer[:size] = data
+            if size < len(buffer):
+                break
+            buffer = self._buffer = bytearray(len(buffer) * 2)
+        return buffer[:size]
+
+    def _read_statm(self):
+        data = self._read("statm")
+        if data is None:
+            return None
+        # size resident shared text lib data dt, in pages
+        fields = data.split()
+        page_size = self._page_size
+        return [int(field) * page_size for field in fields[:6]]
+
+    def _collect_rusage(self, metrics):
+        try:
+            import resource
+        except ImportError:
+            return
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            # kilobytes
+            max_rss *= 1024
+        metrics['max_rss'] = (max_rss, 'size')
+
+    def collect(self):
+        # Return a dict: name => (value, format)
+        metrics = {}
+        with self._lock:
+            if sys.platform != "linux":
+                self._collect_rusage(metrics)
+                return metrics
+
+            if self.detail == 'statm':
+                statm = self._read_statm()
+                if statm is not None:
+                    size, rss, shared, text, lib, data = statm
+                    metrics['Size'] = (size, 'size')
+                    metrics['RSS'] = (rss, 'size')
+                    metrics['Shared'] = (shared, 'size')
+                    metrics['Text'] = (text, 'size')
+                    metrics['Data'] = (data, 'size')
+            else:
+                data = self._read("status")
+                if data is not None:
+                    for key, value in _parse_kb_lines(data, b"Vm"):
+                        metrics[key] = (value, 'size')
+
+            if self.detail == 'smaps':
+                data = self._read("smaps_rollup")
+                if data is not None:
+                    for key, value in _parse_kb_lines(data):
+                        metrics['smaps.%s' % key] = (value, 'size')
+        return metrics
+
+    def add_metrics(self, snapshot):
+        for key, value_format in self.collect().items():
+            value, format = value_format
+            snapshot.add_metric('process_memory.%s' % key, value, format)
+
+    def sample(self):
+        # Read the RSS and the virtual memory size from /proc/self/statm
+        # and store them in the ring buffer
+        with self._lock:
+            statm = self._read_statm()
+            if statm is None:
+                return False
+            if self.ring_size:
+                index = self.nsample % self.ring_size
+                self._ring_time[index] = _time_monotonic()
+                self._ring_vms[index] = statm[0]
+                self._ring_rss[index] = statm[1]
+            self.nsample += 1
+            return True
+
+    def get_samples(self):
+        # Return the list of (time, rss, vms) samples of the ring buffer,
+        # oldest first
+        with self._lock:
+            count = min(self.nsample, self.ring_size)
+            start = self.nsample - count
+            samples = []
+            for index in range(start, self.nsample):
+                index %= self.ring_size
+                samples.append((self._ring_time[index],
+                                self._ring_rss[index],
+                                self._ring_vms[index]))
+            return samples
+
+_process_memory_collector = None
+
+def _get_process_memory_collector():
+    global _process_memory_collector
+    if _process_memory_collector is None:
+        _process_memory_collector = ProcessMemoryCollector()
+    return _process_memory_collector
+
+def add_process_memory_metrics(snapshot):
+    _get_process_memory_collector().add_metrics(snapshot)
+
+def _collect_pymalloc_metrics():
     # FIXME: test python version
-    snapshot.add_metric('pymalloc.blocks', sys.getallocatedblocks(), 'int')
+    return {'blocks': (sys.getallocatedblocks(), 'int')}
+
+def add_pymalloc_metrics(snapshot):
+    for key, value_format in _collect_pymalloc_metrics().items():
+        value, format = value_format
+        snapshot.add_metric('pymalloc.%s' % key, value, format)
+
+class GCCollector:
+    def __init__(self, count_objects=False, min_interval=60.0, budget=0.01):
+        if min_interval < 0:
+            raise ValueError("minimum interval must be positive or zero")
+        if budget <= 0:
+            raise ValueError("budget must be greater than zero")
+        self.count_objects = count_objects
+        self.min_interval = min_interval
+        self.budget = budget
+        # (time, duration) of the last exact count of objects
+        self._last_count = None
+
+    def _can_count_objects(self, now):
+        if self._last_count is None:
+            return True
+        last_time, duration = self._last_count
+        # don't spend more than budget of the time to count objects
+        interval = max(self.min_interval, duration / self.budget)
+        return (now - last_time >= interval)
+
+    def collect(self):
+        # Return a dict: name => (value, format)
+        metrics = {}
+        start = _time_monotonic()
+        for generation, count in enumerate(gc.get_count()):
+            metrics['gen%s.count' % generation] = (count, 'int')
+        if hasattr(gc, 'get_stats'):
+            for generation, stats in enumerate(gc.get_stats()):
+                for key in ('collections', 'collected', 'uncollectable'):
+                    metrics['gen%s.%s' % (generation, key)] = (stats[key],
+                                                               'int')
+        if hasattr(gc, 'get_freeze_count'):
+            metrics['frozen'] = (gc.get_freeze_count(), 'int')
+        metrics['garbage'] = (len(gc.garbage), 'int')
+        end = _time_monotonic()
+        metrics['collect_time'] = (end - start, 'seconds')
+
+        if self.count_objects and self._can_count_objects(end):
+            # expensive: create a list of all objects tracked by the GC
+            start = end
+            objects = len(gc.get_objects())
+            end = _time_monotonic()
+            duration = end - start
+            self._last_count = (end, duration)
+            metrics['objects'] = (objects, 'int')
+            metrics['objects.time'] = (duration, 'seconds')
+        return metrics
+
+    def add_metrics(self, snapshot):
+        for key, value_format in self.collect().items():
+            value, format = value_format
+            snapshot.add_metric('gc.%s' % key, value, format)
+
+_gc_collector = None
+
+def _get_gc_collector():
+    global _gc_collector
+    if _gc_collector is None:
+        _gc_collector = GCCollector()
+    return _gc_collector
 
 def add_gc_metrics(snapshot):
-    snapshot.add_metric('gc.objects', len(gc.get_objects()), 'int')
+    _get_gc_collector().add_metrics(snapshot)
 
-def add_tracemalloc_metrics(snapshot):
+def _collect_tracemalloc_metrics():
+    metrics = {}
     size, max_size = tracemalloc.get_traced_memory()
-    snapshot.add_metric('tracemalloc.traced.size', size, 'size')
-    snapshot.add_metric('tracemalloc.traced.max_size', max_size, 'size')
-
-    if snapshot.traces:
-        snapshot.add_metric('tracemalloc.traces', len(snapshot.traces), 'int')
+    metrics['traced.size'] = (size, 'size')
+    metrics['traced.max_size'] = (max_size, 'size')
 
     size, free = tracemalloc.get_tracemalloc_memory()
-    snapshot.add_metric('tracemalloc.module.size', size, 'size')
-    snapshot.add_metric('tracemalloc.module.free', free, 'size')
+    metrics['module.size'] = (size, 'size')
+    metrics['module.free'] = (free, 'size')
     if size:
         frag = free / size
-        snapshot.add_metric('tracemalloc.module.fragmentation', frag, 'percent')
+        metrics['module.fragmentation'] = (frag, 'percent')
+    return metrics
+
+def _add_traces_metric(snapshot):
+    if snapshot.traces:
+        snapshot.add_metric('tracemalloc.traces', len(snapshot.traces), 'int')
+
+def add_tracemalloc_metrics(snapshot):
+    for key, value_format in _collect_tracemalloc_metrics().items():
+        value, format = value_format
+        snapshot.add_metric('tracemalloc.%s' % key, value, format)
+    _add_traces_metric(snapshot)
+
+
+# cost class => default interval in seconds between two collects
+# (None means at each collect)
+_COLLECTOR_INTERVALS = {
+    'cheap': None,
+    'moderate': 10.0,
+    'expensive': 60.0,
+}
+# minimum delay in seconds between two collects of MetricsRegistry.schedule()
+_MIN_COLLECT_DELAY = 1.0
+
+class _RegisteredCollector:
+    __slots__ = ('name', 'collect', 'cost', 'interval', 'budget',
+                 'last_time', 'runtime', 'metrics')
+
+    def __init__(self, name, collect, cost, interval, budget):
+        self.name = name
+        self.collect = collect
+        self.cost = cost
+        self.interval = interval
+        self.budget = budget
+        # monotonic time and duration of the last collect
+        self.last_time = None
+        self.runtime = None
+        # metrics of the last collect
+        self.metrics = {}
+
+    def get_due_delay(self, now):
+        # Get the delay in seconds until the collector is due
+        if self.last_time is None:
+            return 0.0
+        interval = self.interval
+        if interval is None:
+            interval = 0.0
+        if self.budget is not None:
+            # don't spend more than budget of the time in the collector
+            interval = max(interval, self.runtime / self.budget)
+        return max(self.last_time + interval - now, 0.0)
+
+    def is_due(self, now):
+        return (self.get_due_delay(now) <= 0.0)
+
+
+# MetricsRegistry instances
+_metrics_registries = weakref.WeakSet()
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        _metrics_registries.add(self)
+        # name => _RegisteredCollector
+        self._collectors = collections.OrderedDict()
+        # MetricsHistory instance, or None
+        self.history = None
+        # _CollectTask instance, or None
+        self._task = None
+
+    def register(self, name, collect, cost='cheap', interval=None,
+                 budget=None):
+        if cost not in _COLLECTOR_INTERVALS:
+            raise ValueError("unknown cost class: %r" % (cost,))
+        if interval is None:
+            interval = _COLLECTOR_INTERVALS[cost]
+        elif interval < 0:
+            raise ValueError("interval must be positive or zero")
+        if budget is not None and budget <= 0:
+            raise ValueError("budget must be greater than zero")
+        collector = _RegisteredCollector(name, collect, cost, interval,
+                                         budget)
+        with self._lock:
+            self._collectors[name] = collector
+
+    def unregister(self, name):
+        with self._lock:
+            del self._collectors[name]
+
+    def get_collectors(self):
+        with self._lock:
+            return list(self._collectors)
+
+    def after_fork(self):
+        # Called in the child process: the lock may have been held by
+        # another thread of the parent
+        self._lock = threading.Lock()
+
+    def _run(self, collector):
+        start = _time_monotonic()
+        try:
+            values = collector.collect()
+        except Exception:
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            print(("%s: %s" % (exc_type, exc_value)), file=sys.stderr)
+            values = {}
+        end = _time_monotonic()
+        collector.last_time = end
+        collector.runtime = end - start
+
+        metrics = {}
+        for key, value_format in values.items():
+            metrics['%s.%s' % (collector.name, key)] = value_format
+        metrics['collector.%s.time' % collector.name] = (collector.runtime,
+                                                         'seconds')
+        collector.metrics = metrics
+
+    def collect(self, force=False):
+        # Run collectors which are due and return all metrics: a dict
+        # name => (value, format). Collectors which are not due return
+        # metrics of their last collect.
+        metrics = {}
+        with self._lock:
+            now = _time_monotonic()
+            updated = []
+            for collector in self._collectors.values():
+                if force or collector.is_due(now):
+                    self._run(collector)
+                    updated.append(collector)
+                metrics.update(collector.metrics)
+
+            if self.history is not None and updated:
+                timestamp = time.time()
+                for collector in updated:
+                    for name, value_format in collector.metrics.items():
+                        value, format = value_format
+                        self.history.add(name, value, format, timestamp)
+        return metrics
+
+    def add_metrics(self, snapshot, force=False):
+        for name, value_format in self.collect(force).items():
+            value, format = value_format
+            snapshot.add_metric(name, value, format)
+
+    def get_next_delay(self, min_delay=_MIN_COLLECT_DELAY):
+        # Get the delay in seconds until the next collector is due
+        with self._lock:
+            now = _time_monotonic()
+            delays = [collector.get_due_delay(now)
+                      for collector in self._collectors.values()]
+        if delays:
+            return max(min(delays), min_delay)
+        return min_delay
+
+    def schedule(self, min_delay=_MIN_COLLECT_DELAY):
+        if min_delay <= 0.0:
+            raise ValueError("minimum delay must greater than 0")
+        if self._task is None:
+            self._task = _CollectTask(self)
+        task = self._task
+        task.min_delay = min_delay
+        task.set_delay(self.get_next_delay(min_delay))
+        task.schedule()
+        return task
+
+_metrics_registry = None
+
+def get_metrics_registry():
+    global _metrics_registry
+    if _metrics_registry is None:
+        registry = MetricsRegistry()
+        registry.register('process_memory',
+                          _get_process_memory_collector().collect)
+        registry.register('pymalloc', _collect_pymalloc_metrics)
+        registry.register('gc', _get_gc_collector().collect)
+        registry.register('tracemalloc', _collect_tracemalloc_metrics)
+        _metrics_registry = registry
+    return _metrics_registry
 
 def add_metrics(snapshot):
-    add_process_memory_metrics(snapshot)
-    add_pymalloc_metrics(snapshot)
-    add_gc_metrics(snapshot)
-    # tracemalloc metrics uses the traces attribute
-    add_tracemalloc_metrics(snapshot)
+    get_metrics_registry().add_metrics(snapshot)
+    # the number of traces depends on the snapshot
+    _add_traces_metric(snapshot)
+
+class TracebackTable:
+    def __init__(self, previous=None):
+        # frame identifier => (filename, lineno)
+        self.frames = []
+        self._frame_ids = {}
+        # traceback identifier => traceback: tuple of interned frames
+        self.tracebacks = []
+        # traceback identifier => tuple of frame identifiers
+        self.traceback_frames = []
+        self._traceback_ids = {}
+        # Interned frames and tracebacks of the previous table are reused.
+        # Only its data is kept, not the previous table itself: tables
+        # don't form a chain.
+        if previous is not None:
+            self._previous_frames = previous.frames
+            self._previous_frame_ids = previous._frame_ids
+            self._previous_tracebacks = previous.tracebacks
+            self._previous_traceback_ids = previous._traceback_ids
+        else:
+            self._previous_frame_ids = None
+            self._previous_traceback_ids = None
+
+    def __len__(self):
+        return len(self.tracebacks)
+
+    def _add_frame(self, frame):
+        try:
+            return self._frame_ids[frame]
+        except KeyError:
+            pass
+        if self._previous_frame_ids is not None:
+            previous_id = self._previous_frame_ids.get(frame)
+            if previous_id is not None:
+                frame = self._previous_frames[previous_id]
+        frame_id = len(self.frames)
+        self._frame_ids[frame] = frame_id
+        self.frames.append(frame)
+        return frame_id
+
+    def add(self, traceback):
+        try:
+            return self._traceback_ids[traceback]
+        except KeyError:
+            pass
+        frame_ids = tuple(self._add_frame(frame) for frame in traceback)
+        interned = None
+        if self._previous_traceback_ids is not None:
+            previous_id = self._previous_traceback_ids.get(traceback)
+            if previous_id is not None:
+                interned = self._previous_tracebacks[previous_id]
+        if interned is None:
+            frames = self.frames
+            interned = tuple(frames[frame_id] for frame_id in frame_ids)
+        traceback_id = len(self.tracebacks)
+        # use the interned traceback as the key to not keep the original
+        # traceback alive
+        self._traceback_ids[interned] = traceback_id
+        self.tracebacks.append(interned)
+        self.traceback_frames.append(frame_ids)
+        return traceback_id
+
+    def get(self, traceback_id):
+        return self.tracebacks[traceback_id]
+
+    def intern(self, traceback):
+        return self.tracebacks[self.add(traceback)]
+
+    def get_trace_ids(self, traces):
+        # Return (addresses, sizes, traceback_ids) lists
+        addresses = []
+        sizes = []
+        traceback_ids = []
+        add = self.add
+        for address, trace in traces.items():
+            addresses.append(address)
+            sizes.append(trace[0])
+            traceback_ids.append(add(trace[1]))
+        return addresses, sizes, traceback_ids
+
+    def intern_traces(self, traces):
+        # Replace tracebacks of traces with interned tracebacks inplace
+        intern = self.intern
+        for address, trace in traces.items():
+            traceback = intern(trace[1])
+            if traceback is not trace[1]:
+                traces[address] = (trace[0], traceback)
+
+def intern_tracebacks(snapshot, table=None):
+    if table is None:
+        table = TracebackTable()
+    if snapshot.traces is not None:
+        table.intern_traces(snapshot.traces)
+    return table
+
+
+def _normalize_filename(filename):
+    # Normalize a filename or a pattern like tracemalloc.Filter: ".pyc" and
+    # ".pyo" suffixes are replaced with ".py", the case is ignored on Windows
+    filename = os.path.normcase(filename)
+    if filename.endswith(('.pyc', '.pyo')):
+        filename = filename[:-1]
+    return filename
+
+def _compile_patterns(patterns):
+    # Compile filename patterns into a single regular expression. The "*"
+    # joker is the only special character.
+    regexes = []
+    for pattern in sorted(set(map(_normalize_filename, patterns))):
+        regex = '.*'.join(re.escape(part) for part in pattern.split('*'))
+        regexes.append(regex)
+    regex = '(?:%s)\\Z' % '|'.join(regexes)
+    return re.compile(regex, re.DOTALL).match
+
+
+class _FrameMatcher:
+    def __init__(self, filters):
+        patterns = set()
+        lineno_patterns = {}
+        for trace_filter in filters:
+            if trace_filter.lineno is not None:
+                lineno_patterns.setdefault(trace_filter.lineno, set()).add(
+                    trace_filter.pattern)
+            else:
+                patterns.add(trace_filter.pattern)
+        if patterns:
+            self._match_filename = _compile_patterns(patterns)
+        else:
+            self._match_filename = None
+        self._lineno_match = dict(
+            (lineno, _compile_patterns(patterns))
+            for lineno, patterns in lineno_patterns.items())
+        # frame => bool
+        self._cache = {}
+
+    def __call__(self, frame):
+        try:
+            return self._cache[frame]
+        except KeyError:
+            pass
+
+        filename, lineno = frame
+        if filename is None:
+            filename = ''
+        else:
+            filename = _normalize_filename(filename)
+        match = False
+        if self._match_filename is not None:
+            match = (self._match_filename(filename) is not None)
+        if not match and lineno in self._lineno_match:
+            match = (self._lineno_match[lineno](filename) is not None)
+        self._cache[frame] = match
+        return match
+
+
+class FilterMatcher:
+    def __init__(self, filters):
+        self.filters = list(filters)
+        matchers = []
+        for include in (True, False):
+            for traceback in (False, True):
+                group = [trace_filter for trace_filter in self.filters
+                         if (bool(trace_filter.include) == include
+                             and bool(trace_filter.traceback) == traceback)]
+                if group:
+                    matchers.append(_FrameMatcher(group))
+                else:
+                    matchers.append(None)
+        (self._include_frame, self._include_traceback,
+         self._exclude_frame, self._exclude_traceback) = matchers
+        self._include = (self._include_frame is not None
+                         or self._include_traceback is not None)
+        # id(traceback) => (traceback, bool): tracebacks are usually interned
+        # (see intern_tracebacks()), storing the traceback keeps its
+        # identifier alive
+        self._traceback_cache = {}
+
+    def __len__(self):
+        return len(self.filters)
+
+    def _match(self, traceback):
+        if not traceback:
+            # unknown frame
+            traceback = ((None, None),)
+        if self._include:
+            match = False
+            if self._include_frame is not None:
+                match = self._include_frame(traceback[0])
+            if not match and self._include_traceback is not None:
+                match = any(map(self._include_traceback, traceback))
+            if not match:
+                return False
+        if self._exclude_frame is not None:
+            if self._exclude_frame(traceback[0]):
+                return False
+        if self._exclude_traceback is not None:
+            if any(map(self._exclude_traceback, traceback)):
+                return False
+        return True
+
+    def match_traceback(self, traceback):
+        key = id(traceback)
+        try:
+            cached, match = self._traceback_cache[key]
+            if cached is traceback:
+                return match
+        except KeyError:
+            pass
+        match = self._match(traceback)
+        self._traceback_cache[key] = (traceback, match)
+        return match
+
+    def match_frame(self, filename, lineno):
+        return self._match(((filename, lineno),))
+
+    def filter_traces(self, traces):
+        match_traceback = self.match_traceback
+        return dict((address, trace) for address, trace in traces.items()
+                    if match_traceback(trace[1]))
+
+    def filter_stats(self, stats):
+        new_stats = {}
+        for filename, line_stats in stats.items():
+            new_line_stats = dict(
+                (lineno, line_stat) for lineno, line_stat in line_stats.items()
+                if self._match(((filename, lineno),)))
+            if new_line_stats:
+                new_stats[filename] = new_line_stats
+        return new_stats
+
+
+def apply_filters(snapshot, filters):
+    if not isinstance(filters, FilterMatcher):
+        filters = FilterMatcher(filters)
+    if not filters:
+        return
+    if isinstance(snapshot, ColumnarSnapshot):
+        snapshot.load_traces()
+        snapshot = snapshot._snapshot
+    if snapshot.stats is not None:
+        snapshot.stats = filters.filter_stats(snapshot.stats)
+    if snapshot.traces is not None:
+        snapshot.traces = filters.filter_traces(snapshot.traces)
+
+
+def _group_tracebacks(table, group_by, cumulative):
+    # Map each traceback of the table to the list of its key identifiers.
+    # Return (keys, traceback_keys).
+    key_ids = {}
+    keys = []
+    traceback_keys = []
+    for traceback in table.tracebacks:
+        if not cumulative:
+            traceback = traceback[:1]
+        ids = []
+        for frame in traceback:
+            if group_by == 'filename':
+                key = frame[0]
+            else:
+                key = frame
+            try:
+                key_id = key_ids[key]
+            except KeyError:
+                key_id = len(keys)
+                key_ids[key] = key_id
+                keys.append(key)
+            # a key is only counted once per traceback
+            if key_id not in ids:
+                ids.append(key_id)
+        traceback_keys.append(ids)
+    return keys, traceback_keys
+
+# numpy module imported by _import_numpy(), None if numpy is missing
+_numpy = None
+_numpy_imported = False
+
+def _import_numpy():
+    # Only import numpy when the numpy engine is used: the import takes time
+    # and its memory would be traced in snapshots of the process
+    global _numpy, _numpy_imported
+    if not _numpy_imported:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+        _numpy_imported = True
+    return _numpy
+
+def _numpy_top_by(snapshot, group_by, cumulative):
+    numpy = _import_numpy()
+    traces = list(snapshot.traces.values())
+    ntrace = len(traces)
+
+    # build arrays without a Python loop per trace: tracebacks are
+    # identified by their id(), interned tracebacks share the same object
+    sizes = numpy.fromiter(map(operator.itemgetter(0), traces),
+                           dtype=numpy.int64, count=ntrace)
+    object_ids = numpy.fromiter(map(id, map(operator.itemgetter(1), traces)),
+                                dtype=numpy.uintp, count=ntrace)
+    object_ids, first_indexes, traceback_ids = numpy.unique(
+        object_ids, return_index=True, return_inverse=True)
+    del object_ids
+    # equal tracebacks which are not interned get the same identifier
+    table = TracebackTable()
+    table_ids = numpy.fromiter(
+        (table.add(traces[index][1]) for index in first_indexes.tolist()),
+        dtype=numpy.intp, count=len(first_indexes))
+    traceback_ids = table_ids[traceback_ids.reshape(-1)]
+    del traces, first_indexes, table_ids
+    ntraceback = len(table)
+
+    # aggregate traces per traceback
+    traceback_sizes = numpy.bincount(traceback_ids, weights=sizes,
+                                     minlength=ntraceback)
+    traceback_counts = numpy.bincount(traceback_ids, minlength=ntraceback)
+    del traceback_ids, sizes
+
+    # aggregate tracebacks per key
+    keys, traceback_keys = _group_tracebacks(table, group_by, cumulative)
+    lengths = numpy.fromiter(map(len, traceback_keys), dtype=numpy.intp,
+                             count=ntraceback)
+    key_ids = numpy.fromiter(itertools.chain.from_iterable(traceback_keys),
+                             dtype=numpy.intp, count=int(lengths.sum()))
+    key_sizes = numpy.bincount(key_ids,
+                               weights=numpy.repeat(traceback_sizes, lengths),
+                               minlength=len(keys))
+    key_counts = numpy.bincount(key_ids,
+                                weights=numpy.repeat(traceback_counts, lengths),
+                                minlength=len(keys))
+
+    stats = {}
+    key_sizes = numpy.rint(key_sizes).astype(numpy.int64).tolist()
+    key_counts = numpy.rint(key_counts).astype(numpy.int64).tolist()
+    for key, size, count in zip(keys, key_sizes, key_counts):
+        if count:
+            stats[key] = (size, count)
+    return tracemalloc.GroupedStats(snapshot.timestamp, stats, group_by,
+                                    cumulative, snapshot.metrics)
+
+
+def _identity(obj):
+    return obj
+
+
+class CallTreeNode:
+    __slots__ = ('frame', 'parent', 'children', 'size', 'count')
+
+    def __init__(self, frame, parent):
+        self.frame = frame
+        self.parent = parent
+        # frame => CallTreeNode
+        self.children = {}
+        # size and number of memory blocks allocated by this frame and its
+        # callees
+        self.size = 0
+        self.count = 0
+
+    def get_self_stats(self):
+        # Get (size, count) of memory blocks allocated directly by this
+        # frame, not by its callees
+        size = self.size
+        count = self.count
+        for child in self.children.values():
+            size -= child.size
+            count -= child.count
+        return (size, count)
+
+    def get_path(self):
+        frames = []
+        node = self
+        while node.parent is not None:
+            frames.append(node.frame)
+            node = node.parent
+        return tuple(frames)
+
+
+class CallTree:
+    def __init__(self, traces, table=None):
+        if table is None:
+            table = TracebackTable()
+        addresses, sizes, traceback_ids = table.get_trace_ids(traces)
+        del addresses
+
+        # aggregate traces per traceback
+        traceback_sizes = [0] * len(table)
+        traceback_counts = [0] * len(table)
+        for traceback_id, size in zip(traceback_ids, sizes):
+            traceback_sizes[traceback_id] += size
+            traceback_counts[traceback_id] += 1
+        del sizes, traceback_ids
+
+        # insert each traceback once: frames shared by common prefixes are
+        # only computed once
+        self.root = CallTreeNode(None, None)
+        # frame => list of nodes
+        self._nodes = {}
+        for traceback_id, traceback in enumerate(table.tracebacks):
+            size = traceback_sizes[traceback_id]
+            count = traceback_counts[traceback_id]
+            if not count:
+                continue
+            node = self.root
+            node.size += size
+            node.count += count
+            # the most recent frame is the first frame of the traceback
+            for frame in reversed(traceback):
+                try:
+                    child = node.children[frame]
+                except KeyError:
+                    child = CallTreeNode(frame, node)
+                    node.children[frame] = child
+                    self._nodes.setdefault(frame, []).append(child)
+                node = child
+                node.size += size
+                node.count += count
+
+    def get_nodes(self, frame):
+        return list(self._nodes.get(frame, ()))
+
+    def _iter_outermost(self, key_func):
+        # Generate (key, node) for each node which has no ancestor with the
+        # same key, so a memory block is only counted once per key
+        active = {}
+        stack = [(self.root, False)]
+        while stack:
+            node, leave = stack.pop()
+            if node.parent is None:
+                key = None
+            else:
+                key = key_func(node.frame)
+            if leave:
+                active[key] -= 1
+                continue
+            if node.parent is not None:
+                if not active.get(key):
+                    yield key, node
+                active[key] = active.get(key, 0) + 1
+                stack.append((node, True))
+            stack.extend((child, False) for child in node.children.values())
+
+    def get_cumulative_stats(self, group_by='line'):
+        if group_by == 'filename':
+            key_func = operator.itemgetter(0)
+        elif group_by == 'line':
+            key_func = _identity
+        else:
+            raise ValueError("unable to group by %r" % (group_by,))
+
+        stats = {}
+        for key, node in self._iter_outermost(key_func):
+            size, count = stats.get(key, (0, 0))
+            stats[key] = (size + node.size, count + node.count)
+        return stats
+
+    def get_callees(self, frame):
+        # Get where the memory allocated through frame goes: return a
+        # dict callee frame => (size, count). The frame itself is used as
+        # the key of memory blocks allocated directly by the frame.
+        callees = {}
+        for node in self._nodes.get(frame, ()):
+            # skip recursive calls, already counted by the outer node
+            parent = node.parent
+            while parent is not None and parent.frame != frame:
+                parent = parent.parent
+            if parent is not None:
+                continue
+
+            items = [(child.frame, (child.size, child.count))
+                     for child in node.children.values()]
+            items.append((frame, node.get_self_stats()))
+            for key, stats in items:
+                size, count = callees.get(key, (0, 0))
+                callees[key] = (size + stats[0], count + stats[1])
+        return callees
+
+
+def sample_traces(snapshot, size):
+    # Priority sampling: the priority of a trace is its size divided by a
+    # random number in (0, 1], the size biggest priorities are kept. The
+    # threshold is the next priority: traces bigger than the threshold are
+    # always kept.
+    if size < 1:
+        raise ValueError("sample size must be at least 1")
+    traces = snapshot.traces
+    if traces is None:
+        raise ValueError("the snapshot has no traces")
+    ntrace = len(traces)
+    if ntrace > size:
+        rand = random.random
+        items = heapq.nlargest(size + 1,
+                               ((trace[0] / (1.0 - rand()), address)
+                                for address, trace in traces.items()))
+        threshold = items.pop()[0]
+        snapshot.traces = dict((address, traces[address])
+                               for priority, address in items)
+    else:
+        threshold = 0
+    snapshot.add_metric('tracemalloc.sample.threshold', threshold, 'size')
+    snapshot.add_metric('tracemalloc.sample.traces', ntrace, 'int')
+
+
+def _estimate_trace(size, threshold):
+    # Return (size, count, variance) estimates of a sampled trace: a trace
+    # smaller than the threshold stands for threshold bytes, threshold /
+    # size memory blocks of its size
+    if size >= threshold:
+        return (size, 1.0, 0.0)
+    else:
+        return (threshold, threshold / size, threshold * (threshold - size))
+
+def _estimate_top_by(snapshot, group_by, cumulative, threshold):
+    traces = snapshot.traces
+    stats = {}
+    errors = {}
+    if group_by in ('address', 'traceback'):
+        # a key per memory block
+        for address, trace in traces.items():
+            size, count, variance = _estimate_trace(trace[0], threshold)
+            if group_by == 'address':
+                key = address
+            else:
+                key = (address, trace[1])
+            stats[key] = (int(round(size)), int(round(count)))
+            errors[key] = int(round(math.sqrt(variance)))
+    else:
+        table = TracebackTable()
+        addresses, sizes, traceback_ids = table.get_trace_ids(traces)
+        del addresses
+        keys, traceback_keys = _group_tracebacks(table, group_by, True)
+        key_sizes = [0.0] * len(keys)
+        key_counts = [0.0] * len(keys)
+        key_variances = [0.0] * len(keys)
+        for size, traceback_id in zip(sizes, traceback_ids):
+            size, count, variance = _estimate_trace(size, threshold)
+            for key_id in traceback_keys[traceback_id]:
+                key_sizes[key_id] += size
+                key_counts[key_id] += count
+                key_variances[key_id] += variance
+
+        for key, size, count, variance in zip(keys, key_sizes, key_counts,
+                                              key_variances):
+            stats[key] = (int(round(size)), int(round(count)))
+            errors[key] = int(round(math.sqrt(variance)))
+    top_stats = tracemalloc.GroupedStats(snapshot.timestamp, stats, group_by,
+                                         cumulative, snapshot.metrics)
+    # key => standard error of the estimated size
+    top_stats.errors = errors
+    top_stats.nsample = len(traces)
+    top_stats.ntrace = snapshot.get_metric('tracemalloc.sample.traces',
+                                           len(traces))
+    return top_stats
+
+
+def top_by(snapshot, group_by="line", cumulative=False, engine=None):
+    if engine is None:
+        # the vectorized engine and the call tree are only faster if all
+        # frames are used
+        if not cumulative:
+            engine = 'python'
+        elif _import_numpy() is not None:
+            engine = 'numpy'
+        else:
+            engine = 'tree'
+    if engine == 'numpy':
+        if _import_numpy() is None:
+            engine = 'python'
+    elif engine == 'tree':
+        if not cumulative:
+            engine = 'python'
+    elif engine != 'python':
+        raise ValueError("unknown engine: %r" % (engine,))
+
+    # traces of a sampled snapshot give estimates of cumulative stats and
+    # of stats per memory block, stats of lines and filenames are exact
+    threshold = snapshot.get_metric('tracemalloc.sample.threshold')
+    if (threshold is not None
+    and (cumulative or group_by in ('address', 'traceback'))
+    and snapshot.traces is not None):
+        return _estimate_top_by(snapshot, group_by, cumulative, threshold)
+
+    if (engine != 'python'
+    and group_by in ('line', 'filename')
+    and snapshot.traces is not None):
+        if engine == 'numpy':
+            return _numpy_top_by(snapshot, group_by, cumulative)
+        else:
+            tree = CallTree(snapshot.traces)
+            stats = tree.get_cumulative_stats(group_by)
+            return tracemalloc.GroupedStats(snapshot.timestamp, stats,
+                                            group_by, cumulative,
+                                            snapshot.metrics)
+    return snapshot.top_by(group_by, cumulative)
+
+
+# Magic numbers of snapshot file formats
+_GZIP_MAGIC = b'\x1f\x8b'
+_XZ_MAGIC = b'\xfd7zXZ\x00'
+_PICKLE_MAGIC = b'TMTPCKL1'
+_COLUMNAR_MAGIC = b'TMTCOLS1'
+_DELTA_MAGIC = b'TMTDELT1'
+_MAGIC_SIZE = 8
+
+# Type codes of the columns of the columnar format
+_ADDRESS_TYPECODE = 'Q'
+_SIZE_TYPECODE = 'Q'
+_TRACEBACK_ID_TYPECODE = 'I'
+
+def _open_compressed(filename, mode, compression):
+    if compression == 'zlib':
+        import gzip
+        return gzip.open(filename, mode)
+    elif compression == 'lzma':
+        import lzma
+        return lzma.open(filename, mode)
+    else:
+        raise ValueError("unknown compression: %r" % (compression,))
+
+def _read_magic(filename):
+    with open(filename, "rb") as fp:
+        return fp.read(_MAGIC_SIZE)
+
+def _detect_compression(magic):
+    if magic.startswith(_GZIP_MAGIC):
+        return 'zlib'
+    elif magic.startswith(_XZ_MAGIC):
+        return 'lzma'
+    else:
+        return None
+
+def _dump_header(snapshot, fp):
+    metrics = [(metric.name, metric.value, metric.format)
+               for metric in snapshot.metrics.values()]
+    header = {
+        'timestamp': snapshot.timestamp,
+        'traceback_limit': snapshot.traceback_limit,
+        'stats': snapshot.stats,
+        'metrics': metrics,
+    }
+    pickle.dump(header, fp, pickle.HIGHEST_PROTOCOL)
+
+def _create_snapshot(header, traces):
+    snapshot = tracemalloc.Snapshot(header['timestamp'],
+                                    header['traceback_limit'],
+                                    header['stats'], traces)
+    for name, value, format in header['metrics']:
+        snapshot.add_metric(name, value, format)
+    return snapshot
+
+def _align(offset, size=8):
+    return (offset + size - 1) // size * size
+
+def _dump_columnar(snapshot, filename):
+    if snapshot.traces is not None:
+        # traces are sorted by address to lookup an address using a
+        # binary search
+        addresses = array.array(_ADDRESS_TYPECODE, sorted(snapshot.traces))
+        sizes = array.array(_SIZE_TYPECODE)
+        traceback_ids = array.array(_TRACEBACK_ID_TYPECODE)
+        table = TracebackTable()
+        traces = snapshot.traces
+        for address in addresses:
+            size, traceback = traces[address]
+            sizes.append(size)
+            traceback_ids.append(table.add(traceback))
+        # frames are shared by tracebacks: pickle only stores them once
+        tracebacks = pickle.dumps(table.tracebacks, pickle.HIGHEST_PROTOCOL)
+        del table
+
+        columns = (addresses.tobytes(), sizes.tobytes(),
+                   traceback_ids.tobytes(), tracebacks)
+        ntraces = len(addresses)
+    else:
+        columns = ()
+        ntraces = None
+
+    offsets = []
+    offset = 0
+    for column in columns:
+        offset = _align(offset)
+        offsets.append((offset, len(column)))
+        offset += len(column)
+
+    metrics = [(metric.name, metric.value, metric.format)
+               for metric in snapshot.metrics.values()]
+    header = {
+        'timestamp': snapshot.timestamp,
+        'traceback_limit': snapshot.traceback_limit,
+        'stats': snapshot.stats,
+        'metrics': metrics,
+        'byteorder': sys.byteorder,
+        'ntraces': ntraces,
+        'columns': offsets,
+    }
+    header = pickle.dumps(header, pickle.HIGHEST_PROTOCOL)
+
+    with open(filename, "wb") as fp:
+        fp.write(_COLUMNAR_MAGIC)
+        fp.write(struct.pack("<Q", len(header)))
+        fp.write(header)
+        data_start = _align(fp.tell())
+        for column, column_offset in zip(columns, offsets):
+            fp.write(b'\0' * (data_start + column_offset[0] - fp.tell()))
+            fp.write(column)
+
+def _compute_delta(traces, base_traces):
+    new = {}
+    resized = {}
+    for address, trace in traces.items():
+        base_trace = base_traces.get(address)
+        if base_trace is None:
+            new[address] = trace
+        elif base_trace != trace:
+            if base_trace[1] == trace[1]:
+                resized[address] = trace[0]
+            else:
+                new[address] = trace
+    freed = [address for address in base_traces if address not in traces]
+    return {'new': new, 'resized': resized, 'freed': freed}
+
+def _apply_delta(traces, delta):
+    for address in delta['freed']:
+        del traces[address]
+    for address, size in delta['resized'].items():
+        traces[address] = (size, traces[address][1])
+    traces.update(delta['new'])
+
+def _dump_delta(snapshot, fp, filename, base):
+    base_filename, base_traces = base
+    directory = os.path.dirname(filename) or os.curdir
+    fp.write(_DELTA_MAGIC)
+    pickle.dump(os.path.relpath(base_filename, directory), fp,
+                pickle.HIGHEST_PROTOCOL)
+    _dump_header(snapshot, fp)
+    delta = _compute_delta(snapshot.traces, base_traces)
+    pickle.dump(delta, fp, pickle.HIGHEST_PROTOCOL)
+
+def dump_snapshot(snapshot, filename, compression=None, format='pickle',
+                  base=None):
+    if base is not None:
+        if snapshot.traces is None:
+            raise ValueError("a delta snapshot requires traces")
+        if compression is not None:
+            fp = _open_compressed(filename, "wb", compression)
+        else:
+            fp = open(filename, "wb")
+        with fp:
+            _dump_delta(snapshot, fp, filename, base)
+        return
+
+    if format == 'columnar':
+        if compression is not None:
+            raise ValueError("the columnar format does not support "
+                             "compression")
+        _dump_columnar(snapshot, filename)
+        return
+    elif format != 'pickle':
+        raise ValueError("unknown format: %r" % (format,))
+
+    if compression is None:
+        snapshot.dump(filename)
+        return
+
+    with _open_compressed(filename, "wb", compression) as fp:
+        fp.write(_PICKLE_MAGIC)
+        _dump_header(snapshot, fp)
+        # traces are written separately to be able to load a snapshot
+        # without its traces
+        pickle.dump(snapshot.traces, fp, pickle.HIGHEST_PROTOCOL)
+
+def _load_delta(fp, filename, traces, cache):
+    base = pickle.load(fp)
+    header = pickle.load(fp)
+    if not traces:
+        return _create_snapshot(header, None)
+
+    base = os.path.join(os.path.dirname(filename), base)
+    key = os.path.abspath(base)
+    if cache is not None and key in cache:
+        snapshot_traces = dict(cache[key])
+    else:
+        snapshot_traces = load_snapshot(base, True, cache).traces
+        snapshot_traces = dict(snapshot_traces.items())
+    delta = pickle.load(fp)
+    _apply_delta(snapshot_traces, delta)
+    if cache is not None:
+        cache[os.path.abspath(filename)] = snapshot_traces
+        snapshot_traces = dict(snapshot_traces)
+    return _create_snapshot(header, snapshot_traces)
+
+def load_snapshot(filename, traces=True, cache=None):
+    magic = _read_magic(filename)
+    if magic == _COLUMNAR_MAGIC:
+        return ColumnarSnapshot(filename, traces)
+
+    compression = _detect_compression(magic)
+    if compression is not None:
+        fp = _open_compressed(filename, "rb", compression)
+    elif magic == _DELTA_MAGIC:
+        fp = open(filename, "rb")
+    else:
+        return tracemalloc.Snapshot.load(filename, traces)
+
+    with fp:
+        magic = fp.read(_MAGIC_SIZE)
+        if magic == _DELTA_MAGIC:
+            return _load_delta(fp, filename, traces, cache)
+        if magic != _PICKLE_MAGIC:
+            raise ValueError("unknown snapshot format")
+        header = pickle.load(fp)
+        if traces:
+            snapshot_traces = pickle.load(fp)
+        else:
+            snapshot_traces = None
+    return _create_snapshot(header, snapshot_traces)
+
+
+class _ColumnarTraces(collections.abc.Mapping):
+    # Read-only mapping address => (size, traceback) reading columns of a
+    # memory mapped file: only touched pages are read from the disk
+    def __init__(self, data, byteorder, ntraces, columns):
+        def column(index, typecode):
+            offset, length = columns[index]
+            view = data[offset:offset + length].cast(typecode)
+            if byteorder != sys.byteorder:
+                # the file was written on a platform with a different byte
+                # order: load and convert the whole column
+                values = array.array(typecode, view)
+                values.byteswap()
+                view = memoryview(values)
+            return view
+
+        self._ntraces = ntraces
+        self.addresses = column(0, _ADDRESS_TYPECODE)
+        self.sizes = column(1, _SIZE_TYPECODE)
+        self.traceback_ids = column(2, _TRACEBACK_ID_TYPECODE)
+        offset, length = columns[3]
+        self._tracebacks_data = data[offset:offset + length]
+        self._tracebacks = None
+
+    def get_tracebacks(self):
+        if self._tracebacks is None:
+            self._tracebacks = pickle.loads(self._tracebacks_data)
+        return self._tracebacks
+
+    def __len__(self):
+        return self._ntraces
+
+    def __iter__(self):
+        return iter(self.addresses)
+
+    def _lookup(self, address):
+        index = bisect.bisect_left(self.addresses, address)
+        if index == self._ntraces or self.addresses[index] != address:
+            raise KeyError(address)
+        return index
+
+    def __contains__(self, address):
+        try:
+            self._lookup(address)
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def __getitem__(self, address):
+        index = self._lookup(address)
+        traceback = self.get_tracebacks()[self.traceback_ids[index]]
+        return (self.sizes[index], traceback)
+
+    def items(self):
+        tracebacks = self.get_tracebacks()
+        for address, size, traceback_id in zip(self.addresses, self.sizes,
+                                               self.traceback_ids):
+            yield (address, (size, tracebacks[traceback_id]))
+
+
+class ColumnarSnapshot:
+    def __init__(self, filename, traces=True):
+        with open(filename, "rb") as fp:
+            if fp.read(len(_COLUMNAR_MAGIC)) != _COLUMNAR_MAGIC:
+                raise ValueError("not a columnar snapshot file")
+            header_size = struct.unpack("<Q", fp.read(8))[0]
+            header = pickle.loads(fp.read(header_size))
+            data_start = _align(fp.tell())
+            if traces and header['ntraces'] is not None:
+                self._mmap = mmap.mmap(fp.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            else:
+                self._mmap = None
+
+        self._snapshot = _create_snapshot(header, None)
+        if self._mmap is not None:
+            data = memoryview(self._mmap)[data_start:]
+            self._traces = _ColumnarTraces(data, header['byteorder'],
+                                           header['ntraces'],
+                                           header['columns'])
+        else:
+            self._traces = None
+
+    def __getattr__(self, name):
+        return getattr(self._snapshot, name)
+
+    def _get_traces(self):
+        if self._snapshot.traces is not None:
+            return self._snapshot.traces
+        return self._traces
+    traces = property(_get_traces)
+
+    def load_traces(self):
+        # Load all traces into a dict
+        if self._snapshot.traces is None and self._traces is not None:
+            self._snapshot.traces = dict(self._traces.items())
+        return self._snapshot.traces
+
+    def apply_filters(self, filters):
+        apply_filters(self, filters)
+
+    def top_by(self, group_by, cumulative=False):
+        if (group_by == 'address'
+        and self._snapshot.traces is None
+        and self._traces is not None):
+            # only read addresses and sizes, not tracebacks
+            stats = {}
+            for address, size in zip(self._traces.addresses,
+                                     self._traces.sizes):
+                stats[address] = (size, 1)
+            return tracemalloc.GroupedStats(self.timestamp, stats, group_by,
+                                            cumulative, self.metrics)
+
+        if group_by != 'line' and group_by != 'filename' or cumulative:
+            self.load_traces()
+        return self._snapshot.top_by(group_by, cumulative)
+
+
+def _stats_diff_sort_key(diff):
+    return (abs(diff[0]), diff[1], abs(diff[2]), diff[3])
+
+def _iter_stats_diff(top_stats, previous_top_stats):
+    # Generate the same differences than GroupedStats.compare_to(), but
+    # unsorted
+    if previous_top_stats is None:
+        for key, stats in top_stats.stats.items():
+            yield (0, stats[0], 0, stats[1], key)
+        return
+
+    previous_stats = previous_top_stats.stats
+    for key, stats in top_stats.stats.items():
+        previous = previous_stats.get(key)
+        if previous is not None:
+            yield (stats[0] - previous[0], stats[0],
+                   stats[1] - previous[1], stats[1],
+                   key)
+        else:
+            yield (stats[0], stats[0], stats[1], stats[1], key)
+    stats = top_stats.stats
+    for key, previous in previous_stats.items():
+        if key not in stats:
+            yield (-previous[0], 0, -previous[1], 0, key)
+
+def _top_stats_diff(top_stats, previous_top_stats, count):
+    # Select the count biggest differences using a heap and compute the
+    # total in a single pass: O(n log count) instead of sorting all
+    # differences. Return (diff_list, ndiff, total).
+    heap = []
+    total = [0, 0, 0, 0]
+    ndiff = 0
+    for diff in _iter_stats_diff(top_stats, previous_top_stats):
+        total[0] += diff[0]
+        total[1] += diff[1]
+        total[2] += diff[2]
+        total[3] += diff[3]
+        if count:
+            # on equal keys, the first difference wins (stable sort)
+            item = (_stats_diff_sort_key(diff), -ndiff, diff)
+            if len(heap) < count:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+        ndiff += 1
+    heap.sort(reverse=True)
+    diff_list = [item[2] for item in heap]
+    return diff_list, ndiff, total
+
+KeyTrend = collections.namedtuple('KeyTrend',
+    'key size count slope r2 monotonicity score')
+
+
+class _KeyTrendSums:
+    __slots__ = ('sum_y', 'sum_ty', 'sum_yy', 'last_index', 'size', 'count',
+                 'increase', 'decrease')
+
+    def __init__(self):
+        self.sum_y = 0.0
+        self.sum_ty = 0.0
+        self.sum_yy = 0.0
+        self.last_index = -1
+        self.size = 0
+        self.count = 0
+        self.increase = 0
+        self.decrease = 0
+
+    def add_size(self, size, index):
+        if index == 0:
+            self.size = size
+        else:
+            if self.last_index < index - 1:
+                # the key was missing (size 0) in the previous top stats
+                self._add_step(0)
+            self._add_step(size)
+        self.last_index = index
+
+    def _add_step(self, size):
+        if size > self.size:
+            self.increase += 1
+        elif size < self.size:
+            self.decrease += 1
+        self.size = size
+
+
+class TrendAnalysis:
+    def __init__(self):
+        self.group_by = None
+        self.cumulative = None
+        self.nsnapshot = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self._sum_t = 0.0
+        self._sum_tt = 0.0
+        # key => _KeyTrendSums
+        self._sums = {}
+
+    def add(self, top_stats):
+        if self.nsnapshot:
+            if top_stats.timestamp < self.last_timestamp:
+                raise ValueError("top stats must be added in chronological "
+                                 "order")
+            if (top_stats.group_by != self.group_by
+            or top_stats.cumulative != self.cumulative):
+                raise ValueError("top stats must be grouped the same way")
+        else:
+            self.group_by = top_stats.group_by
+            self.cumulative = top_stats.cumulative
+            self.first_timestamp = top_stats.timestamp
+        self.last_timestamp = top_stats.timestamp
+        index = self.nsnapshot
+        self.nsnapshot += 1
+
+        # time in seconds since the first top stats
+        t = (top_stats.timestamp - self.first_timestamp).total_seconds()
+        self._sum_t += t
+        self._sum_tt += t * t
+
+        sums = self._sums
+        for key, stats in top_stats.stats.items():
+            size, count = stats
+            try:
+                key_sums = sums[key]
+            except KeyError:
+                key_sums = sums[key] = _KeyTrendSums()
+            key_sums.sum_y += size
+            key_sums.sum_ty += t * size
+            key_sums.sum_yy += size * size
+            key_sums.add_size(size, index)
+            key_sums.count = count
+
+    def get_trend(self, key):
+        key_sums = self._sums[key]
+        n = self.nsnapshot
+        size = key_sums.size
+        count = key_sums.count
+        increase = key_sums.increase
+        decrease = key_sums.decrease
+        if key_sums.last_index != n - 1:
+            # the key is missing in the last top stats
+            size = 0
+            count = 0
+            if key_sums.size:
+                decrease += 1
+
+        # least squares linear regression: size = slope * t + intercept
+        var_t = n * self._sum_tt - self._sum_t ** 2
+        var_y = n * key_sums.sum_yy - key_sums.sum_y ** 2
+        cov = n * key_sums.sum_ty - self._sum_t * key_sums.sum_y
+        if var_t > 0:
+            slope = cov / var_t
+        else:
+            slope = 0.0
+        if var_t > 0 and var_y > 0:
+            r2 = min(cov * cov / (var_t * var_y), 1.0)
+        else:
+            r2 = 0.0
+        # ratio of increasing steps minus ratio of decreasing steps
+        if n > 1:
+            monotonicity = (increase - decrease) / (n - 1)
+        else:
+            monotonicity = 0.0
+
+        # confidence of a steady growth
+        if slope > 0 and monotonicity > 0:
+            score = r2 * monotonicity
+        else:
+            score = 0.0
+        return KeyTrend(key, size, count, slope, r2, monotonicity, score)
+
+    def get_trends(self):
+        trends = [self.get_trend(key) for key in self._sums]
+        trends.sort(key=lambda key_trend: (key_trend.score, key_trend.slope),
+                    reverse=True)
+        return trends
+
+
+class StatsMatrix:
+    def __init__(self, count=10, candidates=None):
+        if candidates is None:
+            candidates = count * 3
+        elif candidates < 0:
+            raise ValueError("candidates must be positive or zero")
+        self.count = count
+        self.candidates = candidates
+        self.group_by = None
+        self.cumulative = None
+        self.timestamps = []
+        # key => list of (size, count) per column, None if the key was not
+        # tracked yet
+        self._rows = {}
+        # cells of keys just below the top of the last column: they become
+        # the previous cells of the row if the key enters the top later
+        self._candidates = {}
+        # next column filled by fill()
+        self._fill_column = 0
+
+    def add(self, top_stats):
+        if self.timestamps:
+            if top_stats.timestamp < self.timestamps[-1]:
+                raise ValueError("top stats must be added in chronological "
+                                 "order")
+            if (top_stats.group_by != self.group_by
+            or top_stats.cumulative != self.cumulative):
+                raise ValueError("top stats must be grouped the same way")
+        else:
+            self.group_by = top_stats.group_by
+            self.cumulative = top_stats.cumulative
+        column = len(self.timestamps)
+        self.timestamps.append(top_stats.timestamp)
+
+        stats = top_stats.stats
+        rows = self._rows
+        # only track keys which are in the top of at least one column
+        top = heapq.nlargest(self.count + self.candidates, stats.items(),
+                             key=lambda item: item[1][0])
+        candidates = self._candidates
+        for key, key_stats in top[:self.count]:
+            if key not in rows:
+                cells = candidates.pop(key, None)
+                if cells is None:
+                    cells = [None] * column
+                rows[key] = cells
+        # the memory is bounded: only keep candidates of the last column
+        old_candidates = candidates
+        candidates = {}
+        for key, key_stats in top[self.count:]:
+            if key in rows:
+                continue
+            cells = old_candidates.get(key)
+            if cells is None:
+                cells = [None] * column
+            candidates[key] = cells
+        self._candidates = candidates
+        del old_candidates
+        for cells_dict in (rows, candidates):
+            for key, cells in cells_dict.items():
+                cells.append(stats.get(key, (0, 0)))
+
+    def is_complete(self):
+        # unknown cells are the first cells of a row
+        return all(cells[0] is not None for cells in self._rows.values())
+
+    def fill(self, top_stats):
+        # Second pass: fill the unknown cells of the next column. Rows are
+        # only chosen by add() (first pass).
+        column = self._fill_column
+        if (column >= len(self.timestamps)
+        or top_stats.timestamp != self.timestamps[column]):
+            raise ValueError("top stats must be filled in the order "
+                             "they were added")
+        self._fill_column += 1
+        stats = top_stats.stats
+        for key, cells in self._rows.items():
+            if cells[column] is None:
+                cells[column] = stats.get(key, (0, 0))
+
+    def get_rows(self):
+        # Get the list of (key, cells) sorted by the biggest size
+        def sort_key(row):
+            return max(cell[0] for cell in row[1] if cell is not None)
+        rows = list(self._rows.items())
+        rows.sort(key=sort_key, reverse=True)
+        return rows
+
+    def write_csv(self, file):
+        import csv
+        writer = csv.writer(file)
+        header = ['key']
+        for timestamp in self.timestamps:
+            timestamp = _format_timestamp(timestamp)
+            header.append('%s size' % timestamp)
+            header.append('%s count' % timestamp)
+        writer.writerow(header)
+        for key, cells in self.get_rows():
+            if self.group_by == 'line':
+                filename, lineno = key
+                key = '%s:%s' % (filename or '???', _format_lineno(lineno))
+            elif self.group_by == 'address':
+                key = '0x%x' % key
+            elif self.group_by == 'traceback':
+                key = '0x%x' % key[0]
+            row = [key]
+            for cell in cells:
+                if cell is not None:
+                    row.extend(cell)
+                else:
+                    row.extend(('', ''))
+            writer.writerow(row)
+
+
+# Name of the metric of the PID of the process which took the snapshot
+_PID_METRIC = 'process.pid'
+
+FleetOutlier = collections.namedtuple('FleetOutlier',
+    'key worker size mean zscore')
+
+
+def _zscore(value, total, total_squares, n):
+    # Compare value to the mean and the standard deviation of the n - 1
+    # other values (leave-one-out): including the value itself, the z-score
+    # could never be greater than sqrt(n - 1). Return (mean, zscore).
+    n -= 1
+    if n < 1:
+        return (value, 0.0)
+    total -= value
+    total_squares -= float(value) * value
+    mean = total / n
+    variance = total_squares / n - mean * mean
+    if variance <= 0:
+        # all other values are equal
+        if value > mean:
+            return (mean, float('inf'))
+        else:
+            return (mean, 0.0)
+    return (mean, (value - mean) / variance ** 0.5)
+
+
+class _FleetKeyStats:
+    __slots__ = ('size', 'count', 'size_squares', 'max_size', 'max_worker')
+
+    def __init__(self):
+        self.size = 0
+        self.count = 0
+        self.size_squares = 0.0
+        self.max_size = 0
+        self.max_worker = None
+
+
+class FleetWindow:
+    def __init__(self, timestamp, group_by, cumulative):
+        self.timestamp = timestamp
+        self.group_by = group_by
+        self.cumulative = cumulative
+        # worker => (size, count)
+        self.workers = {}
+        # key => _FleetKeyStats
+        self._stats = {}
+        # name => [value, format]
+        self._metrics = {}
+
+    def add(self, top_stats, worker):
+        if worker in self.workers:
+            return False
+        if top_stats.timestamp < self.timestamp:
+            self.timestamp = top_stats.timestamp
+
+        total_size = 0
+        total_count = 0
+        stats = self._stats
+        for key, key_stats in top_stats.stats.items():
+            size, count = key_stats
+            try:
+                fleet_stats = stats[key]
+            except KeyError:
+                fleet_stats = stats[key] = _FleetKeyStats()
+            fleet_stats.size += size
+            fleet_stats.count += count
+            fleet_stats.size_squares += size * size
+            if fleet_stats.max_worker is None or size > fleet_stats.max_size:
+                fleet_stats.max_size = size
+                fleet_stats.max_worker = worker
+            total_size += size
+            total_count += count
+        self.workers[worker] = (total_size, total_count)
+
+        if top_stats.metrics:
+            for metric in top_stats.metrics.values():
+                if (metric.format not in ('size', 'int')
+                or metric.name == _PID_METRIC):
+                    continue
+                try:
+                    self._metrics[metric.name][0] += metric.value
+                except KeyError:
+                    self._metrics[metric.name] = [metric.value, metric.format]
+        return True
+
+    def get_top_stats(self):
+        stats = dict((key, (fleet_stats.size, fleet_stats.count))
+                     for key, fleet_stats in self._stats.items())
+        metrics = {}
+        for name, (value, format) in self._metrics.items():
+            metrics[name] = tracemalloc.Metric(name, value, format)
+        name = 'fleet.workers'
+        metrics[name] = tracemalloc.Metric(name, len(self.workers), 'int')
+        return tracemalloc.GroupedStats(self.timestamp, stats,
+                                        self.group_by, self.cumulative,
+                                        metrics)
+
+    def get_outliers(self, threshold=3.0):
+        # Get keys where a worker allocated much more memory than the other
+        # workers. Workers which don't have the key count as zero.
+        nworker = len(self.workers)
+        outliers = []
+        for key, fleet_stats in self._stats.items():
+            mean, zscore = _zscore(fleet_stats.max_size, fleet_stats.size,
+                                   fleet_stats.size_squares, nworker)
+            if zscore >= threshold:
+                outliers.append(FleetOutlier(key, fleet_stats.max_worker,
+                                             fleet_stats.max_size, mean,
+                                             zscore))
+        outliers.sort(key=lambda outlier: outlier.size - outlier.mean,
+                      reverse=True)
+        return outliers
+
+    def get_worker_outliers(self, threshold=3.0):
+        # Get workers using much more memory than the other workers
+        nworker = len(self.workers)
+        total = sum(size for size, count in self.workers.values())
+        total_squares = sum(float(size) * size
+                            for size, count in self.workers.values())
+        outliers = []
+        for worker, worker_stats in self.workers.items():
+            size = worker_stats[0]
+            mean, zscore = _zscore(size, total, total_squares, nworker)
+            if zscore >= threshold:
+                outliers.append(FleetOutlier(None, worker, size, mean, zscore))
+        outliers.sort(key=lambda outlier: outlier.size, reverse=True)
+        return outliers
+
+
+class FleetAggregation:
+    def __init__(self, window=60.0):
+        if window <= 0:
+            raise ValueError("window must be greater than zero")
+        self.window = window
+        self.group_by = None
+        self.cumulative = None
+        # number of ignored top stats: same worker in the same window
+        self.ignored = 0
+        # number of windows
+        self.nwindow = 0
+        # open FleetWindow, or None: closed windows are not kept
+        self._window = None
+        self._last_timestamp = None
+
+    def add(self, top_stats, worker):
+        if self.group_by is None:
+            self.group_by = top_stats.group_by
+            self.cumulative = top_stats.cumulative
+        elif (top_stats.group_by != self.group_by
+        or top_stats.cumulative != self.cumulative):
+            raise ValueError("top stats must be grouped the same way")
+
+        timestamp = top_stats.timestamp
+        if (self._last_timestamp is not None
+        and timestamp < self._last_timestamp):
+            raise ValueError("top stats must be added in chronological "
+                             "order")
+        self._last_timestamp = timestamp
+
+        # a window starts at the first top stats taken more than window
+        # seconds after the start of the previous window: snapshots taken
+        # close together are not split by a fixed boundary
+        closed = None
+        window = self._window
+        if (window is None
+        or (timestamp - window.timestamp).total_seconds() > self.window):
+            closed = window
+            window = FleetWindow(timestamp, self.group_by, self.cumulative)
+            self._window = window
+            self.nwindow += 1
+        if not window.add(top_stats, worker):
+            self.ignored += 1
+        # return the window closed by top_stats
+        return closed
+
+    def flush(self):
+        # Close the open window and return it
+        window = self._window
+        self._window = None
+        return window
+
 
 class DisplayTop:
     def __init__(self):
@@ -183,6 +2132,15 @@ class DisplayTop:
         self.color = None
         self.compare_to_previous = True
         self.previous_top_stats = None
+        # table of the last snapshot, its tracebacks are shared with the
+        # next snapshot
+        self.traceback_table = TracebackTable()
+        # MetricsHistory instance, or None
+        self.history = None
+        self.history_window = None
+        # number of traces kept by sample_traces(), or None to keep all
+        # traces
+        self.sample_size = None
 
     def _format_diff(self, diff, show_diff, show_count, color):
         if not show_count and not self.average:
@@ -231,6 +2189,11 @@ class DisplayTop:
                 return "%+.1f%%" % (value * 100)
             else:
                 return "%.1f%%" % (value * 100)
+        elif format == 'seconds':
+            if sign:
+                return "%+.3f sec" % value
+            else:
+                return "%.3f sec" % value
         else:
             if sign:
                 return "%+i" % value
@@ -281,11 +2244,178 @@ class DisplayTop:
                 if color:
                     diff = _FORMAT_YELLOW % diff
                 text = '%s (%s)' % (text, diff)
+            if self.history is not None:
+                text += self._format_history(name, color)
             log("%s: %s\n" % (name, text))
 
+    def _format_history(self, name, color):
+        history = self.history
+        try:
+            values = history.get_values(name, self.history_window)
+        except KeyError:
+            return ''
+        if len(values) < 2:
+            return ''
+        format = history.get_format(name)
+        low = min(value for timestamp, value in values)
+        high = max(value for timestamp, value in values)
+        sparkline = _format_sparkline([value
+                                       for timestamp, value in values[-20:]])
+        if color:
+            sparkline = _FORMAT_CYAN % sparkline
+        return ' %s min=%s, max=%s' % (sparkline,
+                                       self._format_metric(low, format),
+                                       self._format_metric(high, format))
+
+    def _get_format_key(self, group_by):
+        if group_by == 'filename':
+            return (self._format_filename, "filename")
+        elif group_by == 'address':
+            return (self._format_address, "address")
+        elif group_by == 'traceback':
+            return (self._format_traceback, "traceback")
+        else:
+            return (self._format_filename_lineno, "filename and line number")
+
+    def display_outliers(self, window, count=10, threshold=3.0, file=None):
+        if file is None:
+            file = sys.stdout
+        log = file.write
+        if self.color is None:
+            color = file.isatty()
+        else:
+            color = self.color
+        format_key, per_text = self._get_format_key(window.group_by)
+        outliers = window.get_worker_outliers(threshold)
+        outliers.extend(window.get_outliers(threshold)[:count])
+
+        text = ("%s outliers in %s workers"
+                % (len(outliers), len(window.workers)))
+        if color:
+            text = _FORMAT_CYAN % text
+        name = _format_timestamp(window.timestamp)
+        if color:
+            name = _FORMAT_BOLD % name
+        log("%s: %s\n" % (name, text))
+        for index, outlier in enumerate(outliers):
+            if outlier.key is not None:
+                key_text = "%s: " % format_key(outlier.key, color)
+            else:
+                key_text = "total: "
+            log("#%s: %sworker %s: size=%s (other workers: %s, z=%.1f)\n"
+                % (1 + index, key_text, outlier.worker,
+                   _format_size_color(outlier.size, color),
+                   _format_size(outlier.mean), outlier.zscore))
+        log("\n")
+        file.flush()
+
+    def display_trend(self, trend, count=10, file=None):
+        trends = [key_trend for key_trend in trend.get_trends()
+                  if key_trend.score > 0]
+        if file is None:
+            file = sys.stdout
+        log = file.write
+        if self.color is None:
+            color = file.isatty()
+        else:
+            color = self.color
+        format_key, per_text = self._get_format_key(trend.group_by)
+
+        nother = max(len(trends) - count, 0)
+        count = min(count, len(trends))
+        text = ("Top %s growing allocations per %s (%s snapshots)"
+                % (count, per_text, trend.nsnapshot))
+        if color:
+            text = _FORMAT_CYAN % text
+        name = "%s - %s" % (_format_timestamp(trend.first_timestamp),
+                            _format_timestamp(trend.last_timestamp))
+        if color:
+            name = _FORMAT_BOLD % name
+        log("%s: %s\n" % (name, text))
+
+        for index, key_trend in enumerate(trends[:count]):
+            key_text = format_key(key_trend.key, color)
+            parts = []
+            if self.size:
+                parts.append("size=%s"
+                             % _format_size_color(key_trend.size, color))
+            if self.count and trend.group_by != 'address':
+                parts.append("count=%s" % key_trend.count)
+            slope = _format_size(key_trend.slope * 3600, sign=True)
+            if color:
+                slope = _FORMAT_YELLOW % slope
+            parts.append("slope=%s/hour" % slope)
+            parts.append("r2=%.2f" % key_trend.r2)
+            parts.append("monotonic=%.0f%%" % (key_trend.monotonicity * 100))
+            log("#%s: %s: %s\n" % (1 + index, key_text, ', '.join(parts)))
+
+        if nother > 0:
+            text = "%s more growing" % nother
+            if color:
+                text = _FORMAT_CYAN % text
+            log("%s\n" % text)
+        log("\n")
+        file.flush()
+
+    def display_matrix(self, matrix, file=None):
+        if file is None:
+            file = sys.stdout
+        log = file.write
+        if self.color is None:
+            color = file.isatty()
+        else:
+            color = self.color
+        format_key, per_text = self._get_format_key(matrix.group_by)
+        rows = matrix.get_rows()
+
+        if matrix.cumulative:
+            text = "Cumulative top %s allocations per %s" % (len(rows), per_text)
+        else:
+            text = "Top %s allocations per %s" % (len(rows), per_text)
+        text += " (%s snapshots)" % len(matrix.timestamps)
+        if color:
+            text = _FORMAT_CYAN % text
+        log("%s\n" % text)
+
+        show_count = (self.count and matrix.group_by != 'address')
+        table = []
+        for key, cells in rows:
+            texts = []
+            for cell in cells:
+                if cell is None:
+                    # the key was not tracked yet
+                    texts.append('-')
+                    continue
+                text = _format_size(cell[0])
+                if show_count:
+                    text += ' (%s)' % cell[1]
+                texts.append(text)
+            table.append(texts)
+        headers = [_format_timestamp(timestamp)
+                   for timestamp in matrix.timestamps]
+        widths = [max([len(header)] + [len(texts[column]) for texts in table])
+                  for column, header in enumerate(headers)]
+
+        log("%s\n" % '  '.join(header.rjust(width)
+                               for header, width in zip(headers, widths)))
+        for row, texts in zip(rows, table):
+            line = '  '.join(text.rjust(width)
+                             for text, width in zip(texts, widths))
+            log("%s  %s\n" % (line, format_key(row[0], color)))
+        log("\n")
+        file.flush()
+
     def display_top_stats(self, top_stats, count=10, file=None):
         previous_top_stats = self.previous_top_stats
-        diff_list = top_stats.compare_to(previous_top_stats)
+        if count is not None:
+            diff_list, ndiff, total = _top_stats_diff(top_stats,
+                                                      previous_top_stats,
+                                                      count)
+        else:
+            diff_list = top_stats.compare_to(previous_top_stats)
+            ndiff = len(diff_list)
+            count = ndiff
+            total = None
 
         if file is None:
             file = sys.stdout
@@ -300,22 +2430,11 @@ class DisplayTop:
         else:
             show_count = self.count
 
-        if top_stats.group_by == 'filename':
-            format_key = self._format_filename
-            per_text = "filename"
-        elif top_stats.group_by == 'address':
-            format_key = self._format_address
-            per_text = "address"
-        elif top_stats.group_by == 'traceback':
-            format_key = self._format_traceback
-            per_text = "traceback"
-        else:
-            format_key = self._format_filename_lineno
-            per_text = "filename and line number"
+        format_key, per_text = self._get_format_key(top_stats.group_by)
 
         # Write the header
-        nother = max(len(diff_list) - count, 0)
-        count = min(count, len(diff_list))
+        nother = max(ndiff - count, 0)
+        count = min(count, ndiff)
         if top_stats.cumulative:
             text = "Cumulative top %s allocations per %s" % (count, per_text)
         else:
@@ -324,36 +2443,45 @@ class DisplayTop:
             text = _FORMAT_CYAN % text
         if previous_top_stats is not None:
             text += ' (compared to %s)' % _format_timestamp(previous_top_stats.timestamp)
+        errors = getattr(top_stats, 'errors', None)
+        if errors is not None:
+            text += (' (estimated from %s of %s traces)'
+                     % (top_stats.nsample, top_stats.ntrace))
         name = _format_timestamp(top_stats.timestamp)
         if color:
             name = _FORMAT_BOLD % name
         file.write("%s: %s\n" % (name, text))
 
         # Display items
-        total = [0, 0, 0, 0]
+        top_total = [0, 0, 0, 0]
         for index in range(0, count):
             diff = diff_list[index]
             key = diff[4]
             key_text = format_key(key, color)
             diff_text = self._format_diff(diff, has_previous, show_count, color)
+            if errors is not None and errors.get(key):
+                # two standard errors: 95% confidence interval
+                diff_text += ", error=+/-%s" % _format_size(2 * errors[key])
             log("#%s: %s: %s\n" % (1 + index, key_text, diff_text))
             if top_stats.group_by == 'traceback':
                 for line in _format_traceback(key[1], self.filename_parts, color):
                     log(line + "\n")
                 log("\n")
 
-            total[0] += diff[0]
-            total[1] += diff[1]
-            total[2] += diff[2]
-            total[3] += diff[3]
-
-        other = tuple(total)
-        for index in range(count, len(diff_list)):
-            diff = diff_list[index]
-            total[0] += diff[0]
-            total[1] += diff[1]
-            total[2] += diff[2]
-            total[3] += diff[3]
+            top_total[0] += diff[0]
+            top_total[1] += diff[1]
+            top_total[2] += diff[2]
+            top_total[3] += diff[3]
+
+        other = tuple(top_total)
+        if total is None:
+            total = top_total
+            for index in range(count, len(diff_list)):
+                diff = diff_list[index]
+                total[0] += diff[0]
+                total[1] += diff[1]
+                total[2] += diff[2]
+                total[3] += diff[3]
 
         # Display "xxx more"
         if nother > 0:
@@ -389,7 +2517,7 @@ class DisplayTop:
 
     def display_snapshot(self, snapshot, count=10, group_by="line",
                          cumulative=False, file=None):
-        top_stats = snapshot.top_by(group_by, cumulative)
+        top_stats = top_by(snapshot, group_by, cumulative)
         self.display_top_stats(top_stats, count=count, file=file)
 
     def display(self, count=10, group_by="line", cumulative=False, file=None,
@@ -401,10 +2529,18 @@ class DisplayTop:
         else:
             traces = False
         snapshot = tracemalloc.Snapshot.create(traces=traces)
+        if self.sample_size is not None and snapshot.traces is not None:
+            sample_traces(snapshot, self.sample_size)
+        # only reuse tracebacks of the previous snapshot: tracebacks of
+        # older snapshots are not kept alive
+        self.traceback_table = TracebackTable(self.traceback_table)
+        intern_tracebacks(snapshot, self.traceback_table)
         if self.metrics:
             add_metrics(snapshot)
         if callback is not None:
             callback(snapshot)
+        if self.history is not None:
+            self.history.add_snapshot(snapshot)
 
         self.display_snapshot(snapshot,
                               count=count,
@@ -414,29 +2550,84 @@ class DisplayTop:
         return snapshot
 
 
-class _TaskThread(threading.Thread):
+# Default minimum and maximum delay in seconds between two polls of the
+# traced memory
+_MIN_MEMORY_POLL_DELAY = 0.01
+_MAX_MEMORY_POLL_DELAY = 0.1
+# Number of traced memory samples per growth rate window
+_GROWTH_RATE_SAMPLES = 10
+# Minimum fraction of the window covered by samples to compute the growth
+# rate
+_GROWTH_RATE_COVERAGE = 0.9
+# Weight of the last sample in the estimation of the allocation rate
+_POLL_RATE_ALPHA = 0.3
+# Poll before the threshold can be reached at the estimated rate
+_POLL_SAFETY_FACTOR = 0.5
+
+def _linear_regression(samples):
+    # Compute the slope of the least squares line of (x, y) samples
+    n = len(samples)
+    x0 = samples[0][0]
+    sum_x = sum_y = sum_xx = sum_xy = 0.0
+    for x, y in samples:
+        x -= x0
+        sum_x += x
+        sum_y += y
+        sum_xx += x * x
+        sum_xy += x * y
+    denominator = n * sum_xx - sum_x * sum_x
+    if not denominator:
+        return 0.0
+    return (n * sum_xy - sum_x * sum_y) / denominator
+
+def _block_signals():
+    if hasattr(signal, 'pthread_sigmask'):
+        # this thread should not handle any signal
+        mask = range(1, signal.NSIG)
+        signal.pthread_sigmask(signal.SIG_BLOCK, mask)
+
+class _ScheduledTask:
     def __init__(self, task, ncall):
-        threading.Thread.__init__(self)
-        self.daemon = True
-
-        self.run_lock = threading.Lock()
-        self.stop_lock = threading.Lock()
-        self.sleep_lock = threading.Condition()
-        self._task_ref = weakref.ref(task)
-        self.memory_delay = 0.1
+        self.key = id(task)
+        self.task_ref = weakref.ref(task)
         self.ncall = ncall
+        self.active = True
 
         self.min_memory = None
         self.max_memory = None
         self.timeout = None
-
-    def schedule(self):
-        task = self._task_ref()
+        self.min_delay = None
+        self.max_delay = None
+        self.growth_rate = None
+        self.growth_window = None
+        # samples (time, traced) used to compute the growth rate
+        self.growth_samples = collections.deque()
+        self.peak_margin = None
+        # high-water mark of the traced memory when the task was armed
+        self.peak_memory = None
+
+    def schedule(self, traced, max_traced):
+        task = self.task_ref()
         memory_threshold = task.get_memory_threshold()
         delay = task.get_delay()
+        self.min_delay, self.max_delay = task.get_memory_poll_delay()
+
+        growth = task.get_growth_rate_threshold()
+        if growth is not None:
+            self.growth_rate, self.growth_window = growth
+        else:
+            self.growth_rate = None
+            self.growth_window = None
+        self.growth_samples.clear()
+
+        self.peak_margin = task.get_peak_threshold()
+        if self.peak_margin is not None:
+            if self.peak_memory is None or max_traced > self.peak_memory:
+                self.peak_memory = max_traced
+        else:
+            self.peak_memory = None
 
         if memory_threshold is not None:
-            traced = tracemalloc.get_traced_memory()[0]
             self.min_memory = traced - memory_threshold
             self.max_memory = traced + memory_threshold
         else:
@@ -448,121 +2639,330 @@ class _TaskThread(threading.Thread):
         else:
             self.timeout = None
 
-    def interrupt_sleep(self):
-        with self.sleep_lock:
-            self.sleep_lock.notify()
-
-    def reschedule(self):
-        assert self.is_alive()
-        # FIXME: reschedule using old traced and time, not new
-        self.schedule()
-        self.interrupt_sleep()
+    def is_watcher(self):
+        return (self.min_memory is not None
+                or self.growth_rate is not None
+                or self.peak_margin is not None)
 
-    def once(self):
+    def poll(self, now, traced, max_traced, rate):
+        # Return None if the task must be called, or the delay in seconds
+        # before the next poll
         delay = None
-
         if self.min_memory is not None:
-            traced = tracemalloc.get_traced_memory()[0]
-            if traced <= self.min_memory:
+            if self.memory_triggered(traced):
                 return None
-            if traced >= self.max_memory:
+            delay = self.memory_delay(traced, rate)
+        if self.peak_margin is not None:
+            # use the high-water mark: a peak freed between two polls is
+            # not missed
+            peak = self.peak_memory + self.peak_margin
+            if max_traced >= peak:
                 return None
-            delay = self.memory_delay
-
-        if self.timeout is not None:
-            dt = (self.timeout - _time_monotonic())
-            if dt <= 0:
+            distance = peak - traced
+            peak_delay = self.poll_delay(distance, rate)
+            if delay is not None:
+                delay = min(delay, peak_delay)
+            else:
+                delay = peak_delay
+        if self.growth_rate is not None:
+            if self.growth_triggered(now, traced):
                 return None
+            growth_delay = max(self.growth_window / _GROWTH_RATE_SAMPLES,
+                               self.min_delay)
             if delay is not None:
-                delay = min(delay, dt)
+                delay = min(delay, growth_delay)
             else:
-                delay = dt
-
+                delay = growth_delay
         return delay
 
-    def _run(self):
-        if hasattr(signal, 'pthread_sigmask'):
-            # this thread should not handle any signal
-            mask = range(1, signal.NSIG)
-            signal.pthread_sigmask(signal.SIG_BLOCK, mask)
-
-        self.schedule()
-
-        while self.stop_lock.acquire(0):
-            self.stop_lock.release()
-            delay = self.once()
-            if delay is not None:
-                assert delay > 0.0
-                with self.sleep_lock:
-                    interrupted = self.sleep_lock.wait(timeout=delay)
-                if interrupted:
-                    break
-                continue
-
-            task = self._task_ref()
-            try:
-                task.call()
-            except Exception as err:
-                # the task is not rescheduled on error
-                exc_type, exc_value, exc_tb = sys.exc_info()
-                # FIXME: log the traceback
-                print(("%s: %s" % (exc_type, exc_value)), file=sys.stderr)
-                break
-            if self.ncall is not None:
-                self.ncall -= 1
-                if self.ncall <= 0:
-                    break
-            self.schedule()
+    def growth_triggered(self, now, traced):
+        window = self.growth_window
+        samples = self.growth_samples
+        if (not samples
+        or now - samples[-1][0] >= window / _GROWTH_RATE_SAMPLES):
+            samples.append((now, traced))
+        while samples and samples[0][0] < now - window:
+            samples.popleft()
+        # the growth must be sustained during the whole window
+        if len(samples) < 3:
+            return False
+        if samples[-1][0] - samples[0][0] < window * _GROWTH_RATE_COVERAGE:
+            return False
+        return (_linear_regression(samples) >= self.growth_rate)
 
-    def run(self):
-        with self.run_lock:
-            self._run()
+    def memory_triggered(self, traced):
+        return (traced <= self.min_memory or traced >= self.max_memory)
 
-    def stop(self):
-        if not self.is_alive():
-            return
+    def memory_delay(self, traced, rate):
+        distance = min(traced - self.min_memory, self.max_memory - traced)
+        return self.poll_delay(distance, rate)
 
-        # ask to stop the thread
-        self.stop_lock.acquire()
+    def poll_delay(self, distance, rate):
+        # sleep until the traced memory can move by distance bytes at the
+        # estimated allocation rate (in bytes per second)
+        if rate > 0:
+            delay = distance * _POLL_SAFETY_FACTOR / rate
+        else:
+            delay = self.max_delay
+        return min(max(delay, self.min_delay), self.max_delay)
 
-        # interrupt sleep
-        self.interrupt_sleep()
 
-        # wait until run() exited
-        self.run_lock.acquire()
+# Run all scheduled tasks in a single thread: timers are stored in a heap
+# and the traced memory is polled once for all memory thresholds
+class _Scheduler:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._thread = None
+        # id(task) => _ScheduledTask
+        self._entries = {}
+        # heap of (timeout, sequence number, _ScheduledTask)
+        self._timers = []
+        # _ScheduledTask instances with a memory or growth rate threshold
+        self._watchers = set()
+        self._sequence = 0
+        self._running = None
+        # estimation of the allocation rate, updated at each memory poll
+        self._last_sample = None
+        self._rate = 0.0
+
+    def _get_traced_memory(self):
+        # (traced memory, high-water mark of the traced memory)
+        return tracemalloc.get_traced_memory()
+
+    def _sample_traced(self, now):
+        memory = self._get_traced_memory()
+        traced = memory[0]
+        if self._last_sample is not None:
+            last_time, last_traced = self._last_sample
+            dt = now - last_time
+            if dt > 0:
+                # use the instant rate if memory is suddenly moving faster,
+                # the exponentially weighted moving average otherwise
+                rate = abs(traced - last_traced) / dt
+                alpha = _POLL_RATE_ALPHA
+                self._rate = alpha * rate + (1.0 - alpha) * self._rate
+                self._rate = max(self._rate, rate)
+        self._last_sample = (now, traced)
+        return memory
+
+    def _arm(self, entry, memory=None, jitter=0.0):
+        if memory is None:
+            memory = self._get_traced_memory()
+        entry.schedule(*memory)
+        if entry.timeout is not None:
+            entry.timeout += jitter
+            self._sequence += 1
+            heapq.heappush(self._timers,
+                           (entry.timeout, self._sequence, entry))
+        if entry.is_watcher():
+            self._watchers.add(entry)
+        else:
+            self._watchers.discard(entry)
+
+    def _remove(self, entry):
+        entry.active = False
+        self._watchers.discard(entry)
+        if self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+        # stale timers are skipped when they are popped from the heap
+
+    def _create_thread(self):
+        # Return the new thread which must be started once the lock is
+        # released, or None if the thread is already running
+        if self._thread is not None:
+            self._cond.notify_all()
+            return None
+        thread = threading.Thread(target=self._run, name="tracemalloctext")
+        thread.daemon = True
+        self._thread = thread
+        return thread
+
+    def add(self, task, ncall):
+        entry = _ScheduledTask(task, ncall)
+        with self._cond:
+            self._entries[entry.key] = entry
+            self._arm(entry)
+            thread = self._create_thread()
+        if thread is not None:
+            thread.start()
+        return entry
+
+    def after_fork(self, restart):
+        # Called in the child process: the scheduler thread does not exist
+        # in the child and the lock may have been held by another thread
+        # of the parent during the fork
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = None
+        self._timers = []
+        self._watchers = set()
+        self._last_sample = None
+        self._rate = 0.0
+        entries = list(self._entries.values())
+        self._entries = {}
+
+        with self._cond:
+            memory = self._get_traced_memory()
+            for entry in entries:
+                task = entry.task_ref()
+                if (not restart
+                or task is None or not task._can_restart_after_fork()):
+                    entry.active = False
+                    continue
+                # desynchronize the children of the same parent
+                jitter = random.uniform(0.0, task.get_fork_jitter())
+                self._entries[entry.key] = entry
+                self._arm(entry, memory, jitter)
+            if self._entries:
+                thread = self._create_thread()
+            else:
+                thread = None
+        if thread is not None:
+            thread.start()
+
+    def reschedule(self, entry):
+        with self._cond:
+            if not entry.active:
+                return
+            # FIXME: reschedule using old traced and time, not new
+            self._arm(entry)
+            self._cond.notify_all()
+
+    def cancel(self, entry):
+        with self._cond:
+            self._remove(entry)
+            self._cond.notify_all()
+            # wait until the task exited, except if the task is cancelled
+            # by itself
+            if threading.current_thread() is not self._thread:
+                while self._running is entry:
+                    self._cond.wait()
+
+    def get_tasks(self):
+        with self._cond:
+            refs = [entry.task_ref for entry in self._entries.values()]
+        tasks = []
+        for ref in refs:
+            task = ref()
+            if task is None:
+                continue
+            tasks.append(task)
+        return tasks
+
+    def _next_task(self):
+        # Return (entry, delay): entry is the task which must be called now,
+        # or None if the scheduler must sleep delay seconds
+        now = _time_monotonic()
+        timers = self._timers
+        while timers:
+            timeout, sequence, entry = timers[0]
+            if not entry.active or entry.timeout != timeout:
+                heapq.heappop(timers)
+                continue
+            if timeout <= now:
+                heapq.heappop(timers)
+                return entry, None
+            break
+
+        if self._watchers:
+            traced, max_traced = self._sample_traced(now)
+            delay = None
+            for entry in self._watchers:
+                entry_delay = entry.poll(now, traced, max_traced, self._rate)
+                if entry_delay is None:
+                    return entry, None
+                if delay is not None:
+                    delay = min(delay, entry_delay)
+                else:
+                    delay = entry_delay
+        else:
+            self._last_sample = None
+            delay = None
 
-        # release locks
-        self.run_lock.release()
-        self.stop_lock.release()
+        if timers:
+            dt = timers[0][0] - now
+            if delay is not None:
+                delay = min(delay, dt)
+            else:
+                delay = dt
+        return None, delay
 
-    def _task(self):
-        pass
+    def _call(self, entry):
+        task = entry.task_ref()
+        if task is None:
+            return False
+        try:
+            task.call()
+        except Exception as err:
+            # the task is not rescheduled on error
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            # FIXME: log the traceback
+            print(("%s: %s" % (exc_type, exc_value)), file=sys.stderr)
+            return False
+        if entry.ncall is not None:
+            entry.ncall -= 1
+            if entry.ncall <= 0:
+                return False
+        return True
 
-_scheduled_tasks = {}
+    def _run(self):
+        _block_signals()
+
+        while True:
+            with self._cond:
+                while True:
+                    if not self._entries:
+                        # no more task: exit the thread, it will be
+                        # recreated by the next call to add()
+                        self._thread = None
+                        return
+                    entry, delay = self._next_task()
+                    if entry is not None:
+                        break
+                    self._cond.wait(timeout=delay)
+                self._running = entry
+
+            reschedule = self._call(entry)
+            if self._thread is not threading.current_thread():
+                # the task forked the process: the child process has its own
+                # scheduler thread
+                return
+
+            with self._cond:
+                self._running = None
+                if entry.active:
+                    if reschedule:
+                        self._arm(entry)
+                    else:
+                        self._remove(entry)
+                self._cond.notify_all()
+
+_scheduler = _Scheduler()
+# the fork_dump attribute is True in the thread forking a child process
+# only used to write a snapshot
+_fork_state = threading.local()
 
 def get_tasks():
-    tasks = []
-    refs = list(_scheduled_tasks.values())
-    for ref in refs:
-        task = ref()
-        if task is None:
-            continue
-        tasks.append(task)
-    return tasks
+    return _scheduler.get_tasks()
 
 def cancel_tasks():
     tasks = get_tasks()
     for task in tasks:
         task.cancel()
-    _scheduled_tasks.clear()
 cancel_tasks._registered = False
 
 
 class Task:
     def __init__(self, func, *args, **kwargs):
-        self._thread = None
+        self._entry = None
         self._memory_threshold = None
         self._delay = None
+        self._min_poll_delay = _MIN_MEMORY_POLL_DELAY
+        self._max_poll_delay = _MAX_MEMORY_POLL_DELAY
+        self._growth_rate_threshold = None
+        self._peak_threshold = None
+        self._fork_jitter = 0.0
+        self.restart_after_fork = True
         self._func_ref = weakref.ref(func)
         self.func_args = args
         self.func_kwargs = kwargs
@@ -583,23 +2983,24 @@ class Task:
     def get_delay(self):
         return self._delay
 
+    def _can_restart_after_fork(self):
+        return self.restart_after_fork
+
     def _cancel(self):
-        self._thread.stop()
-        self._thread.join()
-        self._thread = None
-        del _scheduled_tasks[id(self)]
+        _scheduler.cancel(self._entry)
+        self._entry = None
 
     def is_scheduled(self):
-        if self._thread is None:
+        if self._entry is None:
             return False
-        if not self._thread.is_alive():
-            self._cancel()
+        if not self._entry.active:
+            self._entry = None
             return False
         return True
 
     def _reschedule(self):
         if self.is_scheduled():
-            self._thread.reschedule()
+            _scheduler.reschedule(self._entry)
 
     def set_delay(self, delay):
         if delay <= 0.0:
@@ -616,24 +3017,66 @@ class Task:
         self._memory_threshold = size
         self._reschedule()
 
+    def get_growth_rate_threshold(self):
+        return self._growth_rate_threshold
+
+    def set_growth_rate_threshold(self, rate, window):
+        if rate <= 0:
+            raise ValueError("rate must greater than 0")
+        if window <= 0:
+            raise ValueError("window must greater than 0")
+        self._growth_rate_threshold = (rate, window)
+        self._reschedule()
+
+    def get_peak_threshold(self):
+        return self._peak_threshold
+
+    def set_peak_threshold(self, size):
+        if size < 1:
+            raise ValueError("threshold must greater than 0")
+        self._peak_threshold = size
+        self._reschedule()
+
+    def get_fork_jitter(self):
+        return self._fork_jitter
+
+    def set_fork_jitter(self, jitter):
+        if jitter < 0:
+            raise ValueError("jitter must be positive or zero")
+        self._fork_jitter = jitter
+
+    def get_memory_poll_delay(self):
+        return (self._min_poll_delay, self._max_poll_delay)
+
+    def set_memory_poll_delay(self, min_delay, max_delay):
+        if min_delay <= 0.0:
+            raise ValueError("minimum delay must greater than 0")
+        if max_delay < min_delay:
+            raise ValueError("maximum delay must be greater than or equal "
+                             "to the minimum delay")
+        self._min_poll_delay = min_delay
+        self._max_poll_delay = max_delay
+        self._reschedule()
+
     def schedule(self, ncall=None):
-        if self._delay is None and self._memory_threshold is None:
-            raise ValueError("need a delay or a memory threshold")
+        if (self._delay is None and self._memory_threshold is None
+        and self._growth_rate_threshold is None
+        and self._peak_threshold is None):
+            raise ValueError("need a delay, a memory threshold, "
+                             "a growth rate threshold or a peak threshold")
 
         if not tracemalloc.is_enabled():
             raise RuntimeError("the tracemalloc module must be enabled "
                                "to schedule a task")
 
         self.cancel()
-        self._thread = _TaskThread(self, ncall)
-        self._thread.start()
-        _scheduled_tasks[id(self)] = weakref.ref(self)
+        self._entry = _scheduler.add(self, ncall)
         if not cancel_tasks._registered:
             cancel_tasks._registered = True
             atexit.register(cancel_tasks)
 
     def cancel(self):
-        if self._thread is None:
+        if self._entry is None:
             return
         self._cancel()
 
@@ -656,16 +3099,450 @@ class DisplayTopTask(Task):
                                         self.callback)
 
 
+class _CollectTask(Task):
+    def __init__(self, registry):
+        Task.__init__(self, MetricsRegistry.collect, registry)
+        self.min_delay = _MIN_COLLECT_DELAY
+
+    def call(self):
+        Task.call(self)
+        # run again when the next collector is due: the scheduler rearms
+        # the task with the new delay after the call
+        registry = self.func_args[0]
+        self._delay = registry.get_next_delay(self.min_delay)
+
+
+# SnapshotWriter instances
+_writers = weakref.WeakSet()
+
+class SnapshotWriter:
+    def __init__(self, maxsize=8, policy='block', compression=None):
+        if policy not in ('block', 'drop'):
+            raise ValueError("invalid policy: %r" % (policy,))
+        self.policy = policy
+        self.compression = compression
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._registered = False
+        _writers.add(self)
+        self.written = 0
+        self.dropped = 0
+        self.last_latency = None
+        self.max_latency = None
+        self.total_latency = 0.0
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name="tracemalloctext-writer")
+            self._thread.daemon = True
+            self._thread.start()
+            if not self._registered:
+                # write pending snapshots at exit
+                self._registered = True
+                atexit.register(self.close)
+
+    def _run(self):
+        _block_signals()
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                self._write(*item)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, snapshot, filename, format, base, callback):
+        start = _time_monotonic()
+        try:
+            dump_snapshot(snapshot, filename, self.compression, format, base)
+        except Exception:
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            print("ERROR: Failed to write snapshot %s: %s: %s"
+                  % (filename, exc_type, exc_value), file=sys.stderr)
+            written = False
+        else:
+            latency = _time_monotonic() - start
+            self.written += 1
+            self.last_latency = latency
+            self.total_latency += latency
+            if self.max_latency is None or latency > self.max_latency:
+                self.max_latency = latency
+            written = True
+        if callback is not None:
+            try:
+                callback(filename, written)
+            except Exception:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+                print("%s: %s" % (exc_type, exc_value), file=sys.stderr)
+
+    def write(self, snapshot, filename, format='pickle', base=None,
+              callback=None):
+        self._start()
+        item = (snapshot, filename, format, base, callback)
+        if self.policy == 'drop':
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+                return False
+        else:
+            self._queue.put(item)
+        return True
+
+    def after_fork(self):
+        # Called in the child process: pending snapshots are written by the
+        # parent process, the writer thread is recreated on demand
+        self._queue = queue.Queue(self._queue.maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def queue_size(self):
+        return self._queue.qsize()
+
+    def get_average_latency(self):
+        if not self.written:
+            return None
+        return self.total_latency / self.written
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join()
+
+    def add_metrics(self, snapshot):
+        snapshot.add_metric('snapshot_writer.queue', self.queue_size(), 'int')
+        snapshot.add_metric('snapshot_writer.written', self.written, 'int')
+        snapshot.add_metric('snapshot_writer.dropped', self.dropped, 'int')
+        if self.last_latency is not None:
+            snapshot.add_metric('snapshot_writer.latency',
+                                self.last_latency, 'seconds')
+            snapshot.add_metric('snapshot_writer.max_latency',
+                                self.max_latency, 'seconds')
+            snapshot.add_metric('snapshot_writer.average_latency',
+                                self.get_average_latency(), 'seconds')
+
+
+# Capture tiers of CapturePolicy, value of the capture.tier metric
+_CAPTURE_TIERS = ('stats', 'traces')
+
+class CapturePolicy:
+    def __init__(self, growth_threshold=None, top_count=None,
+                 max_per_hour=4, group_by='line'):
+        if growth_threshold is not None and growth_threshold <= 0:
+            raise ValueError("growth threshold must be positive")
+        if top_count is not None and top_count < 1:
+            raise ValueError("top count must be at least 1")
+        if max_per_hour < 1:
+            raise ValueError("max_per_hour must be at least 1")
+        self.growth_threshold = growth_threshold
+        self.top_count = top_count
+        self.max_per_hour = max_per_hour
+        self.group_by = group_by
+        # name of the trigger of the last escalation
+        self.last_trigger = None
+        # number of escalations skipped because of max_per_hour
+        self.suppressed = 0
+        # traced memory of the last full capture, or of the first snapshot
+        self._base_size = None
+        self._top_keys = None
+        # times of full captures of the last hour
+        self._captures = collections.deque()
+
+    def _get_trigger(self, snapshot):
+        size = sum(line_stats[0]
+                   for filename_stats in snapshot.stats.values()
+                   for line_stats in filename_stats.values())
+        if self._base_size is None:
+            self._base_size = size
+        trigger = None
+        if (self.growth_threshold is not None
+        and size - self._base_size >= self.growth_threshold):
+            trigger = 'growth'
+
+        if self.top_count is not None:
+            top_stats = top_by(snapshot, self.group_by)
+            top = heapq.nlargest(self.top_count, top_stats.stats.items(),
+                                 key=lambda item: item[1][0])
+            keys = set(item[0] for item in top)
+            if (trigger is None
+            and self._top_keys is not None
+            and not keys <= self._top_keys):
+                trigger = 'new_key'
+            self._top_keys = keys
+        return trigger, size
+
+    def get_tier(self, snapshot, now=None):
+        # Get the tier of the next capture from a stats-only snapshot:
+        # 'traces' if a trigger fires, 'stats' otherwise
+        if now is None:
+            now = _time_monotonic()
+        trigger, size = self._get_trigger(snapshot)
+        if trigger is None:
+            return 'stats'
+
+        captures = self._captures
+        while captures and now - captures[0] >= 3600.0:
+            captures.popleft()
+        if len(captures) >= self.max_per_hour:
+            self.suppressed += 1
+            return 'stats'
+        captures.append(now)
+        self.last_trigger = trigger
+        self._base_size = size
+        return 'traces'
+
+
+class _RetentionEntry:
+    __slots__ = ('filename', 'timestamp', 'base', 'size')
+
+    def __init__(self, filename, timestamp, base):
+        self.filename = filename
+        self.timestamp = timestamp
+        # filename of the base snapshot of a delta snapshot
+        self.base = base
+        # None while the file is being written
+        self.size = None
+
+
+def _hour_bucket(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+def _day_bucket(timestamp):
+    return timestamp.date()
+
+_retention_policies = weakref.WeakSet()
+
+class RetentionPolicy:
+    def __init__(self, keep_last=None, max_bytes=None, hourly=None,
+                 daily=None):
+        for name, value in (('keep_last', keep_last), ('hourly', hourly),
+                            ('daily', daily)):
+            if value is not None and value < 1:
+                raise ValueError("%s must be at least 1" % name)
+        if max_bytes is not None and max_bytes < 0:
+            raise ValueError("max_bytes must be positive")
+        self.keep_last = keep_last
+        self.max_bytes = max_bytes
+        self.hourly = hourly
+        self.daily = daily
+        self.total_size = 0
+        self.deleted = 0
+        # filename => _RetentionEntry of files written by the task, oldest
+        # first. The writer thread updates the index.
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        _retention_policies.add(self)
+
+    def after_fork(self):
+        # Called in the child process: files written by the parent process
+        # are pruned by the parent, the child only prunes its own files
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.total_size = 0
+        self.deleted = 0
+
+    def add(self, filename, timestamp, base=None):
+        with self._lock:
+            entry = self._entries.pop(filename, None)
+            if entry is not None and entry.size is not None:
+                # the file is overwritten (peak window)
+                self.total_size -= entry.size
+            self._entries[filename] = _RetentionEntry(filename, timestamp,
+                                                      base)
+
+    def set_written(self, filename, written=True):
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                return
+            if written:
+                try:
+                    entry.size = os.path.getsize(filename)
+                except OSError:
+                    written = False
+            if not written:
+                del self._entries[filename]
+                return
+            self.total_size += entry.size
+            self._prune()
+
+    def get_files(self):
+        with self._lock:
+            return list(self._entries)
+
+    def add_metrics(self, snapshot):
+        with self._lock:
+            nfile = len(self._entries)
+        snapshot.add_metric('retention.files', nfile, 'int')
+        snapshot.add_metric('retention.size', self.total_size, 'size')
+        snapshot.add_metric('retention.deleted', self.deleted, 'int')
+
+    def _select(self, entries):
+        # Get the set of filenames kept by keep_last, hourly and daily
+        if (self.keep_last is None
+        and self.hourly is None
+        and self.daily is None):
+            return set(entry.filename for entry in entries)
+
+        # always keep the most recent snapshot
+        keep = {entries[-1].filename}
+        if self.keep_last is not None:
+            keep.update(entry.filename
+                        for entry in entries[-self.keep_last:])
+        for count, get_bucket in ((self.hourly, _hour_bucket),
+                                  (self.daily, _day_bucket)):
+            if count is None:
+                continue
+            # keep the oldest snapshot of the count most recent buckets:
+            # kept files don't change when new snapshots are added
+            buckets = {}
+            for entry in entries:
+                buckets.setdefault(get_bucket(entry.timestamp),
+                                   entry.filename)
+            for bucket in sorted(buckets)[-count:]:
+                keep.add(buckets[bucket])
+        return keep
+
+    def _prune(self):
+        entries = self._entries
+        written = [entry for entry in entries.values()
+                   if entry.size is not None]
+        if not written:
+            return
+        written.sort(key=lambda entry: entry.timestamp)
+        keep = self._select(written)
+
+        # a delta snapshot requires all snapshots of its chain up to the
+        # keyframe, files being written are also protected
+        pending = [filename for filename, entry in entries.items()
+                   if entry.size is None]
+        stack = list(keep) + pending
+        while stack:
+            base = entries[stack.pop()].base
+            if base in entries and base not in keep:
+                keep.add(base)
+                stack.append(base)
+
+        if self.max_bytes is not None:
+            # base filename => filenames of delta snapshots
+            deltas = {}
+            for entry in entries.values():
+                if entry.base is not None:
+                    deltas.setdefault(entry.base, []).append(entry.filename)
+            protected = set(pending)
+            protected.add(written[-1].filename)
+            size = sum(entry.size for entry in written
+                       if entry.filename in keep)
+            # drop the oldest snapshots with their delta snapshots
+            for entry in written:
+                if size <= self.max_bytes:
+                    break
+                if entry.filename not in keep:
+                    continue
+                drop = {entry.filename}
+                stack = [entry.filename]
+                while stack:
+                    for filename in deltas.get(stack.pop(), ()):
+                        if filename not in drop:
+                            drop.add(filename)
+                            stack.append(filename)
+                if drop & protected:
+                    break
+                for filename in drop:
+                    if filename in keep:
+                        keep.discard(filename)
+                        size -= entries[filename].size
+
+        for entry in written:
+            if entry.filename in keep:
+                continue
+            del entries[entry.filename]
+            self.total_size -= entry.size
+            try:
+                os.unlink(entry.filename)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+                print("ERROR: Failed to remove snapshot %s: %s: %s"
+                      % (entry.filename, exc_type, exc_value),
+                      file=sys.stderr)
+                continue
+            self.deleted += 1
+
+
+_snapshot_tasks = weakref.WeakSet()
+
 class TakeSnapshotTask(Task):
     def __init__(self, filename_template="tracemalloc-$counter.pickle",
                  traces=False, metrics=True,
-                 callback=None):
+                 callback=None, peak_window=None, fork=False,
+                 max_children=1, writer=None, format='pickle',
+                 keyframe_interval=None, sample_size=None, policy=None,
+                 retention=None):
         Task.__init__(self, self.take_snapshot)
         self.filename_template = filename_template
         self.traces = traces
         self.metrics = metrics
         self.callback = callback
         self.counter = 1
+        self.peak_window = peak_window
+        # (start time, traced memory, filename) of the current peak window
+        self._peak = None
+        self.fork = fork
+        self.max_children = max_children
+        # pid => filename of child processes writing a snapshot
+        self._children = {}
+        self.writer = writer
+        self.format = format
+        if keyframe_interval is not None and peak_window is not None:
+            raise ValueError("delta snapshots cannot be used "
+                             "with a peak window")
+        self.keyframe_interval = keyframe_interval
+        if sample_size is not None and sample_size < 1:
+            raise ValueError("sample size must be at least 1")
+        self.sample_size = sample_size
+        self.policy = policy
+        self.retention = retention
+        # (filename, traces, depth, serial) of the last written snapshot of
+        # the delta chain, depth is 0 for a keyframe
+        self._delta_base = None
+        self._delta_serial = 0
+        # filename => (filename, traces, depth, serial) of snapshots being
+        # written
+        self._pending_deltas = {}
+        # table of the last snapshot: tracebacks are shared by consecutive
+        # snapshots, it reduces the memory usage and the size of pickle
+        # files, and the delta between two snapshots is faster to compute
+        self.traceback_table = TracebackTable()
+        _snapshot_tasks.add(self)
+
+    def after_fork(self):
+        # Called in the child process: child processes writing snapshots
+        # and snapshots being written belong to the parent process, the
+        # next snapshot is a keyframe
+        self._children = {}
+        self._pending_deltas = {}
+        self._delta_base = None
+        self._peak = None
+
+    def _can_restart_after_fork(self):
+        # without $pid, all child processes would write, overwrite and
+        # remove the same files
+        return (self.restart_after_fork
+                and '$pid' in self.filename_template)
 
     def create_filename(self, snapshot):
         filename = self.filename_template
@@ -675,21 +3552,321 @@ class TakeSnapshotTask(Task):
         timestamp = timestamp.replace(" ", "-")
         filename = filename.replace("$timestamp", timestamp)
 
+        if snapshot.traces is not None:
+            tier = 'traces'
+        else:
+            tier = 'stats'
+        filename = filename.replace("$tier", tier)
+
         filename = filename.replace("$counter", "%04i" % self.counter)
         self.counter += 1
         return filename
 
     def take_snapshot(self):
-        snapshot = tracemalloc.Snapshot.create(traces=self.traces)
+        filename = None
+        if self.peak_window is not None:
+            # only keep the worst peak of each window
+            now = _time_monotonic()
+            traced = tracemalloc.get_traced_memory()[0]
+            if (self._peak is not None
+            and now - self._peak[0] < self.peak_window):
+                start, peak, filename = self._peak
+                if traced <= peak:
+                    return None, None
+                self._peak = (start, traced, filename)
+            else:
+                self._peak = (now, traced, None)
+
+        if self.policy is not None:
+            # take a cheap stats-only snapshot, and only capture traces if
+            # the policy escalates
+            snapshot = tracemalloc.Snapshot.create(traces=False)
+            tier = self.policy.get_tier(snapshot)
+            if tier == 'traces':
+                snapshot = tracemalloc.Snapshot.create(traces=True)
+        else:
+            snapshot = tracemalloc.Snapshot.create(traces=self.traces)
+        if self.sample_size is not None and snapshot.traces is not None:
+            sample_traces(snapshot, self.sample_size)
+        # only reuse tracebacks of the previous snapshot: tracebacks of
+        # older snapshots are not kept alive
+        self.traceback_table = TracebackTable(self.traceback_table)
+        intern_tracebacks(snapshot, self.traceback_table)
         if self.metrics:
             add_metrics(snapshot)
+            if self.writer is not None:
+                self.writer.add_metrics(snapshot)
+        if self.policy is not None:
+            snapshot.add_metric('capture.tier', _CAPTURE_TIERS.index(tier),
+                                'int')
+        # identify the worker of a snapshot file of a fleet
+        snapshot.add_metric(_PID_METRIC, os.getpid(), 'int')
         if self.callback is not None:
             self.callback(snapshot)
 
-        filename = self.create_filename(snapshot)
-        snapshot.dump(filename)
+        new_filename = (filename is None)
+        if new_filename:
+            filename = self.create_filename(snapshot)
+            if self._peak is not None:
+                self._peak = self._peak[:2] + (filename,)
+
+        base = None
+        if self.keyframe_interval is not None and snapshot.traces is not None:
+            if self._children:
+                # a snapshot written by a child process can be the base
+                self._reap_children(False)
+            # write a keyframe every keyframe_interval snapshots, and only
+            # the difference with the last written snapshot otherwise: a
+            # snapshot only becomes a base once its file is written
+            depth = 0
+            delta_base = self._delta_base
+            if (delta_base is not None
+            and delta_base[2] < self.keyframe_interval - 1):
+                base = delta_base[:2]
+                depth = delta_base[2] + 1
+            self._delta_serial += 1
+            self._pending_deltas[filename] = (filename, snapshot.traces,
+                                              depth, self._delta_serial)
+
+        retention = self.retention
+        if retention is not None:
+            # index the file before it is written to protect its base
+            if base is not None:
+                retention.add(filename, snapshot.timestamp, base[0])
+            else:
+                retention.add(filename, snapshot.timestamp)
+
+        if self.writer is not None:
+            if not self.writer.write(snapshot, filename, self.format, base,
+                                     self._written):
+                # the snapshot was dropped: the file will not exist
+                self._written(filename, False)
+                if new_filename:
+                    self.counter -= 1
+                return snapshot, None
+        elif self.fork and hasattr(os, 'fork'):
+            self._fork_dump(snapshot, filename, base)
+        else:
+            try:
+                dump_snapshot(snapshot, filename, format=self.format,
+                              base=base)
+            except BaseException:
+                self._written(filename, False)
+                raise
+            self._written(filename, True)
         return snapshot, filename
 
+    def _written(self, filename, written):
+        # Called when a snapshot file is written, or if the write failed or
+        # the snapshot was dropped. It can be called by the writer thread.
+        delta = self._pending_deltas.pop(filename, None)
+        if delta is not None:
+            # files can be written out of order by child processes
+            delta_base = self._delta_base
+            if delta_base is None or delta[3] > delta_base[3]:
+                if written:
+                    self._delta_base = delta
+                else:
+                    # the next snapshot is a keyframe
+                    self._delta_base = None
+        if self.retention is not None:
+            self.retention.set_written(filename, written)
+
+    def _fork_dump(self, snapshot, filename, base):
+        self._reap_children(False)
+        # two children must not write the same file (peak window)
+        for pid, child_filename in list(self._children.items()):
+            if child_filename == filename:
+                self._reap_child(pid, True)
+        while len(self._children) >= self.max_children:
+            self._reap_child(next(iter(self._children)), True)
+
+        _fork_state.fork_dump = True
+        try:
+            pid = os.fork()
+        finally:
+            _fork_state.fork_dump = False
+        if not pid:
+            # child process: write the snapshot and exit immediatly
+            exitcode = 1
+            try:
+                dump_snapshot(snapshot, filename, format=self.format,
+                              base=base)
+                exitcode = 0
+            except BaseException:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+                print(("%s: %s" % (exc_type, exc_value)), file=sys.stderr)
+            finally:
+                os._exit(exitcode)
+        self._children[pid] = filename
+
+    def _reap_child(self, pid, block):
+        try:
+            pid, status = os.waitpid(pid, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            # the child was already reaped by someone else
+            status = 0
+        else:
+            if not pid:
+                return False
+        filename = self._children.pop(pid)
+        if status:
+            print("ERROR: Failed to write snapshot %s (exit status %s)"
+                  % (filename, status), file=sys.stderr)
+        self._written(filename, not status)
+        return True
+
+    def _reap_children(self, block):
+        for pid in list(self._children):
+            self._reap_child(pid, block)
+
+    def get_pending_files(self):
+        self._reap_children(False)
+        return list(self._children.values())
+
+    def wait_children(self):
+        self._reap_children(True)
+
+
+def _after_fork_in_child():
+    # don't restart tasks in a child process only used to write a snapshot
+    restart = not getattr(_fork_state, 'fork_dump', False)
+    _scheduler.after_fork(restart)
+    for writer in list(_writers):
+        writer.after_fork()
+    for collector in list(_process_memory_collectors):
+        collector.after_fork()
+    for registry in list(_metrics_registries):
+        registry.after_fork()
+    for retention in list(_retention_policies):
+        retention.after_fork()
+    for task in list(_snapshot_tasks):
+        task.after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _cli_log(message, *args):
+    if args:
+        message = message % args
+    sys.stderr.write(message + "\n")
+    sys.stderr.flush()
+
+
+def _cli_load_snapshot(filename, load_traces, need_traces, filters,
+                       delta_cache, traceback_table):
+    start = _time_monotonic()
+    if load_traces:
+        load_text = "Load snapshot %s" % filename
+    else:
+        load_text = "Load snapshot %s without traces" % filename
+    _cli_log(load_text)
+    try:
+        snapshot = load_snapshot(filename, load_traces, delta_cache)
+    except Exception:
+        err = sys.exc_info()[1]
+        print("ERROR: Failed to load %s: [%s] %s"
+              % (filename, type(err).__name__, err))
+        sys.exit(1)
+    # only keep the traces of the last loaded snapshot
+    key = os.path.abspath(filename)
+    for cached in list(delta_cache):
+        if cached != key:
+            del delta_cache[cached]
+
+    if isinstance(snapshot.traces, dict):
+        intern_tracebacks(snapshot, traceback_table)
+
+    info = []
+    if snapshot.stats is not None:
+        info.append('%s files' % len(snapshot.stats))
+    if snapshot.traces is not None:
+        info.append('%s traces (limit=%s frames)'
+                    % (len(snapshot.traces), snapshot.traceback_limit))
+    dt = _time_monotonic() - start
+    _cli_log("Load snapshot %s: %s (%.1f sec)",
+             filename, ', '.join(info), dt)
+
+    if need_traces:
+        if snapshot.traces is None:
+            print("ERROR: The snapshot %s does not contain traces, "
+                  "only stats" % filename)
+            sys.exit(1)
+
+    if filters:
+        start = _time_monotonic()
+        text = ("Apply %s filter%s on snapshot %s..."
+               % (len(filters),
+                  's' if not filters or len(filters) > 1 else '',
+                  _format_timestamp(snapshot.timestamp)))
+        _cli_log(text)
+        apply_filters(snapshot, filters)
+        dt = _time_monotonic() - start
+        _cli_log(text + " done (%.1f sec)" % dt)
+    return snapshot
+
+
+def _cli_sort_by_timestamp(filenames):
+    # Sort snapshot files by timestamp: only load the stats of snapshots
+    timestamps = {}
+    for filename in filenames:
+        _cli_log("Read the timestamp of snapshot %s", filename)
+        try:
+            snapshot = load_snapshot(filename, traces=False)
+        except Exception:
+            err = sys.exc_info()[1]
+            print("ERROR: Failed to load %s: [%s] %s"
+                  % (filename, type(err).__name__, err))
+            sys.exit(1)
+        timestamps[filename] = snapshot.timestamp
+        del snapshot
+    return sorted(filenames, key=timestamps.__getitem__)
+
+def _cli_top_by(snapshot, group_by, cumulative):
+    _cli_log("Group stats by %s ...", group_by)
+    start = _time_monotonic()
+    top_stats = top_by(snapshot, group_by, cumulative)
+    dt = _time_monotonic() - start
+    if dt > 0.5:
+        _cli_log("Group stats by %s (%.1f sec)", group_by, dt)
+    return top_stats
+
+
+def _cli_worker_name(top_stats, filename):
+    # the PID recorded by TakeSnapshotTask
+    if top_stats.metrics:
+        metric = top_stats.metrics.get(_PID_METRIC)
+        if metric is not None:
+            return str(metric.value)
+    # or the first number of the filename, usually the PID ($pid variable
+    # of the filename template)
+    basename = os.path.basename(filename)
+    match = re.search(r'[0-9]+', basename)
+    if match is not None:
+        return match.group()
+    return basename
+
+
+# state of a worker process of the command line: the filters, the delta
+# cache and the traceback table are reused for all files of the worker
+_cli_worker_state = {}
+
+def _cli_worker(args):
+    filename, load_traces, need_traces, filter_args, group_by, cumulative = args
+    state = _cli_worker_state
+    if state.get('filter_args') != filter_args:
+        state.clear()
+        state['filter_args'] = filter_args
+        state['filters'] = FilterMatcher(
+            tracemalloc.Filter(*filter_arg) for filter_arg in filter_args)
+        state['delta_cache'] = {}
+        state['traceback_table'] = TracebackTable()
+    snapshot = _cli_load_snapshot(filename, load_traces, need_traces,
+                                  state['filters'], state['delta_cache'],
+                                  state['traceback_table'])
+    return _cli_top_by(snapshot, group_by, cumulative)
+
 
 def main():
     from optparse import OptionParser
@@ -754,6 +3931,32 @@ def main():
     parser.add_option("-P", "--filename-parts",
         help="Number of displayed filename parts (default: 3)",
         type="int", action="store", default=3)
+    parser.add_option("--trend",
+        help="Rank keys by steady growth across all snapshots: least-squares "
+             "slope, R2 and monotonicity. Snapshots are sorted by "
+             "timestamp.",
+        action="store_true", default=False)
+    parser.add_option("--matrix",
+        help="Display a single table with keys as rows and snapshots as "
+             "columns. Only keys in the top NUMBER of at least one snapshot "
+             "are displayed. Snapshots are sorted by timestamp.",
+        action="store_true", default=False)
+    parser.add_option("--csv",
+        help="Write the --matrix table in the CSV format",
+        action="store_true", default=False)
+    parser.add_option("--fleet", metavar="WINDOW",
+        help="Merge snapshots of multiple processes taken in the same window "
+             "of WINDOW seconds and display outlier workers. Snapshots are "
+             "sorted by timestamp. The worker name is the PID recorded in "
+             "the snapshot, or the first number of the filename.",
+        type="float", action="store", default=None)
+    parser.add_option("--outlier-threshold", metavar="ZSCORE",
+        help="Minimum z-score of a worker outlier (default: 3.0)",
+        type="float", action="store", default=3.0)
+    parser.add_option("-j", "--jobs",
+        help="Number of worker processes used to load, filter and group "
+             "snapshots (default: 1)",
+        type="int", action="store", default=1)
     parser.add_option("--color",
         help="Always use colors",
         action="store_true", default=False)
@@ -765,6 +3968,18 @@ def main():
     if not filenames:
         parser.print_help()
         sys.exit(1)
+    if options.jobs < 1:
+        parser.error("--jobs must be greater than 0")
+    if options.csv:
+        options.matrix = True
+    if (options.trend + options.matrix + (options.fleet is not None)) > 1:
+        parser.error("--trend, --matrix and --fleet options are exclusive")
+    if ((options.trend or options.matrix or options.fleet is not None)
+    and options.block is not None):
+        parser.error("--block cannot be used with --trend, --matrix "
+                     "or --fleet")
+    if options.fleet is not None and options.fleet <= 0:
+        parser.error("--fleet window must be greater than 0")
 
     if options.traceback:
         group_by = "traceback"
@@ -791,61 +4006,41 @@ def main():
                 pattern = value
                 lineno = None
             filters.add(tracemalloc.Filter(include, pattern, lineno, traceback))
-
-    def log(message, *args):
-        if args:
-            message = message % args
-        sys.stderr.write(message + "\n")
-        sys.stderr.flush()
-
-    snapshots = []
-    for filename in filenames:
-        load_traces = (options.block or options.address
-                       or options.traceback or options.cumulative)
-
-        start = _time_monotonic()
-        if load_traces:
-            load_text = "Load snapshot %s" % filename
+    # decisions are shared by all snapshots
+    filters = FilterMatcher(filters)
+
+    load_traces = (options.block or options.address
+                   or options.traceback or options.cumulative)
+    need_traces = (options.block is not None or options.traceback)
+
+    def iter_snapshots():
+        if options.jobs > 1 and options.block is None:
+            # load, filter and group snapshots in worker processes, only the
+            # grouped stats are sent back
+            filter_args = tuple(
+                (trace_filter.include, trace_filter.pattern,
+                 trace_filter.lineno, trace_filter.traceback)
+                for trace_filter in filters.filters)
+            args = [(filename, load_traces, need_traces, filter_args,
+                     group_by, options.cumulative)
+                    for filename in filenames]
+            # give consecutive files to the same worker to reuse rebuilt
+            # traces of delta snapshots
+            chunksize = (len(args) + options.jobs - 1) // options.jobs
+            import concurrent.futures
+            with concurrent.futures.ProcessPoolExecutor(options.jobs) as executor:
+                for top_stats in executor.map(_cli_worker, args,
+                                              chunksize=chunksize):
+                    yield top_stats
         else:
-            load_text = "Load snapshot %s without traces" % filename
-        log(load_text)
-        try:
-            snapshot = tracemalloc.Snapshot.load(filename, load_traces)
-        except Exception:
-            err = sys.exc_info()[1]
-            print("ERROR: Failed to load %s: [%s] %s"
-                  % (filename, type(err).__name__, err))
-            sys.exit(1)
-
-        info = []
-        if snapshot.stats is not None:
-            info.append('%s files' % len(snapshot.stats))
-        if snapshot.traces is not None:
-            info.append('%s traces (limit=%s frames)'
-                        % (len(snapshot.traces), snapshot.traceback_limit))
-        dt = _time_monotonic() - start
-        log("Load snapshot %s: %s (%.1f sec)",
-             filename, ', '.join(info), dt)
-
-        if options.block is not None or options.traceback:
-            if snapshot.traces is None:
-                print("ERROR: The snapshot %s does not contain traces, "
-                      "only stats" % filename)
-                sys.exit(1)
-
-        if filters:
-            start = _time_monotonic()
-            text = ("Apply %s filter%s on snapshot %s..."
-                   % (len(filters),
-                      's' if not filters or len(filters) > 1 else '',
-                      _format_timestamp(snapshot.timestamp)))
-            log(text)
-            snapshot.apply_filters(filters)
-            dt = _time_monotonic() - start
-            log(text + " done (%.1f sec)" % dt)
-
-        snapshots.append(snapshot)
-    snapshots.sort(key=lambda snapshot: snapshot.timestamp)
+            # rebuilt traces of the last loaded delta snapshot
+            delta_cache = {}
+            # tracebacks shared by all snapshots
+            traceback_table = TracebackTable()
+            for filename in filenames:
+                yield _cli_load_snapshot(filename, load_traces, need_traces,
+                                         filters, delta_cache,
+                                         traceback_table)
 
     stream = sys.stdout
     if options.color:
@@ -855,15 +4050,93 @@ def main():
     else:
         color = stream.isatty()
 
-    log("")
+    top = DisplayTop()
+    top.filename_parts = options.filename_parts
+    top.average = not options.hide_average
+    top.count = not options.hide_count
+    top.size = not options.hide_size
+    top.metrics = not options.hide_metrics
+    top.compare_to_previous = not options.first
+    top.color = color
+
+    if options.fleet is not None:
+        # windows are built in chronological order
+        filenames = _cli_sort_by_timestamp(filenames)
+        # only keep per-key sums of the open window in memory: a window is
+        # displayed as soon as it is closed
+        def display_window(window):
+            top.display_top_stats(window.get_top_stats(),
+                                  count=options.number, file=stream)
+            top.display_outliers(window, count=options.number,
+                                 threshold=options.outlier_threshold,
+                                 file=stream)
+
+        fleet = FleetAggregation(options.fleet)
+        for filename, snapshot in zip(filenames, iter_snapshots()):
+            if isinstance(snapshot, tracemalloc.GroupedStats):
+                top_stats = snapshot
+            else:
+                top_stats = _cli_top_by(snapshot, group_by,
+                                        options.cumulative)
+            del snapshot
+            window = fleet.add(top_stats,
+                               _cli_worker_name(top_stats, filename))
+            del top_stats
+            if window is not None:
+                _cli_log("")
+                display_window(window)
+                del window
+        _cli_log("")
+        window = fleet.flush()
+        if window is not None:
+            display_window(window)
+            del window
+        if fleet.ignored:
+            _cli_log("Ignore %s snapshots: same worker in the same window",
+                     fleet.ignored)
+        print("%s snapshots, %s windows" % (len(filenames), fleet.nwindow))
+        return
+
+    if options.trend or options.matrix:
+        # top stats are added in chronological order
+        filenames = _cli_sort_by_timestamp(filenames)
+        # streaming analysis: only keep the stats of one snapshot in memory
+        if options.trend:
+            analysis = TrendAnalysis()
+        else:
+            analysis = StatsMatrix(options.number)
+        for snapshot in iter_snapshots():
+            if isinstance(snapshot, tracemalloc.GroupedStats):
+                top_stats = snapshot
+            else:
+                top_stats = _cli_top_by(snapshot, group_by,
+                                        options.cumulative)
+            del snapshot
+            analysis.add(top_stats)
+            del top_stats
+        _cli_log("")
+        if options.trend:
+            top.display_trend(analysis, count=options.number, file=stream)
+            print("%s snapshots" % analysis.nsnapshot)
+        elif options.csv:
+            analysis.write_csv(stream)
+        else:
+            top.display_matrix(analysis, file=stream)
+            print("%s snapshots" % len(analysis.timestamps))
+        return
+
+    snapshots = list(iter_snapshots())
+    snapshots.sort(key=lambda snapshot: snapshot.timestamp)
+
+    _cli_log("")
     if options.block is not None:
         address = options.block
 
         for snapshot in snapshots:
-            log("")
+            _cli_log("")
             trace = snapshot.traces.get(address)
             timestamp = _format_timestamp(snapshot.timestamp)
-            address = _format_address(address, color)
+            address_text = _format_address(address, color)
             if color:
                 timestamp = _FORMAT_CYAN % timestamp
             if trace is not None:
@@ -873,28 +4146,19 @@ def main():
                 if color:
                     size = _FORMAT_YELLOW % size
             print("%s, memory block %s: %s"
-                  % (timestamp, address, size))
+                  % (timestamp, address_text, size))
             if trace is not None:
                 for line in _format_traceback(trace[1], options.filename_parts, color):
                     print(line)
 
     else:
-        top = DisplayTop()
-        top.filename_parts = options.filename_parts
-        top.average = not options.hide_average
-        top.count = not options.hide_count
-        top.size = not options.hide_size
-        top.metrics = not options.hide_metrics
-        top.compare_to_previous = not options.first
-        top.color = color
-
         for snapshot in snapshots:
-            log("Group stats by %s ...", group_by)
-            start = _time_monotonic()
-            top_stats = snapshot.top_by(group_by, options.cumulative)
-            dt = _time_monotonic() - start
-            if dt > 0.5:
-                log("Group stats by %s (%.1f sec)", group_by, dt)
+            if isinstance(snapshot, tracemalloc.GroupedStats):
+                # already grouped by a worker process
+                top_stats = snapshot
+            else:
+                top_stats = _cli_top_by(snapshot, group_by,
+                                        options.cumulative)
             top.display_top_stats(top_stats, count=options.number, file=stream)
 
     print("%s snapshots" % len(snapshots))